@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Cost of filling a sheet cell by cell against one CellModel.batch().
+
+Fills a fully populated 50x20 sheet in which every formula reads the cell
+before it, as a paste or fill-down would, once through individual
+set_input calls and once inside a batch, then loads the same sheet from
+its saved calc_data. Reports time and formula evaluations for each.
+
+    python3 benchmarks/bench_batch.py [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calc import CellModel, format_ref
+
+
+def sheet_inputs(model):
+    """A1 holds a number; every other cell adds one to the cell before it in row-major order"""
+    cells = [(row, col) for row in range(model.rows) for col in range(model.cols)]
+    inputs = [(cells[0], '1')]
+    for previous, cell in zip(cells, cells[1:]):
+        inputs.append((cell, f"={format_ref(*previous)}+1"))
+    return inputs
+
+
+def counting_model():
+    model = CellModel()
+    model.evaluations = 0
+    evaluate = model.evaluate
+
+    def counted(cell):
+        model.evaluations += 1
+        return evaluate(cell)
+    model.evaluate = counted
+    return model
+
+
+def per_cell(model, inputs):
+    # Filled bottom-up, so every edit recalculates the formulas already below it
+    for cell, text in reversed(inputs):
+        model.set_input(cell, text)
+
+
+def batched(model, inputs):
+    with model.batch():
+        for cell, text in reversed(inputs):
+            model.set_input(cell, text)
+
+
+def loaded(model, inputs):
+    source = CellModel()
+    with source.batch():
+        for cell, text in inputs:
+            source.set_input(cell, text)
+    model.load(source.to_dict())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    inputs = sheet_inputs(CellModel())
+    print(f"{len(inputs)} cells")
+    for name, fill in (('per cell', per_cell), ('batch', batched), ('load', loaded)):
+        timings = []
+        for _ in range(args.repeat):
+            model = counting_model()
+            start = time.perf_counter()
+            fill(model, inputs)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:<10} {statistics.median(timings) * 1000:10.2f} ms  "
+              f"{model.evaluations:8d} evaluations  last = {model.display(inputs[-1][0])}")
+
+
+if __name__ == "__main__":
+    main()
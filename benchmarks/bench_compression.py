@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Note file size and save/load time for each compression codec and level.
+
+Saves representative notes in a temporary directory: a short note, a long
+prose note, a generated log-like note and a full 50x20 sheet of numbers and
+formulas. The legacy row is the original format, the note JSON encrypted
+as a single base64 Fernet token.
+
+    python3 benchmarks/bench_compression.py [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SETTINGS = [('none', None), ('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6)]
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def sample_notes(rng):
+    words = ['the', 'note', 'meeting', 'budget', 'call', 'tomorrow', 'review', 'draft',
+             'project', 'invoice', 'password', 'remember', 'shopping', 'list', 'and', 'to']
+    prose = '\n'.join(' '.join(rng.choice(words) for _ in range(rng.randint(5, 15)))
+                      for _ in range(20000))
+    log = '\n'.join(f"2024-01-{day % 28 + 1:02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d} "
+                    f"{rng.choice(['INFO', 'WARN', 'ERROR'])} request {rng.getrandbits(32):08x} "
+                    f"took {rng.random() * 1000:.1f} ms"
+                    for day in range(50000))
+    cells = {}
+    formulas = {}
+    for row in range(50):
+        for col in range(20):
+            if col < 15:
+                cells[f"{row},{col}"] = str(round(rng.uniform(-1000, 1000), 2))
+            else:
+                formulas[f"{row},{col}"] = f"=A{row + 1}+B{row + 1}*C{row + 1}"
+                cells[f"{row},{col}"] = str(round(rng.uniform(-1e6, 1e6), 2))
+    sheet = {'mode': 'calc', 'text_content': '', 'calc_data': {'cells': cells, 'formulas': formulas}}
+    return [
+        ('short', text_note('Call the bank about the card before Friday')),
+        ('prose', text_note(prose)),
+        ('log', text_note(log)),
+        ('sheet', sheet),
+    ]
+
+
+def median_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # storage reads or creates key.key in the working directory on first use
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    import storage
+
+    for name, note_data in sample_notes(random.Random(42)):
+        raw = len(json.dumps(note_data).encode())
+        print(f"{name}: {raw / 1024:.1f} KiB of JSON")
+
+        def save_legacy():
+            storage.write_atomic('legacy.enc', storage.cipher_suite.encrypt(json.dumps(note_data).encode()))
+
+        save = median_ms(save_legacy, args.repeat)
+        load = median_ms(lambda: (storage.note_cache.clear(), storage.load_note_file('legacy.enc')),
+                         args.repeat)
+        print(f"  {'legacy':<8} {os.path.getsize('legacy.enc') / 1024:10.1f} KiB "
+              f"save {save:8.2f} ms  load {load:8.2f} ms")
+
+        for codec, level in SETTINGS:
+            storage.set_compression(codec, level)
+            save = median_ms(lambda: storage.save_note_file('note.enc', note_data), args.repeat)
+            # Saving caches the note decrypted; time reading it from the file
+            load = median_ms(lambda: (storage.note_cache.clear(), storage.load_note_file('note.enc')),
+                             args.repeat)
+            label = codec if level is None else f"{codec}:{level}"
+            print(f"  {label:<8} {os.path.getsize('note.enc') / 1024:10.1f} KiB "
+                  f"save {save:8.2f} ms  load {load:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
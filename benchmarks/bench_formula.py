@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Per-evaluation cost of calc mode formulas.
+
+Compares the old regex substitution + eval() of evaluate_formula against
+compiled formulas from calc.compile_formula evaluated over a value store.
+
+    python3 benchmarks/bench_formula.py [--number 20000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calc import compile_formula, format_result, parse_ref
+
+FORMULAS = [
+    "=A1+1",
+    "=A1*B2-C3/4",
+    "=(A1+A2+A3+A4+A5)/5",
+    "=A10*2+B10**2-(C10%7)",
+]
+
+TEXT = {(row, col): str(row * 20 + col + 1) for row in range(50) for col in range(20)}
+VALUES = {cell: int(text) for cell, text in TEXT.items()}
+
+
+def legacy_evaluate(formula):
+    formula = formula[1:]
+    try:
+        for ref in re.findall(r'[A-T][1-9][0-9]?', formula):
+            cell = parse_ref(ref)
+            if cell:
+                formula = formula.replace(ref, TEXT[cell])
+        return str(eval(formula))
+    except Exception:
+        return "#ERROR"
+
+
+def compiled_evaluate(formula):
+    return format_result(compile_formula(formula).evaluate(VALUES.__getitem__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for formula in FORMULAS:
+        legacy = timeit.timeit(lambda: legacy_evaluate(formula), number=args.number)
+        compiled = timeit.timeit(lambda: compiled_evaluate(formula), number=args.number)
+        print(f"{formula:<24} legacy {legacy / args.number * 1e6:7.2f} us  "
+              f"compiled {compiled / args.number * 1e6:7.2f} us  "
+              f"({legacy / compiled:4.1f}x)  "
+              f"{legacy_evaluate(formula)} / {compiled_evaluate(formula)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Startup time and memory of the calc grid: eager vs virtualized.
+
+Each variant runs in a fresh interpreter that builds a 400x300 window with
+the grid inside a scrolled window, shows it and drains the main loop. The
+eager variant is a copy of the grid StickyNoteWindow built before CalcGrid:
+one Gtk.Entry with five handlers per cell. Needs a display (a real one or
+Xvfb).
+
+    python3 benchmarks/bench_grid.py [--rows 50] [--cols 20]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def build_eager(Gtk, rows, cols):
+    def handler(*args):
+        return False
+
+    grid = Gtk.Grid()
+    grid.set_column_spacing(1)
+    grid.set_row_spacing(1)
+    for col in range(cols):
+        grid.attach(Gtk.Label(label=chr(65 + col % 26)), col + 1, 0, 1, 1)
+    for row in range(rows):
+        grid.attach(Gtk.Label(label=str(row + 1)), 0, row + 1, 1, 1)
+    for row in range(rows):
+        for col in range(cols):
+            entry = Gtk.Entry()
+            entry.set_width_chars(10)
+            for signal in ('changed', 'key-press-event', 'button-press-event',
+                           'focus-out-event', 'focus-in-event'):
+                entry.connect(signal, handler, row, col)
+            grid.attach(entry, col + 1, row + 1, 1, 1)
+    return grid
+
+
+def build_virtual(Gtk, rows, cols):
+    import main
+
+    class Handlers:
+        def render_cells(self, cells):
+            pass
+
+        def __getattr__(self, name):
+            return lambda *args: False
+
+    return main.CalcGrid(Handlers(), rows, cols)
+
+
+def run_variant(variant, rows, cols):
+    # main.py reads or creates key.key in the working directory on first use
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk
+
+    window = Gtk.Window()
+    window.set_default_size(400, 300)
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+    baseline = rss_kb()
+
+    start = time.perf_counter()
+    grid = (build_eager if variant == 'eager' else build_virtual)(Gtk, rows, cols)
+    scroll = Gtk.ScrolledWindow()
+    scroll.add(grid)
+    window.add(scroll)
+    window.show_all()
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+    elapsed = time.perf_counter() - start
+
+    widgets = len(grid.get_children())
+    print(json.dumps({
+        'variant': variant,
+        'startup_ms': elapsed * 1000,
+        'rss_delta_kb': rss_kb() - baseline,
+        'child_widgets': widgets,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--cols', type=int, default=20)
+    parser.add_argument('--variant', choices=('eager', 'virtual'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.rows, args.cols)
+        return
+
+    for variant in ('eager', 'virtual'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--variant', variant,
+             '--rows', str(args.rows), '--cols', str(args.cols)],
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        print(f"{variant:<8} {result['startup_ms']:9.1f} ms  "
+              f"{result['rss_delta_kb'] / 1024:8.1f} MB RSS  "
+              f"{result['child_widgets']:6d} widgets")
+
+
+if __name__ == "__main__":
+    main()
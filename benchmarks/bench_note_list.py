@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Open, sort and filter cost of the Note Manager list for many notes.
+
+Saves synthetic notes into a temporary directory, growing it to each
+count in turn, then times what opening the Note Manager does: reading the
+manifest and building the list model (store, filter and sort), followed
+by re-sorting by modification time and filtering with a search matching
+one note in ten. Reports the RSS the model adds per note. The view draws
+only the rows on screen, so no widgets are made per note. Runs without a
+display.
+
+    python3 benchmarks/bench_note_list.py [--counts 1000 10000 20000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+WORDS = ['meeting', 'budget', 'call', 'review', 'draft', 'invoice', 'shopping', 'list']
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def median_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def create_notes(rng, start, count):
+    """Save notes start..count-1 and record them in the manifest in one write"""
+    import storage
+    from manifest import manifest
+
+    manifest.load()
+    for i in range(start, count):
+        filename = f"{rng.choice(WORDS)}-{i:05d}.enc"
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(5, 200)))
+        note_data = {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+        storage.save_note_file(filename, note_data, notify=False)
+        manifest.entries[filename] = manifest.make_entry(filename, note_data, os.stat(filename))
+    manifest.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 20000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # storage reads or creates key.key in the working directory on first use
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    from main import NOTE_FILE, NOTE_MTIME, NOTE_NAME, Gtk, note_list_model
+    from manifest import NoteManifest
+
+    rng = random.Random(42)
+    created = 0
+    for count in args.counts:
+        create_notes(rng, created, count)
+        created = count
+
+        def read_manifest():
+            fresh = NoteManifest()
+            fresh.load()
+            return fresh.list_entries()
+
+        def open_model():
+            model, iters = note_list_model(entries, lambda file: True)
+            model.set_sort_column_id(NOTE_NAME, Gtk.SortType.ASCENDING)
+            model.get_iter_first()  # The sort model sorts on first access
+            return model
+
+        manifest_ms = median_ms(read_manifest, args.repeat)
+        entries = read_manifest()
+        model_ms = median_ms(open_model, args.repeat)
+
+        baseline = rss_kb()
+        model = open_model()
+        rss = rss_kb() - baseline
+
+        def sort_by_mtime():
+            model.set_sort_column_id(NOTE_NAME, Gtk.SortType.ASCENDING)
+            model.get_iter_first()
+            model.set_sort_column_id(NOTE_MTIME, Gtk.SortType.DESCENDING)
+            model.get_iter_first()
+
+        sort_ms = median_ms(sort_by_mtime, args.repeat)
+
+        matches = {entry['file'] for entry in entries[::10]}
+        model, iters = note_list_model(entries, lambda file: file in matches)
+        filter_ms = median_ms(model.get_model().refilter, args.repeat)
+        shown = len(model)
+        assert model.get_value(model.get_iter_first(), NOTE_FILE) in matches
+
+        print(f"{count:>6} notes  manifest {manifest_ms:7.1f} ms  model {model_ms:7.1f} ms  "
+              f"sort {sort_ms:6.1f} ms  filter {filter_ms:6.1f} ms ({shown} shown)  "
+              f"{rss * 1024 / count:6.0f} B/note RSS")
+
+
+if __name__ == "__main__":
+    main()
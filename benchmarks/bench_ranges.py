@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Cost of range aggregates against spelled-out cell sums.
+
+Fills a 50x20 sheet with numbers and times evaluating =SUM(A1:A50) against
+=A1+A2+...+A50, and a whole-sheet SUM, through CellModel.evaluate. Also
+reports the dependency edges each form registers. Uses NumPy when it is
+installed.
+
+    python3 benchmarks/bench_ranges.py [--number 5000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import calc
+from calc import CellModel, format_ref
+
+RESULT = (0, 19)  # T1 holds the formula under test; the data fills the other columns
+
+
+def spelled_out(col, rows):
+    return '=' + '+'.join(format_ref(row, col) for row in range(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=5000)
+    args = parser.parse_args()
+
+    model = CellModel()
+    for row in range(model.rows):
+        for col in range(model.cols - 1):
+            model.set_input((row, col), str(row * model.cols + col))
+
+    print(f"numpy: {'yes' if calc._numpy() is not None else 'no (pure Python fallback)'}")
+    formulas = [
+        ('=SUM(A1:A50)', spelled_out(0, model.rows)),
+        ('=SUM(A1:S50)', None),
+        ('=AVERAGE(A1:S50)+MAX(B1:B50)', None),
+    ]
+    for formula, equivalent in formulas:
+        for text in filter(None, (formula, equivalent)):
+            model.set_input(RESULT, text)
+            edges = (len(model.graph.precedents.get(RESULT, ()))
+                     + len(model.graph.precedent_ranges.get(RESULT, ())))
+            seconds = timeit.timeit(lambda: model.evaluate(RESULT), number=args.number)
+            label = text if len(text) <= 30 else text[:27] + '...'
+            print(f"{label:<30} {seconds / args.number * 1e6:8.2f} us  "
+                  f"{edges:3d} edges  = {model.display(RESULT)}")
+
+
+if __name__ == "__main__":
+    main()
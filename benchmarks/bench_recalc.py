@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Edit-to-repaint latency of calc mode recalculation.
+
+Runs headless: cell text lives in a plain dict standing in for the Gtk.Entry
+grid, and "repaint" is the point where every dirty cell has received its new
+text. The legacy engine is a copy of the recursive depth-first
+update_dependent_cells that main.py used before the dependency graph.
+
+    python3 benchmarks/bench_recalc.py [--rows 50] [--cols 20] [--repeat 20]
+"""
+
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calc import DependencyGraph
+
+
+def cell_to_ref(row, col):
+    return f"{chr(65 + col)}{row + 1}"
+
+
+def ref_to_cell(ref):
+    col = ord(ref[0].upper()) - 65
+    row = int(ref[1:]) - 1
+    if 0 <= row < 50 and 0 <= col < 20:
+        return (row, col)
+    return None
+
+
+class HeadlessSheet:
+    """The evaluation half of StickyNoteWindow with widgets replaced by a dict"""
+
+    def __init__(self):
+        self.text = {}
+        self.formulas = {}
+        self.evaluations = 0
+
+    def find_dependencies(self, formula):
+        return [ref_to_cell(ref) for ref in re.findall(r'[A-T][1-9][0-9]?', formula)]
+
+    def evaluate_formula(self, formula, current_cell):
+        self.evaluations += 1
+        formula = formula[1:]
+        try:
+            for ref in re.findall(r'[A-T][1-9][0-9]?', formula):
+                formula = formula.replace(ref, self.text.get(ref_to_cell(ref), ''))
+            return str(eval(formula))
+        except Exception:
+            return "#ERROR"
+
+
+class LegacyEngine(HeadlessSheet):
+    def __init__(self):
+        super().__init__()
+        self.cell_dependencies = {}
+
+    def update_dependencies(self, cell, formula):
+        for deps in self.cell_dependencies.values():
+            if cell in deps:
+                deps.remove(cell)
+        for dep in self.find_dependencies(formula):
+            self.cell_dependencies.setdefault(dep, [])
+            if cell not in self.cell_dependencies[dep]:
+                self.cell_dependencies[dep].append(cell)
+
+    def update_dependent_cells(self, cell):
+        for dep in self.cell_dependencies.get(cell, [])[:]:
+            if dep in self.formulas:
+                self.text[dep] = self.evaluate_formula(self.formulas[dep], dep)
+                self.update_dependent_cells(dep)
+
+
+class GraphEngine(HeadlessSheet):
+    def __init__(self):
+        super().__init__()
+        self.dependency_graph = DependencyGraph()
+
+    def update_dependencies(self, cell, formula):
+        self.dependency_graph.set_precedents(cell, self.find_dependencies(formula))
+
+    def update_dependent_cells(self, cell):
+        for dep in self.dependency_graph.recalc_order([cell]):
+            if dep in self.formulas:
+                self.text[dep] = self.evaluate_formula(self.formulas[dep], dep)
+
+
+def build_chain(engine, rows, cols):
+    """Every cell in row-major order adds one to the cell before it"""
+    cells = [(row, col) for row in range(rows) for col in range(cols)]
+    engine.text[cells[0]] = '1'
+    for previous, cell in zip(cells, cells[1:]):
+        formula = f"={cell_to_ref(*previous)}+1"
+        engine.formulas[cell] = formula
+        engine.update_dependencies(cell, formula)
+    return cells[0]
+
+
+def build_diamond(engine, rows, cols):
+    """Every cell sums its left and upper neighbours, sharing all descendants"""
+    engine.text[(0, 0)] = '1'
+    for row in range(rows):
+        for col in range(cols):
+            if (row, col) == (0, 0):
+                continue
+            refs = []
+            if row > 0:
+                refs.append(cell_to_ref(row - 1, col))
+            if col > 0:
+                refs.append(cell_to_ref(row, col - 1))
+            formula = "=" + "+".join(refs)
+            engine.formulas[(row, col)] = formula
+            engine.update_dependencies((row, col), formula)
+    return (0, 0)
+
+
+def measure(engine_cls, shape, rows, cols, repeat):
+    engine = engine_cls()
+    source = shape(engine, rows, cols)
+    timings = []
+    for i in range(repeat):
+        engine.text[source] = str(i + 2)
+        engine.evaluations = 0
+        start = time.perf_counter()
+        try:
+            engine.update_dependent_cells(source)
+        except RecursionError:
+            return {'error': 'RecursionError'}
+        timings.append(time.perf_counter() - start)
+    return {
+        'median_ms': statistics.median(timings) * 1000,
+        'evaluations': engine.evaluations,
+    }
+
+
+def report(label, result):
+    if 'error' in result:
+        print(f"  {label:<8} {result['error']}")
+    else:
+        print(f"  {label:<8} {result['median_ms']:10.2f} ms  {result['evaluations']:8d} evaluations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--cols', type=int, default=20)
+    parser.add_argument('--diamond-size', type=int, default=8,
+                        help="side of the diamond sheet; legacy cost grows exponentially")
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"chained {args.rows}x{args.cols} sheet, edit A1")
+    report('legacy', measure(LegacyEngine, build_chain, args.rows, args.cols, args.repeat))
+    report('graph', measure(GraphEngine, build_chain, args.rows, args.cols, args.repeat))
+
+    size = args.diamond_size
+    print(f"diamond {size}x{size} sheet, edit A1")
+    report('legacy', measure(LegacyEngine, build_diamond, size, size, args.repeat))
+    report('graph', measure(GraphEngine, build_diamond, size, size, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Query latency and incremental update cost of the search index.
+
+Builds an index over synthetic notes in a temporary directory, then times
+queries and the save-time update of a single note (reindex plus encrypted
+write of the index).
+
+    python3 benchmarks/bench_search.py [--notes 10000] [--words 200]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+QUERIES = ['alpha', 'alpha beta', 'gam', 'delta epsilon zeta', 'nosuchterm']
+
+
+def synthetic_note(rng, vocabulary, words):
+    if rng.random() < 0.2:
+        cells = {f"{row},{col}": rng.choice(vocabulary)
+                 for row in range(10) for col in range(3)}
+        return {'mode': 'calc', 'text_content': '', 'calc_data': {'cells': cells, 'formulas': {}}}
+    text = ' '.join(rng.choice(vocabulary) for _ in range(words))
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=10000)
+    parser.add_argument('--words', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    # storage reads or creates key.key in the working directory on first use
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    from search import SearchIndex
+
+    rng = random.Random(42)
+    base = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta']
+    vocabulary = base + [f"word{i}" for i in range(20000)]
+
+    index = SearchIndex()
+    start = time.perf_counter()
+    for i in range(args.notes):
+        index.update(f"note{i}.enc", synthetic_note(rng, vocabulary, args.words))
+    index.loaded = True
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    index.save()
+    save = time.perf_counter() - start
+    print(f"{args.notes} notes: build {build:.2f} s, encrypted save {save * 1000:.1f} ms, "
+          f"{os.path.getsize(index.path) / 1e6:.1f} MB, {len(index.postings)} terms")
+
+    start = time.perf_counter()
+    fresh = SearchIndex()
+    fresh.load()
+    print(f"load {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for query in QUERIES:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results = fresh.search(query)
+            timings.append(time.perf_counter() - start)
+        print(f"query {query!r:<22} {statistics.median(timings) * 1000:8.3f} ms  {len(results)} hits")
+
+    timings = []
+    for i in range(args.repeat):
+        path = os.path.join(fresh.directory, f"note{i}.enc")
+        note_data = synthetic_note(rng, vocabulary, args.words)
+        start = time.perf_counter()
+        fresh.on_note_changed(path, note_data)
+        timings.append(time.perf_counter() - start)
+    print(f"update one note {statistics.median(timings) * 1000:8.2f} ms (median, including index write)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Memory and formula cost of large, sparsely populated sheets.
+
+Scatters numbers over a 100000 x 702 (A..ZZ) sheet and reports the memory
+the model holds per populated cell, then times a whole-column SUM and a
+reference into the far corner of the sheet.
+
+    python3 benchmarks/bench_sparse.py [--cells 1000 10000 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calc import MAX_COLS, MAX_ROWS, CellModel, format_ref
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    last = format_ref(MAX_ROWS - 1, MAX_COLS - 1)
+    print(f"sheet A1:{last}")
+    for count in args.cells:
+        rng = random.Random(42)
+        tracemalloc.start()
+        model = CellModel(MAX_ROWS, MAX_COLS)
+        for i in range(count):
+            model.set_input((rng.randrange(1, MAX_ROWS), rng.randrange(1, MAX_COLS)), str(i))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        model.set_input((0, 0), f"=SUM(B1:B{MAX_ROWS})")
+        column = timeit.timeit(lambda: model.evaluate((0, 0)), number=args.number) / args.number
+        model.set_input((0, 0), f"={last}*2")
+        corner = timeit.timeit(lambda: model.evaluate((0, 0)), number=args.number) / args.number
+        print(f"{count:>7} cells  {memory / 1e6:8.2f} MB  {memory / count:6.0f} B/cell  "
+              f"column SUM {column * 1e6:8.1f} us  {last} {corner * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
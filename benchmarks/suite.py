@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Benchmark suite emitting JSON, for tracking performance between releases.
+
+Headless measurements run in this process, in a temporary notes directory:
+calc recalculation on chained and fan-out sheets, save/load throughput for
+notes from 1 KB to 100 MB, from disk and from the decrypted-note cache, and
+manifest listing for 10 to 10k notes. GUI measurements run in a fresh
+interpreter so the cold import is real: import and StickyNoteWindow()
+time, time to the first keystroke, per-keystroke cost, recalculation
+through update_dependent_cells, time to the first visible text and to the
+whole note for background opens of each note size, first from disk and
+then again from the decrypted-note cache, and
+NoteManagerDialog.refresh_notes. They need a display and are reported as
+skipped without one.
+
+    python3 benchmarks/suite.py [--output results.json] [--max-bytes 100000000]
+    python3 benchmarks/suite.py --quick  # smaller sizes, for a smoke test
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+NOTE_SIZES = [10 ** exponent for exponent in range(3, 9)]  # 1 KB to 100 MB
+MANAGER_COUNTS = [10, 100, 1000, 10000]
+WORDS = ['the', 'note', 'meeting', 'budget', 'call', 'tomorrow', 'review', 'draft',
+         'project', 'invoice', 'remember', 'shopping', 'list', 'and', 'to', 'a']
+
+
+def timings_ms(function, repeat):
+    """Return the median and max of repeat calls of function, in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': statistics.median(timings), 'max_ms': max(timings), 'runs': repeat}
+
+
+def text_of_size(rng, size):
+    parts = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(12)) + '\n'
+        parts.append(line)
+        length += len(line)
+    return ''.join(parts)[:size]
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def build_sheet(model, shape):
+    """Fill model with a chain (each cell adds one to the previous) or a fan-out from A1"""
+    from calc import format_ref
+
+    cells = [(row, col) for col in range(model.cols) for row in range(model.rows)]
+    model.set_input(cells[0], '1')
+    for previous, cell in zip(cells, cells[1:]):
+        if shape == 'chain':
+            model.set_input(cell, f"={format_ref(*previous)}+1")
+        else:
+            model.set_input(cell, "=A1*2")
+    return len(cells)
+
+
+# Headless
+
+def bench_recalc(repeat):
+    from calc import CellModel
+
+    results = {}
+    for shape in ('chain', 'fanout'):
+        model = CellModel()
+        cells = build_sheet(model, shape)
+        values = iter(range(2, 10 ** 9))
+        results[shape] = dict(timings_ms(lambda: model.set_input((0, 0), str(next(values))), repeat),
+                              cells=cells)
+    return results
+
+
+def bench_storage(rng, max_bytes, repeat):
+    import storage
+
+    results = []
+    for size in NOTE_SIZES:
+        if size > max_bytes:
+            break
+        note_data = text_note(text_of_size(rng, size))
+        runs = max(1, min(repeat, 10 ** 7 // size))
+        save = timings_ms(lambda: storage.save_note_file('bench.enc', note_data, notify=False), runs)
+        # Saving left the note in the decrypted-note cache, if it fits
+        cached = timings_ms(lambda: storage.load_note_file('bench.enc'), runs)
+        load = timings_ms(lambda: (storage.note_cache.clear(), storage.load_note_file('bench.enc')), runs)
+        results.append({
+            'bytes': size,
+            'file_bytes': os.path.getsize('bench.enc'),
+            'save': dict(save, mb_per_s=size / 1e6 / (save['median_ms'] / 1000)),
+            'load': dict(load, mb_per_s=size / 1e6 / (load['median_ms'] / 1000)),
+            'cached_load': cached,
+        })
+    os.remove('bench.enc')
+    return results
+
+
+def create_notes(rng, start, count):
+    """Save notes start..count-1 and record them in the manifest in one write"""
+    import storage
+    from manifest import manifest
+
+    manifest.load()
+    for i in range(start, count):
+        filename = f"note{i:05d}.enc"
+        note_data = text_note(text_of_size(rng, 200))
+        storage.save_note_file(filename, note_data, notify=False)
+        manifest.entries[filename] = manifest.make_entry(filename, note_data, os.stat(filename))
+    manifest.save()
+
+
+def bench_manifest(rng, counts, repeat):
+    from manifest import manifest
+
+    results = []
+    created = 0
+    for count in counts:
+        create_notes(rng, created, count)
+        created = count
+        results.append(dict(timings_ms(manifest.list_entries, repeat), notes=count))
+    return results
+
+
+# GUI, in a fresh interpreter
+
+def run_gui(args):
+    launch = start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    import main
+    from gi.repository import Gtk
+    import_ms = (time.perf_counter() - start) * 1000
+
+    def drain():
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+    start = time.perf_counter()
+    win = main.StickyNoteWindow()
+    window_ms = (time.perf_counter() - start) * 1000
+    win.show_all()
+    drain()
+    buffer = win.text_view.get_buffer()
+    buffer.insert_at_cursor('x')
+    drain()
+    first_keystroke_ms = (time.perf_counter() - launch) * 1000
+
+    results = {'startup': {
+        'import_ms': import_ms,
+        'window_ms': window_ms,
+        'first_keystroke_ms': first_keystroke_ms,
+        # Lazy startup: a text note should not have loaded crypto or numpy, or built the grid
+        'crypto_loaded': 'cryptography' in sys.modules,
+        'numpy_loaded': 'numpy' in sys.modules,
+        'grid_built': win.grid is not None,
+    }}
+
+    keystroke = timings_ms(lambda: buffer.insert_at_cursor('x'), args.repeat * 20)
+    handler = timings_ms(lambda: win.on_text_changed(buffer), args.repeat * 20)
+    win.cancel_autosave()
+    results['keystroke'] = {'insert': keystroke, 'on_text_changed': handler}
+
+    results['recalc'] = {}
+    win.ensure_grid()
+    for shape in ('chain', 'fanout'):
+        win.model.clear()
+        cells = build_sheet(win.model, shape)
+        values = iter(range(2, 10 ** 9))
+
+        def edit():
+            win.model._set_input((0, 0), str(next(values)))
+            win.update_dependent_cells(0, 0)
+
+        results['recalc'][shape] = dict(timings_ms(edit, args.repeat), cells=cells)
+
+    import storage
+    rng = random.Random(42)
+    results['open'] = []
+    for size in NOTE_SIZES:
+        if size > args.max_bytes:
+            break
+        storage.save_note_file('open.enc', text_note(text_of_size(rng, size)), notify=False)
+        storage.note_cache.clear()
+        timings = {'bytes': size}
+        # The first open decrypts the file and caches it if it fits; the second reopens it
+        for name in ('', 'reopen_'):
+            win.start_new_note()
+            start = time.perf_counter()
+            first_text = None
+            win.open_note('open.enc')
+            while win.loader is not None:
+                Gtk.main_iteration()
+                if first_text is None and buffer.get_char_count():
+                    first_text = time.perf_counter() - start
+            timings[f'{name}first_text_ms'] = (first_text or 0) * 1000
+            timings[f'{name}total_ms'] = (time.perf_counter() - start) * 1000
+        results['open'].append(timings)
+    os.remove('open.enc')
+
+    results['note_manager'] = []
+    created = 0
+    for count in args.counts:
+        create_notes(rng, created, count)
+        created = count
+        dialog = main.NoteManagerDialog(win)
+        results['note_manager'].append(dict(timings_ms(dialog.refresh_notes, max(1, args.repeat // 5)),
+                                            notes=count))
+        dialog.destroy()
+        drain()
+    win.cancel_autosave()
+    results['note_cache'] = storage.note_cache.stats()
+    print(json.dumps(results))
+
+
+def gui_results(args):
+    """Run the GUI benchmarks in a subprocess; report why if they cannot run"""
+    if not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        return {'skipped': 'no display'}
+    command = [sys.executable, __file__, '--gui', '--repeat', str(args.repeat),
+               '--max-bytes', str(args.max_bytes), '--counts', *map(str, args.counts)]
+    process = subprocess.run(command, capture_output=True, text=True, cwd=tempfile.mkdtemp())
+    if process.returncode != 0:
+        return {'skipped': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    parser.add_argument('--repeat', type=int, default=25)
+    parser.add_argument('--max-bytes', type=int, default=NOTE_SIZES[-1])
+    parser.add_argument('--counts', type=int, nargs='+', default=MANAGER_COUNTS)
+    parser.add_argument('--quick', action='store_true', help="small sizes and few runs")
+    parser.add_argument('--gui', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat = 5
+        args.max_bytes = 10 ** 6
+        args.counts = [10, 100]
+
+    if args.gui:
+        run_gui(args)
+        return
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'gui': gui_results(args),
+    }
+
+    # storage reads or creates key.key in the working directory on first use
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    rng = random.Random(42)
+    results['recalc'] = bench_recalc(args.repeat)
+    results['storage'] = bench_storage(rng, args.max_bytes, args.repeat)
+    results['manifest'] = bench_manifest(rng, args.counts, args.repeat)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
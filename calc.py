@@ -0,0 +1,848 @@
+"""Headless calculation engine for calc mode"""
+
+import ast
+import contextlib
+import functools
+import logging
+import math
+import re
+from array import array
+from collections import deque
+from itertools import repeat
+
+import perf
+import sandbox
+
+# numpy takes about 100 ms to import, so it is only loaded by the first range
+# aggregate; sheets without ranges and text notes never pay for it
+numpy = None
+_numpy_checked = False
+
+CELL_REF = re.compile(r'^([A-Z]{1,2})([1-9][0-9]*)$')
+# A1:B50 is not Python syntax, so ranges are renamed A1__B50 before parsing
+RANGE_REF = re.compile(r'\b([A-Z]+[0-9]+):([A-Z]+[0-9]+)\b')
+RANGE_SEPARATOR = '__'
+# Cell references anywhere in formula text, for moving formulas between cells
+FORMULA_REF = re.compile(r'\b([A-Z]{1,2})([1-9][0-9]*)\b')
+
+# Operators a formula may use; anything else is rejected at compile time
+BINARY_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+UNARY_OPERATORS = (ast.UAdd, ast.USub)
+
+NAN = float('nan')
+
+CYCLE = '#CYCLE'  # Shown by every formula on a circular chain of references
+TIMEOUT = '#TIMEOUT'  # Shown by formulas that overran the sandbox limits
+PENDING = '…'  # Shown while a sandboxed result, or one it depends on, is on its way
+
+DEFAULT_ROWS = 50  # Size of new sheets, and of notes saved before sizes were recorded
+DEFAULT_COLS = 20
+# A..ZZ; rows are capped so the grid stays inside the coordinates GTK can draw
+MAX_ROWS = 100000
+MAX_COLS = 702
+MAX_POWER_BITS = 1 << 10  # Largest int power of two literals evaluated in-process; a float holds no more
+BLOCK_ROWS = 32  # Rows per block of the typed number storage; small, as sparse cells each take one
+
+
+class FormulaError(Exception):
+    """Raised when a formula cannot be compiled or evaluated"""
+
+
+class PendingError(FormulaError):
+    """Raised when a formula reads a cell still waiting for its sandboxed result"""
+
+
+def column_name(col):
+    """Convert a column index to its letters (e.g., 0 -> A, 26 -> AA)"""
+    name = ''
+    col += 1
+    while col:
+        col, letter = divmod(col - 1, 26)
+        name = chr(65 + letter) + name
+    return name
+
+
+def column_index(name):
+    """Convert column letters to their index (e.g., A -> 0, AA -> 26)"""
+    col = 0
+    for letter in name:
+        col = col * 26 + ord(letter) - 64
+    return col - 1
+
+
+def format_ref(row, col):
+    """Convert row, col to a cell reference (e.g., 0,0 -> A1)"""
+    return f"{column_name(col)}{row + 1}"
+
+
+def parse_ref(ref, rows=MAX_ROWS, cols=MAX_COLS):
+    """Convert a cell reference to (row, col), or None outside a rows x cols sheet (e.g., A1 -> 0,0)"""
+    match = CELL_REF.match(ref)
+    if not match:
+        return None
+    row = int(match.group(2)) - 1
+    col = column_index(match.group(1))
+    if 0 <= row < rows and 0 <= col < cols:
+        return (row, col)
+    return None
+
+
+def parse_range(name):
+    """Convert a renamed range (e.g., A1__B50) to (top, left, bottom, right), or None"""
+    first, _, last = name.partition(RANGE_SEPARATOR)
+    start, end = parse_ref(first), parse_ref(last)
+    if start is None or end is None:
+        return None
+    return (min(start[0], end[0]), min(start[1], end[1]), max(start[0], end[0]), max(start[1], end[1]))
+
+
+def shift_formula(formula, rows, cols):
+    """Move the references of formula by rows and cols, as when it is filled into another cell"""
+    def shift(match):
+        row, col = int(match[2]) - 1 + rows, column_index(match[1]) + cols
+        if row < 0 or col < 0:
+            return '#REF'  # Moved off the sheet; the formula no longer compiles
+        return format_ref(row, col)
+    return FORMULA_REF.sub(shift, formula)
+
+
+def parse_value(text):
+    """Convert cell text to the value formulas see: int, float or str"""
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        value = float(text)
+    except ValueError:
+        return text
+    # nan and inf are not numbers a sheet can store; keep them as text
+    return value if math.isfinite(value) else text
+
+
+def format_result(value):
+    """Convert an evaluated value back to cell text"""
+    # Numbers are stored as floats, so show whole results without a trailing .0
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e16:
+        return str(int(value))
+    return str(value)
+
+
+class CellRange:
+    """The numbers of a block of cells as contiguous slices of its columns, NaN where empty"""
+
+    __slots__ = ('slices',)
+
+    def __init__(self, slices):
+        self.slices = slices
+
+
+def _numpy():
+    """Return numpy, importing it on first use, or None if it is not installed"""
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy as module
+        except ImportError:  # Ranges are aggregated in pure Python instead
+            module = None
+        numpy = module
+    return numpy
+
+
+def _aggregate_values(args):
+    """Return the numbers of aggregate arguments, empty and text cells left out"""
+    _numpy()
+    parts = []
+    for arg in args:
+        if isinstance(arg, CellRange):
+            parts.extend(arg.slices)
+        else:
+            parts.append([float(arg)])
+    if not parts:
+        return [] if numpy is None else numpy.empty(0)
+    if numpy is None:
+        return [value for part in parts for value in part if value == value]
+    values = numpy.asarray(parts[0], dtype=numpy.float64) if len(parts) == 1 else numpy.concatenate(parts)
+    return values[~numpy.isnan(values)]
+
+
+def _sum(*args):
+    values = _aggregate_values(args)
+    return float(sum(values) if numpy is None else values.sum())
+
+
+def _count(*args):
+    return len(_aggregate_values(args))
+
+
+def _average(*args):
+    values = _aggregate_values(args)
+    if not len(values):
+        raise FormulaError("AVERAGE of no numbers")
+    return float(sum(values) / len(values) if numpy is None else values.mean())
+
+
+def _min(*args):
+    values = _aggregate_values(args)
+    if not len(values):
+        return 0
+    return float(min(values) if numpy is None else values.min())
+
+
+def _max(*args):
+    values = _aggregate_values(args)
+    if not len(values):
+        return 0
+    return float(max(values) if numpy is None else values.max())
+
+
+# Functions a formula may call, on ranges and single values alike
+FUNCTIONS = {'SUM': _sum, 'AVERAGE': _average, 'MIN': _min, 'MAX': _max, 'COUNT': _count}
+
+
+class CompiledFormula:
+    """A formula parsed once into a Python function over its referenced cells.
+
+    refs lists the distinct (row, col) slots the formula reads and ranges
+    the distinct (top, left, bottom, right) blocks, in the order their
+    values are passed to the compiled function. sandboxed marks formulas
+    whose evaluation time has no bound, to be run in the sandbox pool.
+    """
+
+    __slots__ = ('text', 'refs', 'ranges', 'error', 'sandboxed', '_function')
+
+    def __init__(self, text, refs, function, error=None, ranges=(), sandboxed=False):
+        self.text = text
+        self.refs = refs
+        self.ranges = ranges
+        self.error = error
+        self.sandboxed = sandboxed
+        self._function = function
+
+    def evaluate(self, value_of, range_of=None):
+        """Evaluate against value_of(cell), a cell's number, and range_of(bounds), a CellRange"""
+        if self.error is not None:
+            raise FormulaError(self.error)
+        return self._function(*[value_of(ref) for ref in self.refs],
+                              *[range_of(bounds) for bounds in self.ranges])
+
+    def arguments(self, value_of, range_of):
+        """Return the values evaluate() would pass, to evaluate them elsewhere with call()"""
+        return [value_of(ref) for ref in self.refs] + [range_of(bounds) for bounds in self.ranges]
+
+    def call(self, args):
+        """Evaluate against argument values from arguments()"""
+        if self.error is not None:
+            raise FormulaError(self.error)
+        return self._function(*args)
+
+    def fits(self, rows, cols):
+        """Return whether every reference lies inside a rows x cols sheet"""
+        return (all(row < rows and col < cols for row, col in self.refs)
+                and all(bottom < rows and right < cols for _, _, bottom, right in self.ranges))
+
+
+class _RefRewriter(ast.NodeTransformer):
+    """Validate a formula AST and turn cell and range references into argument names"""
+
+    def __init__(self):
+        self.refs = []
+        self.ranges = []
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name,
+                                 ast.Load) + BINARY_OPERATORS + UNARY_OPERATORS):
+            raise FormulaError(f"Unsupported syntax: {type(node).__name__}")
+        return super().generic_visit(node)
+
+    def visit_Call(self, node):
+        name = node.func.id.upper() if isinstance(node.func, ast.Name) else None
+        if name not in FUNCTIONS or node.keywords:
+            raise FormulaError(f"Unknown function: {ast.unparse(node.func)}")
+        if not node.args:
+            raise FormulaError(f"{name} needs at least one argument")
+        args = []
+        for arg in node.args:
+            if isinstance(arg, ast.Name) and RANGE_SEPARATOR in arg.id:
+                args.append(self.visit_range(arg))
+            else:
+                args.append(self.visit(arg))
+        return ast.copy_location(ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[]),
+                                 node)
+
+    def visit_range(self, node):
+        bounds = parse_range(node.id)
+        if bounds is None:
+            raise FormulaError(f"Invalid range: {node.id.replace(RANGE_SEPARATOR, ':')}")
+        if bounds not in self.ranges:
+            self.ranges.append(bounds)
+        return ast.copy_location(ast.Name(id=f"_r{self.ranges.index(bounds)}", ctx=ast.Load()), node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError(f"Unsupported constant: {node.value!r}")
+        return node
+
+    def visit_Name(self, node):
+        if RANGE_SEPARATOR in node.id:
+            raise FormulaError("Ranges can only be passed to functions")
+        cell = parse_ref(node.id)
+        if cell is None:
+            raise FormulaError(f"Invalid cell reference: {node.id}")
+        if cell not in self.refs:
+            self.refs.append(cell)
+        return ast.copy_location(ast.Name(id=f"_{self.refs.index(cell)}", ctx=ast.Load()), node)
+
+
+def _is_integer(node):
+    """Return whether a rewritten formula node always evaluates to an int"""
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, int)
+    if isinstance(node, ast.UnaryOp):
+        return _is_integer(node.operand)
+    if isinstance(node, ast.BinOp):
+        return not isinstance(node.op, ast.Div) and _is_integer(node.left) and _is_integer(node.right)
+    if isinstance(node, ast.Call):
+        return node.func.id == 'COUNT'
+    return False  # Cells and ranges hold floats
+
+
+def _is_unbounded(tree):
+    """Return whether a formula raises an int to an int power.
+
+    Cell values are floats, and float arithmetic overflows at once, so
+    exact integer powers such as 9**9**9 are the only way a formula can
+    run (and allocate) without bound. A power of two literals is bounded
+    when its result is known to be small, so =2**10 stays in-process.
+    """
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow)
+                and _is_integer(node.left) and _is_integer(node.right)):
+            continue
+        left, right = node.left, node.right
+        if not (isinstance(left, ast.Constant) and isinstance(right, ast.Constant)
+                and abs(right.value) * left.value.bit_length() <= MAX_POWER_BITS):
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_formula(formula):
+    """Parse formula text (with or without the leading '=') into a CompiledFormula.
+
+    Results are cached by formula text, so a formula is only parsed again
+    when its text changes. Syntax errors are cached too and raised on
+    evaluation.
+    """
+    expression = formula[1:] if formula.startswith('=') else formula
+    expression = RANGE_REF.sub(lambda match: f"{match[1]}{RANGE_SEPARATOR}{match[2]}", expression)
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+        rewriter = _RefRewriter()
+        body = rewriter.visit(tree).body
+        names = [f"_{i}" for i in range(len(rewriter.refs))] + [f"_r{i}" for i in range(len(rewriter.ranges))]
+        arguments = ast.arguments(
+            posonlyargs=[], args=[ast.arg(arg=name) for name in names],
+            vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+        lambda_tree = ast.fix_missing_locations(ast.Expression(ast.Lambda(args=arguments, body=body)))
+        function = eval(compile(lambda_tree, '<formula>', 'eval'), dict(FUNCTIONS, __builtins__={}))
+    except (SyntaxError, ValueError, FormulaError) as e:
+        return CompiledFormula(formula, (), None, error=str(e))
+    return CompiledFormula(formula, tuple(rewriter.refs), function, ranges=tuple(rewriter.ranges),
+                           sandboxed=_is_unbounded(body))
+
+
+class DependencyGraph:
+    """Precedent/dependent graph between calc cells.
+
+    Each formula cell keeps the set of cells it reads (its precedents) and
+    every referenced cell keeps the reverse set (its dependents), so edits
+    never have to scan the whole sheet to find what needs recomputing.
+    A range is a single edge from the block to each formula reading it,
+    found through an index of the ranges over each column.
+    """
+
+    def __init__(self):
+        self.precedents = {}  # cell -> set of cells its formula reads
+        self.dependents = {}  # cell -> set of cells whose formulas read it
+        self.precedent_ranges = {}  # cell -> set of (top, left, bottom, right) its formula reads
+        self.range_dependents = {}  # (top, left, bottom, right) -> set of cells reading it
+        self.column_ranges = {}  # col -> set of ranges covering that column
+
+    def set_precedents(self, cell, precedents, ranges=()):
+        """Replace the precedents of cell, keeping the reverse edges in sync"""
+        self.clear(cell)
+        precedents = set(precedents)
+        if precedents:
+            self.precedents[cell] = precedents
+            for precedent in precedents:
+                self.dependents.setdefault(precedent, set()).add(cell)
+        ranges = set(ranges)
+        if ranges:
+            self.precedent_ranges[cell] = ranges
+            for bounds in ranges:
+                readers = self.range_dependents.setdefault(bounds, set())
+                if not readers:
+                    for col in range(bounds[1], bounds[3] + 1):
+                        self.column_ranges.setdefault(col, set()).add(bounds)
+                readers.add(cell)
+
+    def clear(self, cell):
+        """Drop every edge from cell to its precedents"""
+        for precedent in self.precedents.pop(cell, ()):
+            dependents = self.dependents.get(precedent)
+            if dependents is not None:
+                dependents.discard(cell)
+                if not dependents:
+                    del self.dependents[precedent]
+        for bounds in self.precedent_ranges.pop(cell, ()):
+            readers = self.range_dependents.get(bounds)
+            if readers is None:
+                continue
+            readers.discard(cell)
+            if not readers:
+                del self.range_dependents[bounds]
+                for col in range(bounds[1], bounds[3] + 1):
+                    self.column_ranges[col].discard(bounds)
+                    if not self.column_ranges[col]:
+                        del self.column_ranges[col]
+
+    def dependents_of(self, cell):
+        """Yield the cells reading cell, once per edge, directly or through a range"""
+        yield from self.dependents.get(cell, ())
+        row, col = cell
+        for bounds in self.column_ranges.get(col, ()):
+            if bounds[0] <= row <= bounds[2]:
+                yield from self.range_dependents[bounds]
+
+    def dirty_cells(self, changed):
+        """Return the set of cells downstream of the changed cells.
+
+        The changed cells themselves are only included when they are reached
+        again through a cycle.
+        """
+        dirty = set()
+        queue = deque(changed)
+        while queue:
+            cell = queue.popleft()
+            for dependent in self.dependents_of(cell):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    queue.append(dependent)
+        return dirty
+
+    def recalc_order(self, changed):
+        """Return the dirty cells of an edit in topological order.
+
+        Every cell appears exactly once, after all of its dirty precedents.
+        Cells caught in a cycle can never be ordered; they are appended at
+        the end so they are still evaluated once instead of recursing.
+        """
+        return self.topological_order(self.dirty_cells(changed))
+
+    def cyclic_cells(self, cells):
+        """Return the cells that lie on a cycle among cells.
+
+        An iterative Tarjan pass over the strongly connected components of
+        the subgraph cells span: a component of two or more cells, or a
+        cell reading itself, is a cycle. Only edges between cells are
+        followed, so the cost is linear in that subgraph however large the
+        sheet, and no chain is deep enough to exhaust the interpreter stack.
+        """
+        cells = set(cells)
+        index = {}  # cell -> order of discovery
+        lowlink = {}  # cell -> lowest index reachable from it on the stack
+        stack = []
+        on_stack = set()
+        cyclic = set()
+        for root in cells:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, self.dependents_of(root))]
+            while work:
+                cell, edges = work[-1]
+                for dependent in edges:
+                    if dependent not in cells:
+                        continue
+                    if dependent not in index:
+                        # Descend; this cell's remaining edges resume afterwards
+                        index[dependent] = lowlink[dependent] = len(index)
+                        stack.append(dependent)
+                        on_stack.add(dependent)
+                        work.append((dependent, self.dependents_of(dependent)))
+                        break
+                    if dependent in on_stack:
+                        lowlink[cell] = min(lowlink[cell], index[dependent])
+                        if dependent == cell:
+                            cyclic.add(cell)
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[cell])
+                    if lowlink[cell] == index[cell]:
+                        # cell is the root of a component; pop its members
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == cell:
+                                break
+                        if len(component) > 1:
+                            cyclic.update(component)
+        return cyclic
+
+    def topological_order(self, cells):
+        """Order cells so each comes after those of its precedents in cells"""
+        cells = set(cells)
+        indegree = dict.fromkeys(cells, 0)
+        for cell in cells:
+            for dependent in self.dependents_of(cell):
+                if dependent in indegree:
+                    indegree[dependent] += 1
+        queue = deque(sorted(cell for cell, count in indegree.items() if count == 0))
+        order = []
+        while queue:
+            cell = queue.popleft()
+            order.append(cell)
+            for dependent in self.dependents_of(cell):
+                if dependent in indegree:
+                    indegree[dependent] -= 1
+                    if indegree[dependent] == 0:
+                        queue.append(dependent)
+        if len(order) < len(cells):
+            order.extend(sorted(cell for cell, count in indegree.items() if count > 0))
+        return order
+
+
+class CellModel:
+    """Sparse, widget-independent state of a calc sheet.
+
+    Only populated cells are stored: the raw input as typed, the compiled
+    form of formulas and the cached result text of each formula. Numeric
+    values live in typed array('d') blocks of BLOCK_ROWS rows (NaN where a
+    cell holds no number), allocated only for the parts of a column that
+    hold numbers, so formulas read numbers without touching widgets or
+    re-parsing text and memory follows the populated cells rather than the
+    size of the sheet. The grid only renders what this model reports.
+    """
+
+    def __init__(self, rows=DEFAULT_ROWS, cols=DEFAULT_COLS):
+        self.rows = rows
+        self.cols = cols
+        self.graph = DependencyGraph()
+        self._inputs = {}    # cell -> raw text as typed, formula or literal
+        self._formulas = {}  # cell -> CompiledFormula
+        self._results = {}   # cell -> cached display text of formula cells
+        self._text = {}      # cell -> value of cells holding non-numeric text
+        self._numbers = {}   # col -> {block index -> array('d') of BLOCK_ROWS numbers}
+        self._batched = None  # Cells changed inside batch(), recalculated when it ends
+        self._pending = {}   # cell -> future of its sandboxed evaluation
+        # Sandboxed formulas block until their result unless dispatch is set. dispatch(function, *args)
+        # must call function soon on the thread owning the model (GLib.idle_add does); on_update
+        # is then called with the cells whose display changed when each result arrives.
+        self.dispatch = None
+        self.on_update = None
+
+    def clear(self):
+        """Remove every cell"""
+        self.graph = DependencyGraph()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._inputs.clear()
+        self._formulas.clear()
+        self._results.clear()
+        self._text.clear()
+        self._numbers.clear()
+
+    def contains(self, cell):
+        """Return whether cell lies inside the sheet"""
+        row, col = cell
+        return 0 <= row < self.rows and 0 <= col < self.cols
+
+    def parse_ref(self, ref):
+        """Convert a cell reference to a cell of this sheet, or None"""
+        return parse_ref(ref, self.rows, self.cols)
+
+    def resize(self, rows, cols):
+        """Change the sheet dimensions, dropping cells that no longer fit"""
+        rows = max(1, min(rows, MAX_ROWS))
+        cols = max(1, min(cols, MAX_COLS))
+        if (rows, cols) == (self.rows, self.cols):
+            return
+        self.rows, self.cols = rows, cols
+        for cell in [cell for cell in self._inputs if not self.contains(cell)]:
+            self._set_input(cell, '')
+        # Formulas reading cells beyond the old edges may compute now, or no longer
+        for cell, compiled in list(self._formulas.items()):
+            self._set_input(cell, compiled.text)
+        self.recalculate_all()
+
+    def input(self, cell):
+        """Return the raw text entered in cell"""
+        return self._inputs.get(cell, '')
+
+    def formula(self, cell):
+        """Return the formula text of cell, or None"""
+        if cell in self._formulas:
+            return self._inputs[cell]
+        return None
+
+    def display(self, cell):
+        """Return the text the grid shows for cell"""
+        if cell in self._results:
+            return self._results[cell]
+        return self._inputs.get(cell, '')
+
+    def populated(self):
+        """Return the cells that hold any input"""
+        return self._inputs.keys()
+
+    def has_content(self):
+        """Return whether any cell holds non-blank input"""
+        return any(text.strip() for text in self._inputs.values())
+
+    def value(self, cell):
+        """Return the number a formula sees for cell; empty cells count as 0"""
+        row, col = cell
+        column = self._numbers.get(col)
+        if column is not None:
+            block = column.get(row // BLOCK_ROWS)
+            if block is not None:
+                number = block[row % BLOCK_ROWS]
+                if number == number:  # NaN marks cells without a number
+                    return number
+        text = self._text.get(cell)
+        if text is PENDING:  # The marker itself, not the same character typed into a cell
+            raise PendingError(f"{format_ref(row, col)} is not computed yet")
+        if text is not None:
+            raise FormulaError(f"{format_ref(row, col)} is not a number")
+        return 0
+
+    def set_input(self, cell, text):
+        """Store the raw text of cell and recalculate what depends on it.
+
+        Returns the cells whose displayed text may have changed.
+        """
+        if self._inputs.get(cell, '') == text:
+            return [cell]
+        self._set_input(cell, text)
+        if self._batched is not None:
+            self._batched.add(cell)
+            return [cell]
+        updated = self.recalculate([cell])
+        return updated if cell in self._formulas else [cell] + updated
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer recalculation of set_input calls until the block ends.
+
+        Yields a list that is filled, when the block ends, with the cells
+        whose displayed text may have changed. The union of their dirty
+        cells is recalculated once, in dependency order, instead of once
+        per edit. Nested batches join the outermost one.
+        """
+        updated = []
+        if self._batched is not None:
+            yield updated
+            return
+        self._batched = changed = set()
+        try:
+            yield updated
+        finally:
+            self._batched = None
+            if changed:
+                recalculated = self.recalculate(changed)
+                updated.extend(changed)
+                updated.extend(cell for cell in recalculated if cell not in changed)
+
+    def _set_input(self, cell, text):
+        """Store the raw text of cell without evaluating anything"""
+        future = self._pending.pop(cell, None)
+        if future is not None:
+            future.cancel()  # Its result would be for the old input
+        if text:
+            self._inputs[cell] = text
+        else:
+            self._inputs.pop(cell, None)
+        if text.startswith('='):
+            compiled = compile_formula(text)
+            if not compiled.fits(self.rows, self.cols):
+                # Compiled formulas are shared between sheets; the size check is per sheet
+                compiled = CompiledFormula(text, (), None, error="Reference outside the sheet")
+            self._formulas[cell] = compiled
+            self.graph.set_precedents(cell, compiled.refs, compiled.ranges)
+            return
+        self._formulas.pop(cell, None)
+        self._results.pop(cell, None)
+        self.graph.clear(cell)
+        value = parse_value(text) if text.strip() else None
+        if isinstance(value, str):
+            self._store(cell, None, value)
+        else:
+            self._store(cell, value, None)
+
+    def _store(self, cell, number, text):
+        """Record the evaluated value of cell in the typed storage"""
+        row, col = cell
+        if text is None:
+            self._text.pop(cell, None)
+        else:
+            self._text[cell] = text
+        index, offset = divmod(row, BLOCK_ROWS)
+        column = self._numbers.get(col)
+        block = column.get(index) if column is not None else None
+        if number is None:
+            if block is not None:
+                block[offset] = NAN
+                if all(value != value for value in block):
+                    del column[index]
+                    if not column:
+                        del self._numbers[col]
+            return
+        if block is None:
+            # Blocks never grow, so range views of them stay valid
+            block = self._numbers.setdefault(col, {})[index] = array('d', repeat(NAN, BLOCK_ROWS))
+        block[offset] = number
+
+    def range_of(self, bounds):
+        """Return the numbers of a (top, left, bottom, right) block as a CellRange"""
+        top, left, bottom, right = bounds
+        first, last = top // BLOCK_ROWS, bottom // BLOCK_ROWS
+        use_numpy = _numpy() is not None
+        slices = []
+        for col in range(left, right + 1):
+            column = self._numbers.get(col)
+            if column is None:
+                continue
+            if last - first < len(column):
+                blocks = [(index, column[index]) for index in range(first, last + 1) if index in column]
+            else:  # Fewer populated blocks than the range spans
+                blocks = [(index, block) for index, block in column.items() if first <= index <= last]
+            for index, block in blocks:
+                start = max(top - index * BLOCK_ROWS, 0)
+                stop = min(bottom - index * BLOCK_ROWS, BLOCK_ROWS - 1) + 1
+                if use_numpy:
+                    slices.append(numpy.frombuffer(block, dtype=numpy.float64)[start:stop])
+                else:
+                    slices.append(block[start:stop])
+        return CellRange(slices)
+
+    @perf.timed('evaluate_formula')
+    def evaluate_formula(self, compiled, cell):
+        """Evaluate a compiled formula for cell, returning (number, text)"""
+        try:
+            if compiled.sandboxed:
+                return self.evaluate_sandboxed(compiled, cell)
+            value = compiled.evaluate(self.value, self.range_of)
+            return float(value), format_result(value)
+        except PendingError:
+            return None, PENDING
+        except Exception as e:
+            logging.debug("Formula evaluation error: %s", e)
+            return None, "#ERROR"
+
+    def evaluate_sandboxed(self, compiled, cell):
+        """Evaluate a formula in the sandbox pool, returning (number, text) or PENDING"""
+        previous = self._pending.pop(cell, None)
+        if previous is not None:
+            previous.cancel()
+        future = sandbox.pool.submit(compiled.text, compiled.arguments(self.value, self.range_of))
+        if self.dispatch is None:
+            return self._sandbox_result(future.result())
+        self._pending[cell] = future
+        future.add_done_callback(lambda future: self.dispatch(self._sandbox_done, cell, future))
+        return None, PENDING
+
+    def _sandbox_result(self, outcome):
+        status, value = outcome
+        if status == sandbox.OK:
+            return value, format_result(value)
+        if status == sandbox.TIMEOUT:
+            return None, TIMEOUT
+        logging.debug("Formula evaluation error: %s", value)
+        return None, "#ERROR"
+
+    def _sandbox_done(self, cell, future):
+        """Store a sandboxed result and recalculate what depends on it"""
+        if self._pending.get(cell) is not future or future.cancelled():
+            return  # Superseded by a newer evaluation or edit
+        del self._pending[cell]
+        number, result = self._sandbox_result(future.result())
+        self._results[cell] = result
+        self._store(cell, number, None if number is not None else result)
+        # Only what reads the result; evaluating cell again would submit it again
+        dirty = self.graph.dirty_cells([cell])
+        dirty.discard(cell)
+        updated = [cell] + self._evaluate_cells(dirty)
+        if self.on_update is not None:
+            self.on_update(updated)
+
+    def evaluate(self, cell):
+        """Evaluate the formula in cell and cache its result"""
+        number, result = self.evaluate_formula(self._formulas[cell], cell)
+        self._results[cell] = result
+        self._store(cell, number, None if number is not None else result)
+        return result
+
+    def recalculate(self, changed):
+        """Re-evaluate the formulas among changed and downstream of them, each exactly once.
+
+        Returns the cells re-evaluated or marked as part of a cycle.
+        """
+        affected = self.graph.dirty_cells(changed)
+        affected.update(cell for cell in changed if cell in self._formulas)
+        return self._evaluate_cells(affected)
+
+    def recalculate_all(self):
+        """Re-evaluate every formula in dependency order"""
+        self._evaluate_cells(self._formulas)
+
+    def _evaluate_cells(self, cells):
+        """Mark the cycles among cells, then evaluate the rest in dependency order"""
+        cyclic = self.graph.cyclic_cells(cells)
+        for cell in cyclic:
+            if cell in self._formulas:
+                self._results[cell] = CYCLE
+                self._store(cell, None, CYCLE)
+        # Without its cycles the subgraph is acyclic; cells reading a cycle see text and show #ERROR
+        order = self.graph.topological_order(cell for cell in cells if cell not in cyclic)
+        for cell in order:
+            if cell in self._formulas:
+                self.evaluate(cell)
+        return list(cyclic) + order
+
+    def to_dict(self):
+        """Serialize to the calc_data layout stored in notes"""
+        cells = {}
+        formulas = {}
+        for (row, col), text in self._inputs.items():
+            display = self.display((row, col))
+            if display:  # Only save non-empty cells
+                cells[f"{row},{col}"] = display
+            if (row, col) in self._formulas:
+                formulas[f"{row},{col}"] = text
+        return {'rows': self.rows, 'cols': self.cols, 'cells': cells, 'formulas': formulas}
+
+    def load(self, calc_data):
+        """Replace the sheet with calc_data as produced by to_dict"""
+        self.clear()
+        # Notes saved before sheets had a size are 50x20
+        self.rows = max(1, min(int(calc_data.get('rows', DEFAULT_ROWS)), MAX_ROWS))
+        self.cols = max(1, min(int(calc_data.get('cols', DEFAULT_COLS)), MAX_COLS))
+        for key, value in calc_data.get('cells', {}).items():
+            cell = tuple(map(int, key.split(',')))
+            if self.contains(cell) and not value.startswith('='):
+                self._set_input(cell, value)
+        for key, formula in calc_data.get('formulas', {}).items():
+            cell = tuple(map(int, key.split(',')))
+            if self.contains(cell):
+                self._set_input(cell, formula)
+        self.recalculate_all()
@@ -0,0 +1,357 @@
+"""Headless access to the notes directory, for scripts and servers without a display.
+
+Run from the notes directory:
+
+    python3 cli.py list [--json]
+    python3 cli.py export OUTPUT_DIR [NOTE ...] [--format json|text]
+    python3 cli.py import SOURCE_DIR [--overwrite]
+    python3 cli.py verify
+    python3 cli.py rotate [--threads] [--passphrase]
+
+Bulk commands fan out over a pool of worker processes (--workers N). Notes
+are exported and text files imported a bounded piece at a time, so memory
+grows with neither the size of the directory nor that of its files. CSV
+files become whole sheets in memory and are limited to CSV_MAX_BYTES.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import perf
+from calc import DEFAULT_COLS, DEFAULT_ROWS, MAX_COLS, MAX_ROWS, CellModel
+from manifest import MANIFEST_FILE, PREVIEW_LENGTH, manifest
+from rotate import rotate_directory
+from search import INDEX_FILE, MAX_TERM_LENGTH, index, note_terms, unique_terms
+from storage import (NOTE_SUFFIX, SCRATCH_NOTE, TEXT_SLICE_CHARS, UNLOCK_TARGET_SECONDS, KeyLockedError,
+                     NoteReader, atomic_writer, cipher_suite, is_note_file, is_scratch_file, journal_path,
+                     journal_size, key_cache, save_note_file, unpack_frames)
+
+TEXT_EXTENSIONS = ('.txt', '.md', '.text')
+CSV_EXTENSIONS = ('.csv',)
+CSV_MAX_BYTES = 64 << 20  # CSV files are read into a sheet whole
+WORD_CHARS = re.compile(r'\w*')
+WORKER_CHUNKSIZE = 16  # Files handed to a worker process at a time
+
+
+def init_worker(key):
+    key_cache.install(key)
+
+
+def run_pool(function, jobs, workers):
+    """Yield function(job) for every job, computed by a pool of worker processes"""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                initargs=(key_cache.key(),)) as executor:
+        yield from executor.map(function, jobs, chunksize=WORKER_CHUNKSIZE)
+
+
+def note_paths(names=None):
+    """Return the note files named by names, or every named note"""
+    if not names:
+        return sorted(filename for filename in os.listdir('.') if is_note_file(filename))
+    paths = []
+    for name in names:
+        path = name if name.endswith(NOTE_SUFFIX) else name + NOTE_SUFFIX
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No note named {name}")
+        paths.append(path)
+    return paths
+
+
+def note_name(path):
+    filename = os.path.basename(path)
+    if filename == SCRATCH_NOTE:
+        return 'scratch'
+    if is_scratch_file(filename):
+        return 'scratch' + filename[len('.note'):-len(NOTE_SUFFIX)]  # scratch-2 and up
+    return filename[:-len(NOTE_SUFFIX)]
+
+
+# list
+
+def list_notes(args):
+    manifest.reconcile()
+    for entry in manifest.list_entries():
+        if args.json:
+            print(json.dumps(entry))
+        else:
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['mtime'] / 1e9))
+            print(f"{entry['name']:<30} {entry['mode']:<5} {entry['size']:>10} {modified}  {entry['preview']}")
+    return 0
+
+
+# export
+
+def write_csv(out, calc_data):
+    """Write the displayed values of a sheet as CSV"""
+    cells = {}
+    for key, value in calc_data.get('cells', {}).items():
+        row, col = map(int, key.split(','))
+        cells[row, col] = value
+    rows = max((row for row, _ in cells), default=-1) + 1
+    cols = max((col for _, col in cells), default=-1) + 1
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    for row in range(rows):
+        writer.writerow([cells.get((row, col), '') for col in range(cols)])
+    text.flush()
+    text.detach()  # Leave the file to atomic_writer
+
+
+def export_note(job):
+    """Decrypt one note into output_dir; return (path, error message or None)"""
+    path, output_dir, output_format = job
+    try:
+        with NoteReader(path) as reader:
+            if output_format == 'json':
+                # Stream the text into the JSON object instead of building it in memory
+                target = os.path.join(output_dir, note_name(path) + '.json')
+                head = json.dumps(reader.meta)[:-1]
+                with atomic_writer(target) as out:
+                    out.write((head + (', ' if reader.meta else '') + '"text_content": "').encode())
+                    for piece in reader.iter_text():
+                        out.write(json.dumps(piece)[1:-1].encode())
+                    out.write(b'"}\n')
+            elif reader.meta.get('mode') == 'calc':
+                target = os.path.join(output_dir, note_name(path) + '.csv')
+                with atomic_writer(target) as out:
+                    write_csv(out, reader.meta.get('calc_data', {}))
+            else:
+                target = os.path.join(output_dir, note_name(path) + '.txt')
+                with atomic_writer(target) as out:
+                    for piece in reader.iter_text():
+                        out.write(piece.encode())
+        return path, None
+    except Exception as e:
+        return path, str(e) or type(e).__name__
+
+
+def export_notes(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = [(path, args.output_dir, args.format) for path in note_paths(args.notes)]
+    failed = 0
+    for path, error in run_pool(export_note, jobs, args.workers):
+        if error is not None:
+            logging.error(f"Cannot export {path}: {error}")
+            failed += 1
+    print(f"Exported {len(jobs) - failed} notes to {args.output_dir}")
+    return 1 if failed else 0
+
+
+# import
+
+def csv_note(source):
+    """Read a CSV file into calc note data, computing any formulas it contains.
+
+    The sheet grows past the default size to fit the file, up to the
+    largest sheet a note can hold.
+    """
+    inputs = {}
+    formulas = {}
+    rows, cols = DEFAULT_ROWS, DEFAULT_COLS
+    dropped = False
+    if os.path.getsize(source) > CSV_MAX_BYTES:
+        raise ValueError(f"CSV file larger than {CSV_MAX_BYTES >> 20} MB")
+    with open(source, newline='', encoding='utf-8', errors='replace') as f:
+        for row, values in enumerate(csv.reader(f)):
+            for col, value in enumerate(values):
+                if not value:
+                    continue
+                if row >= MAX_ROWS or col >= MAX_COLS:
+                    dropped = True
+                    break
+                (formulas if value.startswith('=') else inputs)[f"{row},{col}"] = value
+                rows, cols = max(rows, row + 1), max(cols, col + 1)
+    if dropped:
+        logging.warning(f"{source}: dropping cells outside the largest {MAX_ROWS}x{MAX_COLS} sheet")
+    model = CellModel()
+    model.load({'rows': rows, 'cols': cols, 'cells': inputs, 'formulas': formulas})
+    return {'mode': 'calc', 'text_content': '', 'calc_data': model.to_dict()}
+
+
+def text_pieces(source, terms):
+    """Yield the text of source in bounded pieces, adding its search terms to terms.
+
+    A word cut by a piece boundary is held back until the next piece, so
+    the terms are those of the whole text.
+    """
+    carry = ''
+    with open(source, encoding='utf-8', errors='replace') as f:
+        while True:
+            piece = f.read(TEXT_SLICE_CHARS)
+            if not piece:
+                break
+            text = carry + piece
+            # Matched on the reversed text, so a long word costs its length only once
+            cut = len(text) - WORD_CHARS.match(text[::-1]).end()
+            terms |= unique_terms(text[:cut])
+            # A word already too long to be a term stays too long
+            carry = text[cut:][-(MAX_TERM_LENGTH + 1):]
+            yield piece
+    terms |= unique_terms(carry)
+
+
+def import_file(job):
+    """Save one source file as a note; return (filename, manifest entry, terms, error)"""
+    source, target = job
+    filename = os.path.basename(target)
+    try:
+        if source.lower().endswith(CSV_EXTENSIONS):
+            note_data = csv_note(source)
+            save_note_file(target, note_data, notify=False)
+            terms = note_terms(note_data)
+        else:
+            terms = set()
+            pieces = text_pieces(source, terms)
+            first = next(pieces, '')
+            # Only the start of the text is kept, for the manifest preview
+            note_data = {'mode': 'text', 'text_content': first[:PREVIEW_LENGTH * 4],
+                         'calc_data': {'cells': {}, 'formulas': {}}}
+            save_note_file(target, note_data, notify=False, pieces=itertools.chain([first], pieces))
+        # The parent updates the manifest and index once for the whole import
+        entry = manifest.make_entry(filename, note_data, os.stat(target))
+        return filename, entry, sorted(terms), None
+    except Exception as e:
+        return filename, None, None, str(e) or type(e).__name__
+
+
+def import_jobs(source_dir, overwrite):
+    """Pair each importable file of source_dir with the note it becomes"""
+    jobs = []
+    taken = set()
+    for filename in sorted(os.listdir(source_dir)):
+        stem, extension = os.path.splitext(filename)
+        if extension.lower() not in TEXT_EXTENSIONS + CSV_EXTENSIONS or stem.startswith('.'):
+            continue
+        target = stem + NOTE_SUFFIX
+        copy = 2
+        while target in taken or (not overwrite and os.path.exists(target)):
+            target = f"{stem} ({copy}){NOTE_SUFFIX}"
+            copy += 1
+        taken.add(target)
+        jobs.append((os.path.join(source_dir, filename), target))
+    return jobs
+
+
+def import_notes(args):
+    manifest.load()
+    index.load()
+    jobs = import_jobs(args.source_dir, args.overwrite)
+    imported = 0
+    for filename, entry, terms, error in run_pool(import_file, jobs, args.workers):
+        if error is not None:
+            logging.error(f"Cannot import {filename}: {error}")
+            continue
+        manifest.entries[filename] = entry
+        index.update_terms(filename, terms)
+        imported += 1
+    manifest.save()
+    index.save()
+    print(f"Imported {imported} of {len(jobs)} files")
+    return 0 if imported == len(jobs) else 1
+
+
+# verify
+
+def verify_note(path):
+    """Decrypt and authenticate every chunk of a note; return (path, error, warning)"""
+    try:
+        with NoteReader(path) as reader:
+            for _ in reader.iter_text():
+                pass
+        warning = None
+        if os.path.exists(journal_path(path)):
+            unreadable = os.path.getsize(journal_path(path)) - journal_size(path)
+            if unreadable:
+                warning = f"{unreadable} bytes of its journal are torn or unreadable"
+        return path, None, warning
+    except Exception as e:
+        return path, str(e) or type(e).__name__, None
+
+
+def verify_notes(args):
+    paths = note_paths() + sorted(filename for filename in os.listdir('.') if is_scratch_file(filename))
+    failed = 0
+    for path, error, warning in run_pool(verify_note, paths, args.workers):
+        if error is not None:
+            print(f"FAILED  {path}: {error}")
+            failed += 1
+        elif warning is not None:
+            print(f"WARNING {path}: {warning}")
+    for path in (MANIFEST_FILE, INDEX_FILE):
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            for token in unpack_frames(data):
+                cipher_suite.decrypt(token)
+        except Exception as e:
+            # The app rebuilds these from the notes, so they do not fail the check
+            print(f"WARNING {path}: {e or type(e).__name__}, it will be rebuilt")
+    print(f"Verified {len(paths) - failed} of {len(paths)} notes")
+    return 1 if failed else 0
+
+
+# rotate
+
+def rotate_key(args):
+    failed = rotate_directory(args.workers, args.threads, args.passphrase, args.unlock_seconds)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-v', '--verbose', action='store_true', help="log progress")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('list', help="list notes with their mode, size and preview")
+    command.add_argument('--json', action='store_true', help="print one JSON object per note")
+    command.set_defaults(run=list_notes)
+
+    command = commands.add_parser('export', help="decrypt notes into a directory")
+    command.add_argument('output_dir')
+    command.add_argument('notes', nargs='*', help="note names (default: every note)")
+    command.add_argument('--format', choices=('json', 'text'), default='json',
+                         help="full JSON note data, or .txt for text notes and .csv for sheets")
+    command.set_defaults(run=export_notes)
+
+    command = commands.add_parser('import', help="save the .txt, .md and .csv files of a directory as notes")
+    command.add_argument('source_dir')
+    command.add_argument('--overwrite', action='store_true', help="replace notes with the same name")
+    command.set_defaults(run=import_notes)
+
+    command = commands.add_parser('verify', help="decrypt and authenticate every note")
+    command.set_defaults(run=verify_notes)
+
+    command = commands.add_parser('rotate', help="re-encrypt every file under a new key")
+    command.add_argument('--threads', action='store_true',
+                         help="use a thread pool instead of worker processes")
+    command.add_argument('--passphrase', action='store_true',
+                         help="derive the new key from a passphrase instead of storing it in key.key")
+    command.add_argument('--unlock-seconds', type=float, default=UNLOCK_TARGET_SECONDS,
+                         help="scrypt cost as the time one unlock takes on this machine")
+    command.set_defaults(run=rotate_key)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    perf.start()
+    try:
+        sys.exit(args.run(args))
+    except (KeyLockedError, FileNotFoundError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,41 +2,134 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
-from cryptography.fernet import Fernet
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject, Pango
 import os
 import logging
-import re
-import json
-
-# Generate or load encryption key
-def get_or_create_key():
-    key_file = 'key.key'
-    if os.path.exists(key_file):
-        with open(key_file, 'rb') as f:
-            key = f.read()
-    else:
-        key = Fernet.generate_key()
-        with open(key_file, 'wb') as f:
-            f.write(key)
-    return key
-
-key = get_or_create_key()
-cipher_suite = Fernet(key)
+import threading
+import time
+
+import perf
+from calc import MAX_COLS, MAX_ROWS, CellModel, column_name, format_ref, shift_formula
+from manifest import manifest
+from search import index as search_index, search_notes
+from storage import (KeyLockedError, NoteLoader, autosave_worker, claim_scratch_note, delete_note_file,
+                     is_note_file, key_cache, new_generation, new_journal_id, release_scratch_note)
+
+AUTOSAVE_DELAY_MS = 1000  # Quiet period after the last edit before autosaving
+WATCH_QUIET_MS = 250  # Quiet period after the last directory event before updating the Note Manager
+WATCH_MAX_DELAY_MS = 2000  # Longest a steady stream of directory events can hold back an update
+
+# Note Manager model columns
+NOTE_FILE, NOTE_NAME, NOTE_MODE, NOTE_MTIME, NOTE_SIZE, NOTE_PREVIEW = range(6)
+NOTE_COLUMN_TYPES = (str, str, str, GObject.TYPE_INT64, GObject.TYPE_INT64, str)
+
+STYLESHEET = b"""
+    .titlebar { 
+        background: linear-gradient(to bottom, #4a90d9, #357abd);
+        font-size: 14pt;
+        font-weight: 300;  
+        color: #1a1a1a;    
+    }
+    .titlebar button { 
+        color: white; 
+        min-width: 24px;
+        min-height: 24px;
+        background: transparent;
+        border: none;
+        border-radius: 12px;
+        transition: all 250ms ease-in-out;
+    }
+    .titlebar button:hover { 
+        background: rgba(255, 255, 255, 0.2);
+    }
+    .titlebar button image { 
+        color: white;
+        -gtk-icon-effect: none;
+        background: transparent;
+    }
+    .titlebar button:hover image {
+        color: rgba(255, 255, 255, 0.9);
+    }
+    .delete-button {
+        background: transparent;
+        border: none;
+        padding: 4px;
+        border-radius: 12px;
+        transition: all 250ms ease-in-out;
+    }
+    .delete-button:hover {
+        background: rgba(255, 0, 0, 0.1);
+    }
+    .delete-button image {
+        color: #ff0000;
+        background: transparent;
+    }
+    .view { font-family: Sans; font-size: 12pt; }
+    .new-note-button { 
+        background: #4a90d9;
+        color: white;
+        padding: 8px 16px;
+        border-radius: 4px;
+        border: none;
+        transition: all 250ms ease-in-out;
+    }
+    .new-note-button:hover { 
+        background: #5aa0e9;
+    }
+    .suggested-action { 
+        background: #2ecc71; 
+        color: white;
+        padding: 8px 16px;   
+        border-radius: 4px;
+    }
+    .column-header {
+        font-weight: bold;
+    }
+    .row-header {
+        font-weight: bold;
+    }
+"""
+_stylesheet_installed = False
+
+
+def install_stylesheet():
+    """Install the app stylesheet on the screen, once per process"""
+    global _stylesheet_installed
+    if _stylesheet_installed:
+        return
+    css_provider = Gtk.CssProvider()
+    css_provider.load_from_data(STYLESHEET)
+    Gtk.StyleContext.add_provider_for_screen(
+        Gdk.Screen.get_default(),
+        css_provider,
+        Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
+    )
+    _stylesheet_installed = True
+
 
 class StickyNoteWindow(Gtk.Window):
     def __init__(self):
         super().__init__(title="Sticky Notes")
-        self.unsaved_changes = False
+        self.edit_generation = 0  # Bumped on every edit
+        self.saved_generation = 0  # Newest generation written to note_path
+        self.note_path = None  # File of a named note; unnamed notes autosave to scratch_path
+        self.scratch_path = claim_scratch_note()  # Not shared with other windows
+        self.autosave_timer = None
+        self.journal_base = None  # Path whose on-disk state journal_ops build on
+        self.journal_id = None  # Journal of the snapshot this window queued for journal_base
+        self.journal_ops = []  # Edits made since the state queued for journal_base
+        self.loader = None  # NoteLoader filling the window while a note opens
+        self.load_started = None
+        self.on_loaded = None
         self.is_shaded = False
         self.mode = "text"  # Track current mode
-        self.cells = {}  # Store cell entries for calc mode
-        self.formulas = {}  # Store formulas for calc mode
-        self.cell_dependencies = {}  # Track which cells depend on which other cells
+        self.model = CellModel()  # Inputs, formulas and results of calc mode
+        # Sandboxed formula results arrive later, on the main loop
+        self.model.dispatch = GLib.idle_add
+        self.model.on_update = self.render_cells
         self.active_formula_cell = None  # Track cell being edited
         self.updating_cell = False  # Prevent recursive updates
         self.is_displaying_formula = False  # Track if we're showing formula text or value
-        logging.info(f"Initial unsaved_changes: {self.unsaved_changes}")
         self.set_default_size(400, 300)
 
         # Create a header bar
@@ -55,6 +148,15 @@ class StickyNoteWindow(Gtk.Window):
         shade_button.connect("clicked", self.on_shade_clicked)
         header_bar.pack_end(shade_button)
 
+        # Add lock button; only a passphrase-derived key can be forgotten and asked for again
+        if key_cache.passphrase_mode():
+            lock_button = Gtk.Button()
+            lock_image = Gtk.Image.new_from_icon_name("system-lock-screen-symbolic", Gtk.IconSize.BUTTON)
+            lock_button.add(lock_image)
+            lock_button.set_tooltip_text("Lock Notes")
+            lock_button.connect("clicked", self.on_lock_clicked)
+            header_bar.pack_end(lock_button)
+
         # Add a button to the header bar
         note_manager_button = Gtk.Button()
         note_manager_image = Gtk.Image.new_from_icon_name("folder-symbolic", Gtk.IconSize.BUTTON)
@@ -72,6 +174,16 @@ class StickyNoteWindow(Gtk.Window):
         mode_button.connect("clicked", self.on_mode_toggle)
         header_bar.pack_start(mode_button)
 
+        # Add sheet size button, shown in calc mode only
+        self.size_button = Gtk.Button()
+        size_image = Gtk.Image.new_from_icon_name("zoom-fit-best-symbolic", Gtk.IconSize.BUTTON)
+        self.size_button.add(size_image)
+        self.size_button.set_tooltip_text("Sheet Size")
+        self.size_button.set_no_show_all(True)
+        size_image.show()
+        self.size_button.connect("clicked", self.on_sheet_size_clicked)
+        header_bar.pack_start(self.size_button)
+
         # Store main content in a box for windowshade
         self.content_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.content_box.set_vexpand(True)
@@ -99,143 +211,155 @@ class StickyNoteWindow(Gtk.Window):
         # Initially show text view
         self.content_box.add(self.text_scroll)
 
-        # Create grid for calc mode
-        self.grid = Gtk.Grid()
-        self.grid.set_column_spacing(1)
-        self.grid.set_row_spacing(1)
-        self.grid.set_margin_start(10)
-        self.grid.set_margin_end(10)
-        self.grid.set_margin_top(10)
-        self.grid.set_margin_bottom(10)
-        self.grid.set_vexpand(True)  # Make grid expand vertically
-        self.grid.set_valign(Gtk.Align.FILL)  # Fill available space
-        self.grid.set_hexpand(True)  # Make grid expand horizontally
-        self.grid.set_halign(Gtk.Align.FILL)  # Fill available space
-
-        # Add column headers (A-T)
-        for col in range(20):
-            label = Gtk.Label(label=chr(65 + col))
-            label.get_style_context().add_class("column-header")
-            self.grid.attach(label, col + 1, 0, 1, 1)
-
-        # Add row headers (1-50)
-        for row in range(50):
-            label = Gtk.Label(label=str(row + 1))
-            label.get_style_context().add_class("row-header")
-            self.grid.attach(label, 0, row + 1, 1, 1)
-
-        # Add cells
-        for row in range(50):
-            for col in range(20):
-                entry = Gtk.Entry()
-                entry.set_width_chars(10)
-                entry.connect('changed', self.on_cell_changed, row, col)
-                entry.connect('key-press-event', self.on_cell_key_press, row, col)
-                entry.connect('button-press-event', self.on_cell_clicked, row, col)
-                entry.connect('focus-out-event', self.on_cell_focus_out, row, col)
-                entry.connect('focus-in-event', self.on_cell_focus_in, row, col)
-                self.cells[(row, col)] = entry
-                self.grid.attach(entry, col + 1, row + 1, 1, 1)
-
-        # Create grid scrolled window but don't add it yet
+        # Shown at the bottom while a note loads in the background
+        self.load_progress = Gtk.ProgressBar()
+        self.load_progress.set_no_show_all(True)
+        self.content_box.pack_end(self.load_progress, False, False, 0)
+
+        # The calc grid is built by ensure_grid() the first time calc mode is shown
+        self.grid = None
+        self.grid_scroll = None
+        self.cells = {}  # Entries currently showing each visible cell
+
+        install_stylesheet()
+
+        # Connect events
+        self.text_view.get_buffer().connect("changed", self.on_text_changed)
+        self.text_view.get_buffer().connect("insert-text", self.on_buffer_insert)
+        self.text_view.get_buffer().connect("delete-range", self.on_buffer_delete)
+        self.connect("delete-event", self.on_delete_event)
+        self.connect("destroy", self.on_destroy)
+        logging.info("Connected delete-event signal")
+        self.start_new_note()
+
+    def ensure_grid(self):
+        """Build the calc grid and its scrolled window on first use"""
+        if self.grid is not None:
+            return
+        # Entries only exist for the cells in view
+        self.grid = CalcGrid(self, self.model.rows, self.model.cols)
+        self.cells = self.grid.entries
+
         self.grid_scroll = Gtk.ScrolledWindow()
         self.grid_scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
         self.grid_scroll.add(self.grid)
         self.grid_scroll.set_vexpand(True)  # Make scrolled window expand vertically
         self.grid_scroll.set_valign(Gtk.Align.FILL)  # Fill available space
-        self.grid_scroll.set_hexpand(True)  # Make scrolled window expand horizontally 
+        self.grid_scroll.set_hexpand(True)  # Make scrolled window expand horizontally
         self.grid_scroll.set_halign(Gtk.Align.FILL)  # Fill available space
 
-        # Set up CSS styling
-        css_provider = Gtk.CssProvider()
-        css_provider.load_from_data(b"""
-            .titlebar { 
-                background: linear-gradient(to bottom, #4a90d9, #357abd);
-                font-size: 14pt;
-                font-weight: 300;  
-                color: #1a1a1a;    
-            }
-            .titlebar button { 
-                color: white; 
-                min-width: 24px;
-                min-height: 24px;
-                background: transparent;
-                border: none;
-                border-radius: 12px;
-                transition: all 250ms ease-in-out;
-            }
-            .titlebar button:hover { 
-                background: rgba(255, 255, 255, 0.2);
-            }
-            .titlebar button image { 
-                color: white;
-                -gtk-icon-effect: none;
-                background: transparent;
-            }
-            .titlebar button:hover image {
-                color: rgba(255, 255, 255, 0.9);
-            }
-            .delete-button {
-                background: transparent;
-                border: none;
-                padding: 4px;
-                border-radius: 12px;
-                transition: all 250ms ease-in-out;
-            }
-            .delete-button:hover {
-                background: rgba(255, 0, 0, 0.1);
-            }
-            .delete-button image {
-                color: #ff0000;
-                background: transparent;
-            }
-            .view { font-family: Sans; font-size: 12pt; }
-            .new-note-button { 
-                background: #4a90d9;
-                color: white;
-                padding: 8px 16px;
-                border-radius: 4px;
-                border: none;
-                transition: all 250ms ease-in-out;
-            }
-            .new-note-button:hover { 
-                background: #5aa0e9;
-            }
-            .suggested-action { 
-                background: #2ecc71; 
-                color: white;
-                padding: 8px 16px;   
-                border-radius: 4px;
-            }
-            .column-header {
-                font-weight: bold;
-            }
-            .row-header {
-                font-weight: bold;
-            }
-        """)
-        Gtk.StyleContext.add_provider_for_screen(
-            Gdk.Screen.get_default(),
-            css_provider,
-            Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
-        )
+    @property
+    def unsaved_changes(self):
+        """True while the newest edit is not yet on disk in note_path"""
+        return self.edit_generation != self.saved_generation
 
-        # Connect events
-        self.text_view.get_buffer().connect("changed", self.on_text_changed)
-        self.connect("delete-event", self.on_delete_event)
-        logging.info("Connected delete-event signal")
-        self.start_new_note()
+    @unsaved_changes.setter
+    def unsaved_changes(self, value):
+        if value:
+            self.edit_generation = new_generation()
+        else:
+            self.saved_generation = self.edit_generation
 
+    @perf.timed('on_text_changed')
     def on_text_changed(self, buffer):
-        logging.info("on_text_changed triggered")
+        if self.loader is not None:  # Text arriving from the file is not an edit
+            return
         self.unsaved_changes = True
-        logging.info(f"unsaved_changes set to {self.unsaved_changes}")
-        logging.info("on_text_changed successfully triggered and unsaved_changes set")
+        self.schedule_autosave()
+
+    def on_buffer_insert(self, buffer, location, text, length):
+        if self.loader is not None:
+            return
+        offset = location.get_offset()
+        last = self.journal_ops[-1] if self.journal_ops else None
+        if (last and last['op'] == 'text' and last['start'] == last['end']
+                and offset == last['start'] + len(last['text'])):
+            last['text'] += text  # Typing extends the previous insertion
+        else:
+            self.journal_ops.append({'op': 'text', 'start': offset, 'end': offset, 'text': text})
+
+    def on_buffer_delete(self, buffer, start, end):
+        if self.loader is not None:
+            return
+        start, end = start.get_offset(), end.get_offset()
+        last = self.journal_ops[-1] if self.journal_ops else None
+        if last and last['op'] == 'text' and not last['text'] and last['start'] == end:
+            last['start'] = start  # Backspacing extends the previous deletion
+        elif last and last['op'] == 'text' and not last['text'] and last['start'] == start:
+            last['end'] += end - start  # So does deleting forwards
+        else:
+            self.journal_ops.append({'op': 'text', 'start': start, 'end': end, 'text': ''})
+
+    def schedule_autosave(self):
+        """(Re)start the debounce timer so a burst of edits is saved once"""
+        if self.autosave_timer is not None:
+            GLib.source_remove(self.autosave_timer)
+        self.autosave_timer = GLib.timeout_add(AUTOSAVE_DELAY_MS, self.on_autosave_timeout)
+
+    def cancel_autosave(self):
+        if self.autosave_timer is not None:
+            GLib.source_remove(self.autosave_timer)
+            self.autosave_timer = None
+
+    def on_autosave_timeout(self):
+        self.autosave_timer = None
+        if self.loader is not None:
+            return False  # Edits made while a note loads are saved once it is in
+        self.autosave()
+        return False
+
+    def finish_autosave(self):
+        """Hand a pending autosave to the writer now instead of when its timer fires"""
+        if self.autosave_timer is not None:
+            self.cancel_autosave()
+            self.on_autosave_timeout()
+
+    def autosave(self, path=None):
+        """Hand the note's changes to the background writer"""
+        path = path or self.note_path or self.scratch_path
+        if path == self.journal_base:
+            # The file already holds everything before journal_ops; append only those,
+            # unless another window has saved over the snapshot they extend by then
+            autosave_worker.submit_ops(path, self.edit_generation, self.journal_ops, self.on_autosave_written,
+                                       self.journal_id)
+        else:
+            self.journal_id = new_journal_id()
+            autosave_worker.submit(path, self.edit_generation, self.get_note_data(), self.on_autosave_written,
+                                   self.journal_id)
+            self.journal_base = path
+        self.journal_ops = []
+
+    def on_autosave_written(self, path, generation, error):
+        # Called on the writer thread; state is only touched on the main loop
+        GLib.idle_add(self.on_autosave_done, path, generation, error)
+
+    def on_autosave_done(self, path, generation, error):
+        if error is None and path == self.note_path:
+            self.saved_generation = max(self.saved_generation, generation)
+        elif error is not None and path == self.journal_base:
+            # The journal could not be extended; write a full snapshot instead
+            self.journal_base = None
+            self.schedule_autosave()
+        return False
+
+    @perf.timed('save_to')
+    def save_to(self, path):
+        """Write the note to path now, after any autosave still in flight"""
+        self.cancel_autosave()
+        self.autosave(path)
+        autosave_worker.flush()
+        if path == self.note_path:
+            self.saved_generation = max(self.saved_generation, autosave_worker.saved_generation(path))
+
+    def get_note_data(self):
+        """Snapshot text and calc data in the saved note layout"""
         buffer = self.text_view.get_buffer()
         start, end = buffer.get_bounds()
-        content = buffer.get_text(start, end, False)
-        encrypted_content = cipher_suite.encrypt(content.encode())
-        logging.info(f"Encrypted content: {encrypted_content}")
+        return {
+            'mode': self.mode,
+            'text_content': buffer.get_text(start, end, False),
+            'calc_data': self.model.to_dict(),
+        }
 
     def get_note_preview(self):
         buffer = self.text_view.get_buffer()
@@ -254,6 +378,17 @@ class StickyNoteWindow(Gtk.Window):
 
     def on_delete_event(self, widget, event):
         logging.info("on_delete_event triggered")
+        self.cancel_load()  # The file is intact; the partly loaded window has nothing to save
+        if self.autosave_timer is not None:
+            # Finish the pending autosave before deciding whether to ask
+            self.cancel_autosave()
+            self.autosave()
+        if self.note_path:
+            # Fold the journal into the snapshot before the app goes away
+            autosave_worker.submit_compact(self.note_path, self.on_autosave_written)
+        autosave_worker.flush()
+        if self.note_path:
+            self.saved_generation = max(self.saved_generation, autosave_worker.saved_generation(self.note_path))
         logging.info(f"unsaved_changes: {self.unsaved_changes}")
         if self.unsaved_changes:
             # Check for content in current mode
@@ -265,7 +400,7 @@ class StickyNoteWindow(Gtk.Window):
                 has_content = bool(content)
             else:  # calc mode
                 # Check if any cell has content
-                has_content = any(entry.get_text().strip() for entry in self.cells.values())
+                has_content = self.model.has_content()
                 
             if has_content:
                 dialog = Gtk.Dialog(
@@ -316,39 +451,8 @@ class StickyNoteWindow(Gtk.Window):
                 if response == Gtk.ResponseType.YES:
                     save_name = entry.get_text()
                     if save_name:
-                        note_data = {
-                            'mode': self.mode,
-                            'text_content': '',
-                            'calc_data': {
-                                'cells': {},
-                                'formulas': {}
-                            }
-                        }
-
-                        # Save text content if in text mode
-                        if self.mode == 'text':
-                            buffer = self.text_view.get_buffer()
-                            start, end = buffer.get_bounds()
-                            note_data['text_content'] = buffer.get_text(start, end, False)
-
-                        # Save calc data if in calc mode
-                        if self.mode == 'calc':
-                            for (row, col), entry in self.cells.items():
-                                cell_value = entry.get_text()
-                                if cell_value:  # Only save non-empty cells
-                                    note_data['calc_data']['cells'][f"{row},{col}"] = cell_value
-                            
-                            # Save formulas
-                            note_data['calc_data']['formulas'] = {
-                                f"{row},{col}": formula 
-                                for (row, col), formula in self.formulas.items()
-                            }
-
-                        # Convert to JSON and encrypt
-                        json_data = json.dumps(note_data)
-                        encrypted_content = cipher_suite.encrypt(json_data.encode())
-                        with open(f'{save_name}.enc', 'wb') as f:
-                            f.write(encrypted_content)
+                        self.note_path = f'{save_name}.enc'
+                        self.save_to(self.note_path)
                         self.update_title(save_name)
                     else:
                         self.save_note()
@@ -359,70 +463,102 @@ class StickyNoteWindow(Gtk.Window):
         Gtk.main_quit()
         return False
 
-    def save_note(self):
-        # Create a dictionary to store both text and calc data
-        note_data = {
-            'mode': self.mode,
-            'text_content': '',
-            'calc_data': {
-                'cells': {},
-                'formulas': {}
-            }
-        }
+    def on_destroy(self, widget):
+        release_scratch_note(self.scratch_path)
 
-        # Save text content
+    def save_note(self):
         buffer = self.text_view.get_buffer()
-        start, end = buffer.get_bounds()
-        note_data['text_content'] = buffer.get_text(start, end, False)
-
-        # Save calc data
-        for (row, col), entry in self.cells.items():
-            cell_value = entry.get_text()
-            if cell_value:  # Only save non-empty cells
-                note_data['calc_data']['cells'][(row, col)] = cell_value
-        
-        # Save formulas
-        note_data['calc_data']['formulas'] = {
-            f"{row},{col}": formula 
-            for (row, col), formula in self.formulas.items()
-        }
-
-        if note_data['text_content'] or note_data['calc_data']['cells']:
-            # Convert to JSON and encrypt
-            json_data = json.dumps(note_data)
-            encrypted_content = cipher_suite.encrypt(json_data.encode())
-            with open('.note.enc', 'wb') as f:
-                f.write(encrypted_content)
+        if buffer.get_char_count() or self.model.has_content():
+            self.save_to(self.scratch_path)
             self.unsaved_changes = False
             self.update_title()
 
     def load_note(self):
-        if os.path.exists('.note.enc'):
-            try:
-                with open('.note.enc', 'rb') as f:
-                    encrypted_content = f.read()
-                decrypted_content = cipher_suite.decrypt(encrypted_content).decode()
-                
-                # Try to parse as JSON (new format)
-                try:
-                    note_data = json.loads(decrypted_content)
-                    self._load_note_data(note_data)
-                except json.JSONDecodeError:
-                    # Old format - just text content
-                    buffer = self.text_view.get_buffer()
-                    buffer.set_text(decrypted_content)
-                    # Switch to text mode if needed
-                    if self.mode != 'text':
-                        self.mode = 'text'
-                        self.content_box.remove(self.grid_scroll)
-                        self.content_box.add(self.text_scroll)
-                        self.text_scroll.show_all()
-                        self.mode_image.set_from_icon_name("view-grid-symbolic", Gtk.IconSize.BUTTON)
-
-            except Exception as e:
-                print(f"Load error: {e}")
-                buffer = self.text_view.get_buffer()
-                buffer.set_text("")
+        if os.path.exists(self.scratch_path):
+            self.open_note(self.scratch_path)
+
+    def open_note(self, path, on_loaded=None):
+        """Load a note in the background, showing its text piece by piece as it is decrypted.
+
+        The window stays responsive meanwhile, and opening another note
+        cancels the load. on_loaded(path) is called once all of it is in.
+        """
+        self.cancel_load()
+        if self.autosave_timer is not None:
+            # Save what the current note has pending before it is replaced
+            self.cancel_autosave()
+            self.autosave()
+        self.unsaved_changes = False
+        # Until the load is done the window holds neither note, so nothing may be
+        # autosaved or journaled over the previous one
+        self.note_path = None
+        self.journal_base = None
+        self.journal_ops = []
+        self.loader = NoteLoader(path, self.on_load_event)
+        self.load_started = time.perf_counter()
+        self.on_loaded = on_loaded
+        self.text_view.set_editable(False)  # Edits would race the text still to come
+        self.load_progress.set_fraction(0.0)
+        self.load_progress.show()
+        self.loader.start()
+
+    def cancel_load(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.finish_load()
+            # A partly loaded note is not worth saving anywhere
+            self.cancel_autosave()
+            self.unsaved_changes = False
+            self.journal_ops = []
+
+    def finish_load(self):
+        self.loader = None
+        self.on_loaded = None
+        self.text_view.set_editable(True)
+        self.load_progress.hide()
+
+    def on_load_event(self, loader, kind, value):
+        # Called on the loader thread; the window is only touched on the main loop.
+        # Idle priority lets input and redraws go first, so the window stays interactive.
+        GLib.idle_add(self.on_load_step, loader, kind, value)
+
+    def on_load_step(self, loader, kind, value):
+        if loader is not self.loader:
+            return False  # Cancelled
+        buffer = self.text_view.get_buffer()
+        if kind == 'meta':
+            self._load_note_data(value)
+        elif kind == 'text':
+            if perf.ENABLED and not buffer.get_char_count():
+                perf.record('open_first_text', time.perf_counter() - self.load_started)
+            buffer.insert(buffer.get_end_iter(), value)
+            self.load_progress.set_fraction(loader.progress)
+            loader.consumed()
+        elif kind == 'done':
+            if perf.ENABLED:
+                perf.record('open_note', time.perf_counter() - self.load_started)
+            on_loaded = self.on_loaded
+            edited = self.unsaved_changes  # Cells or the mode changed while the text came in
+            self.finish_load()
+            # Other windows may have the note open too, so edits are only journaled
+            # onto a snapshot this window wrote itself, after its first save
+            self.journal_ops = []
+            self.journal_base = None
+            if on_loaded is not None:
+                on_loaded(loader.path)
+            if edited:
+                self.unsaved_changes = True
+                self.schedule_autosave()
+        else:
+            logging.error(f"Cannot open {loader.path}: {value}")
+            self.finish_load()
+            # Drop the partial note rather than let it be saved over the current one
+            self.note_path = None
+            self.update_title()
+            self.model.clear()
+            self.render_cells(self.cells)
+            self.start_new_note()
+        return False
 
     def _load_note_data(self, note_data):
         """Helper method to load note data in the new format"""
@@ -430,55 +566,53 @@ class StickyNoteWindow(Gtk.Window):
         buffer = self.text_view.get_buffer()
         buffer.set_text(note_data.get('text_content', ''))
 
-        # Load calc data
-        cells_data = note_data.get('calc_data', {}).get('cells', {})
-        formulas_data = note_data.get('calc_data', {}).get('formulas', {})
-
-        # Clear existing data
-        for entry in self.cells.values():
-            entry.set_text('')
-        self.formulas.clear()
-
-        # Load cell values
-        for cell_pos, value in cells_data.items():
-            row, col = map(int, cell_pos.split(','))
-            if (row, col) in self.cells:
-                self.cells[(row, col)].set_text(value)
-
-        # Load formulas
-        for cell_pos, formula in formulas_data.items():
-            row, col = map(int, cell_pos.split(','))
-            if (row, col) in self.cells:
-                self.formulas[(row, col)] = formula
-                # Update cell with evaluated formula
-                result = self.evaluate_formula(formula, (row, col))
-                self.cells[(row, col)].set_text(result)
+        # Load calc data and show every cell
+        self.model.load(note_data.get('calc_data', {}))
+        if self.grid is not None:
+            self.grid.set_dimensions(self.model.rows, self.model.cols)
+        self.render_cells(self.cells)
 
         # Switch to the saved mode
         saved_mode = note_data.get('mode', 'text')
         if saved_mode != self.mode:
             self.mode = saved_mode
             if saved_mode == 'calc':
+                self.ensure_grid()
                 self.content_box.remove(self.text_scroll)
                 self.content_box.add(self.grid_scroll)
                 self.grid_scroll.show_all()
+                self.size_button.show()
                 self.mode_image.set_from_icon_name("view-list-symbolic", Gtk.IconSize.BUTTON)
             else:
                 self.content_box.remove(self.grid_scroll)
                 self.content_box.add(self.text_scroll)
                 self.text_scroll.show_all()
+                self.size_button.hide()
                 self.mode_image.set_from_icon_name("view-grid-symbolic", Gtk.IconSize.BUTTON)
 
+    def note_opened(self, path):
+        """Adopt path as this window's note once its content has been loaded"""
+        self.cancel_autosave()
+        self.note_path = path
+        self.unsaved_changes = False
+        self.update_title(os.path.basename(path)[:-4])  # Remove .enc
+
     def start_new_note(self):
         buffer = self.text_view.get_buffer()
         buffer.set_text("")
+        self.cancel_autosave()  # Nothing to save yet, so leave the disk and the crypto alone
         self.unsaved_changes = False
+        self.journal_ops = []
+        self.journal_base = None
         logging.info("Started a new note")
 
     def on_note_manager_clicked(self, button):
         dialog = NoteManagerDialog(self)
         dialog.show()
 
+    def on_lock_clicked(self, button):
+        lock_notes()
+
     def on_shade_clicked(self, button):
         self.is_shaded = not self.is_shaded
         if self.is_shaded:
@@ -498,9 +632,11 @@ class StickyNoteWindow(Gtk.Window):
             button.set_tooltip_text("Switch to Text Mode")
             
             # Switch views
+            self.ensure_grid()
             self.content_box.remove(self.text_scroll)
             self.content_box.add(self.grid_scroll)
             self.grid_scroll.show_all()
+            self.size_button.show()
         else:
             # Switch to text mode
             self.mode = "text"
@@ -511,63 +647,90 @@ class StickyNoteWindow(Gtk.Window):
             self.content_box.remove(self.grid_scroll)
             self.content_box.add(self.text_scroll)
             self.text_scroll.show_all()
+            self.size_button.hide()
+
+        self.journal_ops.append({'op': 'mode', 'mode': self.mode})
+        self.unsaved_changes = True
+        self.schedule_autosave()
+
+    def on_sheet_size_clicked(self, button):
+        dialog = Gtk.Dialog(transient_for=self, flags=0, title="Sheet Size")
+        dialog.add_buttons(
+            Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+            Gtk.STOCK_OK, Gtk.ResponseType.OK
+        )
+        dialog.set_default_response(Gtk.ResponseType.OK)
+
+        content_area = dialog.get_content_area()
+        content_area.set_margin_start(10)
+        content_area.set_margin_end(10)
+        content_area.set_margin_top(10)
+        content_area.set_margin_bottom(10)
+        content_area.set_spacing(10)
+
+        grid = Gtk.Grid(column_spacing=10, row_spacing=10)
+        rows_spin = Gtk.SpinButton.new_with_range(1, MAX_ROWS, 1)
+        rows_spin.set_value(self.model.rows)
+        rows_spin.set_activates_default(True)
+        cols_spin = Gtk.SpinButton.new_with_range(1, MAX_COLS, 1)
+        cols_spin.set_value(self.model.cols)
+        cols_spin.set_activates_default(True)
+        grid.attach(Gtk.Label(label="Rows", xalign=0), 0, 0, 1, 1)
+        grid.attach(rows_spin, 1, 0, 1, 1)
+        grid.attach(Gtk.Label(label=f"Columns (up to {column_name(MAX_COLS - 1)})", xalign=0), 0, 1, 1, 1)
+        grid.attach(cols_spin, 1, 1, 1, 1)
+        content_area.add(grid)
+        content_area.add(Gtk.Label(label="Cells outside the new size are removed."))
+
+        dialog.show_all()
+        if dialog.run() == Gtk.ResponseType.OK:
+            self.resize_sheet(rows_spin.get_value_as_int(), cols_spin.get_value_as_int())
+        dialog.destroy()
+
+    def resize_sheet(self, rows, cols):
+        """Change the sheet dimensions, journal the change and redraw the grid"""
+        if (rows, cols) == (self.model.rows, self.model.cols):
+            return
+        self.model.resize(rows, cols)
+        self.grid.set_dimensions(self.model.rows, self.model.cols)
+        self.journal_ops.append({'op': 'size', 'rows': self.model.rows, 'cols': self.model.cols})
+        self.unsaved_changes = True
+        self.schedule_autosave()
 
     def on_cell_focus_out(self, entry, event, row, col):
         """Handle cell focus out"""
-        if (row, col) in self.formulas:
-            self.updating_cell = True
-            result = self.evaluate_formula(self.formulas[(row, col)], (row, col))
-            entry.set_text(result)
-            self.set_numeric_alignment(entry, result)
-            self.updating_cell = False
+        text = entry.get_text()
+        if text.startswith('='):
+            # Editing is complete: commit the formula and show its result
+            self.set_cell_input(row, col, text)
             self.is_displaying_formula = False
         self.active_formula_cell = None
         return False
 
     def cell_to_ref(self, row, col):
         """Convert row, col to cell reference (e.g., 0,0 -> A1)"""
-        return f"{chr(65 + col)}{row + 1}"
+        return format_ref(row, col)
 
     def ref_to_cell(self, ref):
         """Convert cell reference to row, col (e.g., A1 -> 0,0)"""
         if not ref or len(ref) < 2:
             return None
-        col = ord(ref[0].upper()) - 65
-        try:
-            row = int(ref[1:]) - 1
-            if 0 <= row < 50 and 0 <= col < 20:
-                return (row, col)
-        except ValueError:
-            pass
-        return None
+        return self.model.parse_ref(ref.upper())
 
-    def evaluate_formula(self, formula, current_cell):
-        """Evaluate a formula, handling basic arithmetic and cell references"""
-        if not formula.startswith('='):
-            return formula
-        
-        formula = formula[1:]  # Remove '='
-        try:
-            # Replace cell references with their values
-            cell_refs = re.findall(r'[A-T][1-9][0-9]?', formula)
-            for ref in cell_refs:
-                cell_pos = self.ref_to_cell(ref)
-                if cell_pos:
-                    row, col = cell_pos
-                    if (row, col) == current_cell:  # Prevent circular reference
-                        raise ValueError("Circular reference detected")
-                    cell_value = self.cells[(row, col)].get_text()
-                    if cell_value.startswith('='):  # Handle nested formulas
-                        cell_value = self.evaluate_formula(cell_value, (row, col))
-                    formula = formula.replace(ref, cell_value)
-            
-            # Evaluate the resulting expression
-            result = eval(formula)
-            return str(result)
-        except Exception as e:
-            logging.error(f"Formula evaluation error: {e}")
-            return "#ERROR"
+    def render_cells(self, cells):
+        """Show the model's current text in the entries of cells"""
+        self.updating_cell = True
+        for cell in cells:
+            entry = self.cells.get(cell)
+            if entry is None:
+                continue
+            text = self.model.display(cell)
+            if entry.get_text() != text:
+                entry.set_text(text)
+            self.set_numeric_alignment(entry, text)
+        self.updating_cell = False
 
+    @perf.timed('on_cell_changed')
     def on_cell_changed(self, entry, row, col):
         """Handle cell content changes"""
         if self.updating_cell:  # Prevent recursive updates
@@ -576,60 +739,124 @@ class StickyNoteWindow(Gtk.Window):
         cell_value = entry.get_text()
         if cell_value:
             self.unsaved_changes = True
-        
-        # Update active_formula_cell when a cell starts with = and has focus
-        if cell_value.startswith('=') and entry.is_focus():
-            self.active_formula_cell = (row, col)
-            # Update dependencies when formula changes
-            self.update_dependencies(row, col, cell_value)
-            self.formulas[(row, col)] = cell_value
-        
+            self.schedule_autosave()
+
         # Set alignment based on content
         self.set_numeric_alignment(entry, cell_value)
-            
-        if cell_value.startswith('='):
-            # Only evaluate when editing is complete (Enter pressed or focus lost)
-            if not entry.is_focus():
-                self.updating_cell = True
-                result = self.evaluate_formula(cell_value, (row, col))
-                entry.set_text(result)
-                # Set alignment for the result
-                self.set_numeric_alignment(entry, result)
-                self.updating_cell = False
-        else:
-            if (row, col) in self.formulas:
-                del self.formulas[(row, col)]
-            # Update cells that depend on this cell
-            self.update_dependent_cells(row, col)
+
+        # Only evaluate formulas when editing is complete (Enter pressed or focus lost)
+        if cell_value.startswith('=') and entry.is_focus():
+            self.active_formula_cell = (row, col)
+            return
+
+        # Store the input and update cells that depend on this cell
+        self.set_cell_input(row, col, cell_value)
+
+    def set_cell_input(self, row, col, text):
+        """Store a cell's input in the model, journal it and show what changed"""
+        if self.model.input((row, col)) != text:
+            key = f"{row},{col}"
+            last = self.journal_ops[-1] if self.journal_ops else None
+            if last and last['op'] == 'cell' and last['cell'] == key:
+                last['input'] = text  # Typing in a cell replaces its previous value
+            else:
+                self.journal_ops.append({'op': 'cell', 'cell': key, 'input': text})
+        self.render_cells(self.model.set_input((row, col), text))
+
+    def set_cell_inputs(self, inputs):
+        """Store many (cell, text) inputs as one batch, recalculating once at the end"""
+        with self.model.batch() as updated:
+            for cell, text in inputs:
+                if not self.model.contains(cell) or self.model.input(cell) == text:
+                    continue
+                self.journal_ops.append({'op': 'cell', 'cell': f"{cell[0]},{cell[1]}", 'input': text})
+                self.model.set_input(cell, text)
+        if updated:
+            self.render_cells(updated)
+            self.unsaved_changes = True
+            self.schedule_autosave()
+
+    def paste_block(self, row, col, text):
+        """Paste tab-separated rows of text with their top-left corner at row, col"""
+        lines = text.rstrip('\n').split('\n')
+        self.set_cell_inputs(((row + r, col + c), value.rstrip('\r'))
+                             for r, line in enumerate(lines)
+                             for c, value in enumerate(line.split('\t')))
+
+    def fill_down(self, row, col):
+        """Copy a cell down as far as the data beside it runs, moving formula references along"""
+        last = row
+        for side in (col - 1, col + 1):
+            while last + 1 < self.model.rows and self.model.input((last + 1, side)):
+                last += 1
+            if last > row:
+                break
+        text = self.model.input((row, col))
+        formula = text.startswith('=')
+        self.set_cell_inputs(((r, col), shift_formula(text, r - row, 0) if formula else text)
+                             for r in range(row + 1, last + 1))
 
     def on_cell_key_press(self, entry, event, row, col):
-        if event.keyval in (Gdk.KEY_Return, Gdk.KEY_KP_Enter):
+        last_row = self.model.rows - 1
+        last_col = self.model.cols - 1
+        control = event.state & Gdk.ModifierType.CONTROL_MASK
+        if control and event.keyval in (Gdk.KEY_v, Gdk.KEY_V):
+            # Text copied from a spreadsheet spans cells; anything else pastes into the entry
+            text = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD).wait_for_text()
+            if not text or ('\t' not in text and '\n' not in text.rstrip('\n')):
+                return False
+            self.paste_block(row, col, text)
+            return True
+        elif control and event.keyval in (Gdk.KEY_d, Gdk.KEY_D):
+            if entry.get_text().startswith('='):
+                # Commit the formula being edited, as leaving the cell would
+                self.set_cell_input(row, col, entry.get_text())
+                self.is_displaying_formula = False
+            self.fill_down(row, col)
+            return True
+        elif event.keyval in (Gdk.KEY_Return, Gdk.KEY_KP_Enter):
             # Move focus to cell below on Enter
-            if row < 49:  # Not last row
-                self.cells[(row + 1, col)].grab_focus()
+            if row < last_row:  # Not last row
+                self.grid.focus_cell(row + 1, col)
             return True
         elif event.keyval == Gdk.KEY_Tab:
             # Move focus to next cell on Tab
-            if col < 19:  # Not last column
-                self.cells[(row, col + 1)].grab_focus()
-            elif row < 49:  # Move to first column of next row
-                self.cells[(row + 1, 0)].grab_focus()
+            if col < last_col:  # Not last column
+                self.grid.focus_cell(row, col + 1)
+            elif row < last_row:  # Move to first column of next row
+                self.grid.focus_cell(row + 1, 0)
             return True
         elif event.keyval == Gdk.KEY_Up:
             if row > 0:  # Not first row
-                self.cells[(row - 1, col)].grab_focus()
+                self.grid.focus_cell(row - 1, col)
             return True
         elif event.keyval == Gdk.KEY_Down:
-            if row < 49:  # Not last row
-                self.cells[(row + 1, col)].grab_focus()
+            if row < last_row:  # Not last row
+                self.grid.focus_cell(row + 1, col)
             return True
         elif event.keyval == Gdk.KEY_Left:
             if col > 0:  # Not first column
-                self.cells[(row, col - 1)].grab_focus()
+                self.grid.focus_cell(row, col - 1)
             return True
         elif event.keyval == Gdk.KEY_Right:
-            if col < 19:  # Not last column
-                self.cells[(row, col + 1)].grab_focus()
+            if col < last_col:  # Not last column
+                self.grid.focus_cell(row, col + 1)
+            return True
+        elif event.keyval in (Gdk.KEY_Page_Up, Gdk.KEY_Page_Down):
+            # Move by the number of rows in view
+            page = self.grid.page_rows()
+            if event.keyval == Gdk.KEY_Page_Up:
+                self.grid.focus_cell(max(0, row - page), col)
+            else:
+                self.grid.focus_cell(min(last_row, row + page), col)
+            return True
+        elif event.keyval == Gdk.KEY_Home and control:
+            self.grid.focus_cell(0, 0)
+            return True
+        elif event.keyval == Gdk.KEY_End and control:
+            # Jump to the last row and column holding anything
+            cells = self.model.populated()
+            self.grid.focus_cell(max((r for r, _ in cells), default=0), max((c for _, c in cells), default=0))
             return True
         return False
 
@@ -637,9 +864,8 @@ class StickyNoteWindow(Gtk.Window):
         """Handle cell clicks"""
         if event.type == Gdk.EventType.BUTTON_PRESS:
             # If we're editing a formula and clicked another cell, insert cell reference
-            if self.active_formula_cell and self.active_formula_cell != (row, col):
-                active_row, active_col = self.active_formula_cell
-                active_entry = self.cells[self.active_formula_cell]
+            active_entry = self.cells.get(self.active_formula_cell)
+            if active_entry is not None and self.active_formula_cell != (row, col):
                 formula = active_entry.get_text()
                 cell_ref = self.cell_to_ref(row, col)
                 
@@ -651,10 +877,10 @@ class StickyNoteWindow(Gtk.Window):
                 return True
             
             # Show formula if cell has one
-            elif (row, col) in self.formulas and not self.is_displaying_formula:
+            elif self.model.formula((row, col)) and not self.is_displaying_formula:
                 self.updating_cell = True
                 self.is_displaying_formula = True
-                entry.set_text(self.formulas[(row, col)])
+                entry.set_text(self.model.formula((row, col)))
                 entry.set_alignment(0.0)  # Left align formulas
                 self.updating_cell = False
                 # Set cursor at end of formula
@@ -664,45 +890,16 @@ class StickyNoteWindow(Gtk.Window):
 
     def on_cell_focus_in(self, entry, event, row, col):
         """Handle cell focus in - show formula if cell has one"""
-        if (row, col) in self.formulas and not self.is_displaying_formula:
+        if self.model.formula((row, col)) and not self.is_displaying_formula:
             self.updating_cell = True
             self.is_displaying_formula = True
-            entry.set_text(self.formulas[(row, col)])
+            entry.set_text(self.model.formula((row, col)))
             entry.set_alignment(0.0)  # Left align formulas
             self.updating_cell = False
             # Set cursor at end of formula
             entry.set_position(-1)
         return False
 
-    def find_dependencies(self, formula):
-        """Extract all cell references from a formula and return them as a list of (row, col) tuples"""
-        if not formula.startswith('='):
-            return []
-        cell_refs = re.findall(r'[A-T][1-9][0-9]?', formula)
-        dependencies = []
-        for ref in cell_refs:
-            cell_pos = self.ref_to_cell(ref)
-            if cell_pos:
-                dependencies.append(cell_pos)
-        return dependencies
-
-    def update_dependencies(self, row, col, formula):
-        """Update the cell_dependencies dictionary with new dependencies"""
-        # Remove this cell from all dependency lists
-        for deps in self.cell_dependencies.values():
-            if (row, col) in deps:
-                deps.remove((row, col))
-        
-        # Find new dependencies
-        dependencies = self.find_dependencies(formula)
-        
-        # Add this cell to the dependency lists of its dependencies
-        for dep_row, dep_col in dependencies:
-            if (dep_row, dep_col) not in self.cell_dependencies:
-                self.cell_dependencies[(dep_row, dep_col)] = []
-            if (row, col) not in self.cell_dependencies[(dep_row, dep_col)]:
-                self.cell_dependencies[(dep_row, dep_col)].append((row, col))
-
     def set_numeric_alignment(self, entry, value):
         """Set entry alignment based on whether the value is numeric"""
         try:
@@ -713,31 +910,230 @@ class StickyNoteWindow(Gtk.Window):
 
     def update_dependent_cells(self, row, col):
         """Update all cells that depend on the cell at (row, col)"""
-        if (row, col) not in self.cell_dependencies:
+        self.render_cells(self.model.recalculate([(row, col)]))
+
+class CalcGrid(Gtk.Layout):
+    """Calc grid that only creates widgets for the cells in view.
+
+    The layout is sized to the whole sheet so grid_scroll scrolls it
+    natively, but only a pool of entries large enough to cover the viewport
+    exists. When the view scrolls, entries whose cells left the view are
+    moved and rebound to the cells that entered it, so the widget count
+    stays constant however large the sheet is.
+    """
+
+    MARGIN = 10
+
+    def __init__(self, window, rows, cols):
+        super().__init__()
+        self.window = window
+        self.rows = rows
+        self.cols = cols
+        self.entries = {}  # cell -> entry currently showing it
+        self.bindings = {}  # entry -> cell it shows
+        self.spare_entries = []  # Pooled entries not bound to a cell
+        self.column_labels = {}  # col -> header label
+        self.row_labels = {}  # row -> header label
+        self.spare_labels = []
+        self.visible = None  # (first_row, last_row, first_col, last_col) in view
+        self.set_can_focus(True)
+        self.set_hexpand(True)
+        self.set_vexpand(True)
+
+        # Every cell has the size of an entry ten characters wide
+        probe = Gtk.Entry()
+        probe.set_width_chars(10)
+        self.cell_width = probe.get_preferred_width()[1] + 1
+        self.cell_height = probe.get_preferred_height()[1] + 1
+        self.set_dimensions(rows, cols)
+
+        self.connect('notify::hadjustment', self.on_adjustment_set)
+        self.connect('notify::vadjustment', self.on_adjustment_set)
+
+    def set_dimensions(self, rows, cols):
+        """Size the layout for a rows x cols sheet and rebind the view"""
+        self.rows = rows
+        self.cols = cols
+        # The row header is as wide as the longest row number
+        probe = Gtk.Label(label=str(rows))
+        self.header_width = probe.get_preferred_width()[1] + 8
+        self.header_height = probe.get_preferred_height()[1] + 4
+        self.set_size(2 * self.MARGIN + self.header_width + cols * self.cell_width,
+                      2 * self.MARGIN + self.header_height + rows * self.cell_height)
+
+        # Cells may have moved or left the sheet, so place every widget again
+        for entry in list(self.entries.values()):
+            self.release_entry(entry)
+        for labels in (self.column_labels, self.row_labels):
+            for label in labels.values():
+                label.hide()
+                self.spare_labels.append(label)
+            labels.clear()
+        self.visible = None
+        self.refresh()
+
+    def page_rows(self):
+        """Return how many rows fit in the viewport"""
+        if self.visible is None:
+            return 1
+        return max(1, self.visible[1] - self.visible[0])
+
+    def on_adjustment_set(self, layout, pspec):
+        adjustment = self.get_property(pspec.name)
+        if adjustment is not None:
+            adjustment.connect('value-changed', self.on_view_changed)
+            adjustment.connect('changed', self.on_view_changed)
+
+    def on_view_changed(self, adjustment):
+        self.refresh()
+
+    def cell_position(self, row, col):
+        """Return the layout coordinates of the top-left corner of a cell"""
+        return (self.MARGIN + self.header_width + col * self.cell_width,
+                self.MARGIN + self.header_height + row * self.cell_height)
+
+    def visible_range(self):
+        """Return (first_row, last_row, first_col, last_col) covered by the viewport"""
+        hadjustment = self.get_hadjustment()
+        vadjustment = self.get_vadjustment()
+        if hadjustment is None or vadjustment is None or vadjustment.get_page_size() <= 0:
+            return None
+        left = hadjustment.get_value() - self.MARGIN - self.header_width
+        top = vadjustment.get_value() - self.MARGIN - self.header_height
+        return (
+            max(0, int(top // self.cell_height)),
+            min(self.rows - 1, int((top + vadjustment.get_page_size()) // self.cell_height)),
+            max(0, int(left // self.cell_width)),
+            min(self.cols - 1, int((left + hadjustment.get_page_size()) // self.cell_width)),
+        )
+
+    def refresh(self):
+        """Rebind pooled widgets to the cells and headers now in view"""
+        visible = self.visible_range()
+        if visible is None or visible == self.visible:
             return
-            
-        # Get all cells that depend on this cell
-        dependent_cells = self.cell_dependencies[(row, col)][:]  # Create a copy to avoid modification issues
-        
-        # Update each dependent cell
-        for dep_row, dep_col in dependent_cells:
-            # Only update if it still has a formula
-            if (dep_row, dep_col) in self.formulas:
-                self.updating_cell = True
-                formula = self.formulas[(dep_row, dep_col)]
-                result = self.evaluate_formula(formula, (dep_row, dep_col))
-                self.cells[(dep_row, dep_col)].set_text(result)
-                # Ensure numeric results are right-aligned
-                self.set_numeric_alignment(self.cells[(dep_row, dep_col)], result)
-                self.updating_cell = False
-                # Recursively update cells that depend on this dependent cell
-                self.update_dependent_cells(dep_row, dep_col)
+        self.visible = visible
+        first_row, last_row, first_col, last_col = visible
+        rows = range(first_row, last_row + 1)
+        cols = range(first_col, last_col + 1)
+
+        # Recycle entries whose cells left the view, then bind the new cells
+        for cell, entry in list(self.entries.items()):
+            if cell[0] not in rows or cell[1] not in cols:
+                self.release_entry(entry)
+        for row in rows:
+            for col in cols:
+                if (row, col) not in self.entries:
+                    entry = self.spare_entries.pop() if self.spare_entries else self.create_entry()
+                    self.bind_entry(entry, (row, col))
+
+        for index, labels in ((1, self.column_labels), (0, self.row_labels)):
+            wanted = cols if index else rows
+            for key in [key for key in labels if key not in wanted]:
+                label = labels.pop(key)
+                label.hide()
+                self.spare_labels.append(label)
+            for key in wanted:
+                if key not in labels:
+                    labels[key] = self.bind_label(key, index)
+
+    def create_entry(self):
+        entry = Gtk.Entry()
+        entry.set_width_chars(10)
+        entry.set_size_request(self.cell_width - 1, self.cell_height - 1)
+        entry.set_no_show_all(True)
+        entry.connect('changed', self.forward, self.window.on_cell_changed)
+        entry.connect('key-press-event', self.forward, self.window.on_cell_key_press)
+        entry.connect('button-press-event', self.forward, self.window.on_cell_clicked)
+        entry.connect('focus-out-event', self.forward, self.window.on_cell_focus_out)
+        entry.connect('focus-in-event', self.forward, self.window.on_cell_focus_in)
+        self.put(entry, 0, 0)
+        return entry
+
+    def forward(self, entry, *args):
+        """Call a StickyNoteWindow cell handler with the cell entry is bound to"""
+        *args, handler = args
+        cell = self.bindings.get(entry)
+        if cell is None:
+            return False
+        return handler(entry, *args, *cell)
+
+    def bind_entry(self, entry, cell):
+        self.bindings[entry] = cell
+        self.entries[cell] = entry
+        self.move(entry, *self.cell_position(*cell))
+        self.window.render_cells([cell])
+        entry.show()
+
+    def release_entry(self, entry):
+        if entry.is_focus():
+            # Commit whatever is being edited before the entry changes cells
+            self.grab_focus()
+        del self.entries[self.bindings.pop(entry)]
+        entry.hide()
+        self.spare_entries.append(entry)
+
+    def bind_label(self, key, is_column):
+        if self.spare_labels:
+            label = self.spare_labels.pop()
+        else:
+            label = Gtk.Label()
+            label.set_no_show_all(True)
+            self.put(label, 0, 0)
+        style = label.get_style_context()
+        if is_column:
+            style.remove_class("row-header")
+            style.add_class("column-header")
+            label.set_label(column_name(key))
+            label.set_size_request(self.cell_width - 1, self.header_height)
+            x, y = self.cell_position(0, key)
+            self.move(label, x, self.MARGIN)
+        else:
+            style.remove_class("column-header")
+            style.add_class("row-header")
+            label.set_label(str(key + 1))
+            label.set_size_request(self.header_width, self.cell_height - 1)
+            x, y = self.cell_position(key, 0)
+            self.move(label, self.MARGIN, y)
+        label.show()
+        return label
+
+    def focus_cell(self, row, col):
+        """Scroll a cell into view and give its entry keyboard focus"""
+        x, y = self.cell_position(row, col)
+        hadjustment = self.get_hadjustment()
+        vadjustment = self.get_vadjustment()
+        if hadjustment is not None and vadjustment is not None:
+            hadjustment.clamp_page(x - self.header_width, x + self.cell_width)
+            vadjustment.clamp_page(y - self.header_height, y + self.cell_height)
+        self.refresh()
+        entry = self.entries.get((row, col))
+        if entry is not None:
+            entry.grab_focus()
+
+def note_row(entry):
+    """Return the model row for a manifest entry"""
+    return [entry['file'], entry['name'], entry['mode'], entry['mtime'], entry['size'], entry['preview']]
+
+def note_list_model(entries, visible):
+    """Return the Note Manager model for entries, and the store iter of each note by filename.
+
+    A Gtk.ListStore holds one row per note; a filter on top shows the
+    files for which visible(file) is true, and a Gtk.TreeModelSort on top
+    of that sorts by whichever column the view asks for. The view renders
+    only the rows scrolled into sight, so no widgets are made per note.
+    """
+    store = Gtk.ListStore(*NOTE_COLUMN_TYPES)
+    iters = {entry['file']: store.append(note_row(entry)) for entry in entries}
+    filtered = store.filter_new()
+    filtered.set_visible_func(lambda model, it, data: visible(model.get_value(it, NOTE_FILE)))
+    return Gtk.TreeModelSort(model=filtered), iters
 
 class NoteManagerDialog(Gtk.Window):
     def __init__(self, parent):
         super().__init__(title="Note Manager")
         self.parent = parent
-        self.set_default_size(400, 600)
+        self.set_default_size(600, 600)
         self.set_transient_for(parent)  # Make it stay on top of parent
         self.set_type_hint(Gdk.WindowTypeHint.DIALOG)  # Keep dialog appearance
         
@@ -772,8 +1168,34 @@ class NoteManagerDialog(Gtk.Window):
         new_note_button.get_style_context().add_class("new-note-button")  
         new_note_button.connect('clicked', self.on_new_note_clicked)
         new_note_box.pack_end(new_note_button, False, False, 0)
+
+        # Rescan the directory for notes changed outside this app
+        refresh_button = Gtk.Button()
+        refresh_image = Gtk.Image.new_from_icon_name("view-refresh-symbolic", Gtk.IconSize.BUTTON)
+        refresh_button.add(refresh_image)
+        refresh_button.set_tooltip_text("Rescan Notes")
+        refresh_button.connect('clicked', self.on_refresh_clicked)
+        new_note_box.pack_end(refresh_button, False, False, 5)
+
+        # Delete the selected note
+        self.delete_button = Gtk.Button()
+        delete_image = Gtk.Image.new_from_icon_name("user-trash-symbolic", Gtk.IconSize.BUTTON)
+        self.delete_button.add(delete_image)
+        self.delete_button.set_tooltip_text("Delete Note")
+        self.delete_button.get_style_context().add_class("delete-button")
+        self.delete_button.set_sensitive(False)
+        self.delete_button.connect('clicked', self.on_delete_clicked)
+        new_note_box.pack_end(self.delete_button, False, False, 0)
         
         vbox.pack_start(new_note_box, False, False, 0)
+
+        # Search box filtering the list by note content
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text("Search notes")
+        self.search_entry.set_margin_start(10)
+        self.search_entry.set_margin_end(10)
+        self.search_entry.connect('search-changed', self.on_search_changed)
+        vbox.pack_start(self.search_entry, False, False, 0)
         
         # Create list box for notes with styling
         scrolled = Gtk.ScrolledWindow()
@@ -781,86 +1203,183 @@ class NoteManagerDialog(Gtk.Window):
         scrolled.set_vexpand(True)
         scrolled.set_valign(Gtk.Align.FILL)
         
-        self.list_box = Gtk.ListBox()
-        self.list_box.set_selection_mode(Gtk.SelectionMode.NONE)
-        self.list_box.set_margin_top(10)
-        self.list_box.set_margin_bottom(10)
-        self.list_box.set_margin_start(10)
-        self.list_box.set_margin_end(10)
-        scrolled.add(self.list_box)
+        # Fixed-height rows are measured and drawn only as they scroll into view
+        self.tree_view = Gtk.TreeView()
+        self.tree_view.set_fixed_height_mode(True)
+        self.tree_view.set_enable_search(False)
+        self.tree_view.set_margin_top(10)
+        self.tree_view.set_margin_bottom(10)
+        self.tree_view.set_margin_start(10)
+        self.tree_view.set_margin_end(10)
+        columns = [
+            ("Name", NOTE_NAME, 140, None),
+            ("Mode", NOTE_MODE, 60, None),
+            ("Modified", NOTE_MTIME, 130, self.render_mtime),
+            ("Size", NOTE_SIZE, 70, self.render_size),
+            ("Preview", NOTE_PREVIEW, 160, None),
+        ]
+        for title, column_id, width, render in columns:
+            renderer = Gtk.CellRendererText(ellipsize=Pango.EllipsizeMode.END)
+            column = Gtk.TreeViewColumn(title, renderer)
+            if render is None:
+                column.add_attribute(renderer, 'text', column_id)
+            else:
+                column.set_cell_data_func(renderer, render)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(width)
+            column.set_resizable(True)
+            column.set_sort_column_id(column_id)  # Click the header to sort by it
+            self.tree_view.append_column(column)
+        column.set_expand(True)  # The preview takes the remaining width
+        self.tree_view.connect('row-activated', self.on_row_activated)
+        self.tree_view.connect('key-press-event', self.on_tree_key_press)
+        self.tree_view.get_selection().connect('changed', self.on_selection_changed)
+        scrolled.add(self.tree_view)
         
         vbox.pack_start(scrolled, True, True, 0)
         
+        self.model = None  # The sorted model shown by the view
+        self.rows = {}  # Store iters by filename
+        self.sort_order = (NOTE_NAME, Gtk.SortType.ASCENDING)
+        self.matches = None  # Filenames matching the search, or None to show all
+
         # Connect delete event
         self.connect("delete-event", self.on_delete_event)
+        self.connect("destroy", self.on_destroy)
         
+        manifest.load()
         self.refresh_notes()
         self.show_all()
 
+        # Follow notes added, changed or removed by other processes, a burst at a time
+        self.changed_files = set()
+        self.watch_timer = None
+        self.burst_started = 0
+        self.scanning = False
+        self.monitor = Gio.File.new_for_path(manifest.directory).monitor_directory(
+            Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self.monitor.connect('changed', self.on_directory_changed)
+
+    @perf.timed('refresh_notes')
     def refresh_notes(self):
-        # Clear existing items
-        for child in self.list_box.get_children():
-            self.list_box.remove(child)
-        
-        # List all .enc files
-        for file in os.listdir('.'):
-            if file.endswith('.enc') and not file.startswith('.'):
-                row = Gtk.ListBoxRow()
-                row.set_margin_top(5)
-                row.set_margin_bottom(5)
-                
-                hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-                hbox.set_margin_start(10)
-                hbox.set_margin_end(10)
-                hbox.set_margin_top(10)
-                hbox.set_margin_bottom(10)
-                
-                # Note name as button
-                name = file[:-4]  # Remove .enc
-                name_button = Gtk.Button(label=name)
-                name_button.get_style_context().add_class("flat")
-                name_button.set_halign(Gtk.Align.START)
-                name_button.connect('clicked', self.on_open_clicked, file)
-                hbox.pack_start(name_button, True, True, 0)
-                
-                # Delete button
-                delete_button = Gtk.Button()
-                delete_image = Gtk.Image.new_from_icon_name("user-trash-symbolic", Gtk.IconSize.BUTTON)
-                delete_button.add(delete_image)
-                delete_button.get_style_context().add_class("delete-button")
-                delete_button.connect('clicked', self.on_delete_clicked, file)
-                hbox.pack_end(delete_button, False, False, 0)
-                
-                row.add(hbox)
-                self.list_box.add(row)
-        
-        self.show_all()
-    
-    def on_open_clicked(self, button, filename):
-        with open(filename, 'rb') as f:
-            encrypted_content = f.read()
-        decrypted_content = cipher_suite.decrypt(encrypted_content).decode()
-        
-        # Try to parse as JSON (new format)
+        # Build a new model for every note known to the manifest and swap it in,
+        # keeping the sort order the user chose
+        if self.model is not None:
+            column_id, order = self.model.get_sort_column_id()
+            if column_id is not None:
+                self.sort_order = (column_id, order)
+        self.update_matches()
+        self.model, self.rows = note_list_model(manifest.list_entries(), self.is_visible)
+        self.model.set_sort_column_id(*self.sort_order)
+        self.tree_view.set_model(self.model)
+
+    def apply_changes(self, changes):
+        """Add, update or remove the rows of the notes in {filename: entry or None}"""
+        store = self.model.get_model().get_model()
+        for file, entry in changes.items():
+            it = self.rows.get(file)
+            if entry is None:
+                if it is not None:
+                    store.remove(self.rows.pop(file))
+            elif it is None:
+                self.rows[file] = store.append(note_row(entry))
+            else:
+                store[it] = note_row(entry)
+
+    def update_matches(self):
+        query = self.search_entry.get_text().strip()
+        self.matches = set(search_notes(query)) if query else None
+
+    def is_visible(self, file):
+        return self.matches is None or file in self.matches
+
+    def render_mtime(self, column, renderer, model, it, data):
+        mtime = model.get_value(it, NOTE_MTIME)
+        renderer.set_property('text', time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime / 1e9)))
+
+    def render_size(self, column, renderer, model, it, data):
+        renderer.set_property('text', GLib.format_size(model.get_value(it, NOTE_SIZE)))
+
+    def selected_file(self):
+        model, it = self.tree_view.get_selection().get_selected()
+        return model.get_value(it, NOTE_FILE) if it is not None else None
+
+    def on_search_changed(self, entry):
+        self.update_matches()
+        self.model.get_model().refilter()
+
+    def on_directory_changed(self, monitor, file, other_file, event_type):
+        names = {f.get_basename() for f in (file, other_file) if f is not None}
+        names = {name for name in names if is_note_file(name)}
+        if not names:
+            return  # Temporary files, journals and the manifest itself
+        self.changed_files |= names
+        if not self.scanning:
+            self.schedule_scan()
+
+    def schedule_scan(self):
+        """Update the list once events stop arriving, or at the latest WATCH_MAX_DELAY_MS after the first"""
+        now = GLib.get_monotonic_time()
+        if self.watch_timer is None:
+            self.burst_started = now
+        elif (now - self.burst_started) // 1000 < WATCH_MAX_DELAY_MS:
+            GLib.source_remove(self.watch_timer)
+        else:
+            return  # Due already; leave the timer running
+        self.watch_timer = GLib.timeout_add(WATCH_QUIET_MS, self.on_watch_timeout)
+
+    def on_watch_timeout(self):
+        self.watch_timer = None
+        files, self.changed_files = self.changed_files, set()
+        self.scanning = True
+        # Decrypting the changed notes can take a while after a bulk import
+        threading.Thread(target=self.scan_files, args=(files,), name='note-scan', daemon=True).start()
+        return False
+
+    def scan_files(self, files):
+        try:
+            changes = manifest.refresh(files)
+        except Exception as e:
+            logging.error(f"Cannot refresh the note manifest: {e}")
+            changes = {}
         try:
-            note_data = json.loads(decrypted_content)
-            self.parent._load_note_data(note_data)
-        except json.JSONDecodeError:
-            # Old format - just text content
-            buffer = self.parent.text_view.get_buffer()
-            buffer.set_text(decrypted_content)
-            # Switch to text mode if needed
-            if self.parent.mode != 'text':
-                self.parent.mode = 'text'
-                self.parent.content_box.remove(self.parent.grid_scroll)
-                self.parent.content_box.add(self.parent.text_scroll)
-                self.parent.text_scroll.show_all()
-                self.parent.mode_image.set_from_icon_name("view-grid-symbolic", Gtk.IconSize.BUTTON)
-
-        self.parent.update_title(filename[:-4])  # Remove .enc
+            search_index.refresh(files)
+        except Exception as e:
+            logging.error(f"Cannot refresh the search index: {e}")
+        GLib.idle_add(self.on_scan_done, changes)
+
+    def on_scan_done(self, changes):
+        self.scanning = False
+        if self.monitor is None:
+            return False  # Closed while scanning
+        self.apply_changes(changes)
+        if self.changed_files:
+            self.schedule_scan()  # Events that arrived during the scan
+        return False
+
+    def on_refresh_clicked(self, button):
+        manifest.reconcile()
+        search_index.reconcile()
+        self.refresh_notes()
+    
+    def on_row_activated(self, tree_view, path, column):
+        filename = self.model.get_value(self.model.get_iter(path), NOTE_FILE)
+        self.parent.open_note(filename, self.parent.note_opened)
         self.destroy()
+
+    def on_tree_key_press(self, widget, event):
+        if event.keyval == Gdk.KEY_Delete and self.selected_file() is not None:
+            self.on_delete_clicked(self.delete_button)
+            return True
+        return False
+
+    def on_selection_changed(self, selection):
+        self.delete_button.set_sensitive(self.selected_file() is not None)
     
-    def on_delete_clicked(self, button, filename):
+    def on_delete_clicked(self, button):
+        filename = self.selected_file()
+        if filename is None:
+            return
         dialog = Gtk.MessageDialog(
             transient_for=self,
             flags=0,
@@ -873,8 +1392,9 @@ class NoteManagerDialog(Gtk.Window):
         response = dialog.run()
 
         if response == Gtk.ResponseType.OK:
-            os.remove(filename)
-            self.refresh_notes()
+            delete_note_file(filename)
+            if filename in self.rows:
+                self.model.get_model().get_model().remove(self.rows.pop(filename))
         dialog.destroy()
     
     def on_new_note_clicked(self, button):
@@ -885,8 +1405,76 @@ class NoteManagerDialog(Gtk.Window):
         self.destroy()
         return True
 
+    def on_destroy(self, widget):
+        self.monitor.cancel()
+        self.monitor = None
+        if self.watch_timer is not None:
+            GLib.source_remove(self.watch_timer)
+            self.watch_timer = None
+
+def lock_notes():
+    """Save pending edits, forget the key and the decrypted note cache, then ask to unlock again.
+
+    Every window is hidden while locked; cancelling the passphrase quits.
+    """
+    windows = [window for window in Gtk.Window.list_toplevels()
+               if isinstance(window, (StickyNoteWindow, NoteManagerDialog)) and window.get_visible()]
+    for window in windows:
+        if isinstance(window, StickyNoteWindow):
+            window.finish_autosave()
+        window.hide()
+    autosave_worker.flush()  # The writer thread cannot ask for the passphrase
+    key_cache.lock()
+    try:
+        key_cache.cipher()
+    except KeyLockedError:
+        Gtk.main_quit()
+        return
+    for window in windows:
+        window.show()
+
+
+def ask_passphrase(attempt):
+    """Ask for the notes passphrase; return None if the user cancels"""
+    dialog = Gtk.Dialog(title="Unlock Sticky Notes", flags=0)
+    dialog.add_buttons(
+        Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+        "Unlock", Gtk.ResponseType.OK
+    )
+
+    content_area = dialog.get_content_area()
+    content_area.set_margin_start(10)
+    content_area.set_margin_end(10)
+    content_area.set_margin_top(10)
+    content_area.set_margin_bottom(10)
+    content_area.set_spacing(10)
+
+    message = "Wrong passphrase, try again:" if attempt else "Enter the passphrase for your notes:"
+    content_area.add(Gtk.Label(label=message))
+    entry = Gtk.Entry()
+    entry.set_visibility(False)
+    entry.set_activates_default(True)  # Make Enter unlock
+    content_area.add(entry)
+
+    dialog.set_default_response(Gtk.ResponseType.OK)
+    dialog.show_all()
+    response = dialog.run()
+    passphrase = entry.get_text()
+    dialog.destroy()
+    return passphrase if response == Gtk.ResponseType.OK else None
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    perf.start()
+    # The writer thread cannot ask for a passphrase, so unlock up front;
+    # every window then shares the cached key
+    key_cache.passphrase_provider = ask_passphrase
+    if key_cache.passphrase_mode():
+        try:
+            key_cache.cipher()
+        except KeyLockedError:
+            raise SystemExit(1)
     win = StickyNoteWindow()
     win.connect("destroy", Gtk.main_quit)
     win.show_all()
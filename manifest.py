@@ -0,0 +1,223 @@
+"""Encrypted index of the notes in the notes directory"""
+
+import json
+import logging
+import os
+import threading
+
+from storage import (add_note_listener, cipher_suite, is_note_file, load_note_file, pack_frame, unpack_frames,
+                     write_atomic)
+
+MANIFEST_FILE = '.manifest.enc'
+PREVIEW_LENGTH = 60
+COMPACT_MIN_BYTES = 64 * 1024  # Appended updates below this never trigger compaction
+
+
+def summarize_note(note_data):
+    """Return (mode, preview) describing note data"""
+    mode = note_data.get('mode', 'text')
+    if mode == 'calc':
+        cells = note_data.get('calc_data', {}).get('cells', {})
+        content = ' '.join(value for value in list(cells.values())[:10])
+    else:
+        content = note_data.get('text_content', '')[:PREVIEW_LENGTH * 4]
+    # Strip whitespace and replace newlines with spaces
+    content = ' '.join(content.split())
+    return mode, content[:PREVIEW_LENGTH]
+
+
+class NoteManifest:
+    """Name, mode, size, mtime and preview of every note, stored encrypted.
+
+    Entries are updated incrementally as notes are saved and deleted, so
+    the Note Manager reads one small file instead of listing and
+    decrypting the directory. reconcile() rebuilds it from a stat pass,
+    decrypting only notes whose size or mtime changed behind its back.
+
+    Like the search index, the file is a snapshot frame followed by one
+    encrypted frame per changed entry, compacted into a fresh snapshot once
+    the appended frames outgrow it.
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, MANIFEST_FILE)
+        self.entries = {}  # filename -> entry dict
+        self.loaded = False
+        self._snapshot_bytes = 0
+        self._log_bytes = 0  # Bytes of update frames appended since the snapshot
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Read the manifest once; build it from the directory if it is missing"""
+        from cryptography.fernet import InvalidToken
+
+        with self._lock:
+            if self.loaded:
+                return
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                if data.startswith(b'gAAAA'):
+                    # Written whole as a single token before it became a log
+                    self.entries = json.loads(cipher_suite.decrypt(data))['entries']
+                    self._log_bytes = COMPACT_MIN_BYTES + len(data)
+                    self.loaded = True
+                    return
+                frames = unpack_frames(data)
+                snapshot = next(frames)
+                self.entries = json.loads(cipher_suite.decrypt(snapshot))['entries']
+            except FileNotFoundError:
+                self.reconcile()
+                return
+            except Exception as e:
+                logging.error(f"Manifest unreadable, rebuilding: {e}")
+                self.reconcile()
+                return
+            self._snapshot_bytes = len(snapshot) + 4
+            self._log_bytes = 0
+            for frame in frames:
+                try:
+                    record = json.loads(cipher_suite.decrypt(frame))
+                except (InvalidToken, ValueError):
+                    # A torn or corrupt update ends the log; compaction drops it
+                    self._log_bytes = COMPACT_MIN_BYTES + self._snapshot_bytes
+                    break
+                if record['entry'] is None:
+                    self.entries.pop(record['file'], None)
+                else:
+                    self.entries[record['file']] = record['entry']
+                self._log_bytes += len(frame) + 4
+            self.loaded = True
+
+    def save(self):
+        """Write a fresh snapshot, folding in every appended update"""
+        with self._lock:
+            data = json.dumps({'version': 2, 'entries': self.entries}).encode()
+            frame = pack_frame(cipher_suite.encrypt(data))
+            write_atomic(self.path, frame)
+            self._snapshot_bytes = len(frame)
+            self._log_bytes = 0
+
+    def _append(self, filenames):
+        """Persist the current entries of some files as update frames"""
+        if self._log_bytes > max(COMPACT_MIN_BYTES, self._snapshot_bytes) or not os.path.exists(self.path):
+            self.save()
+            return
+        frames = b''
+        for filename in filenames:
+            record = {'file': filename, 'entry': self.entries.get(filename)}
+            frames += pack_frame(cipher_suite.encrypt(json.dumps(record).encode()))
+        with open(self.path, 'ab') as f:
+            f.write(frames)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_bytes += len(frames)
+
+    def list_entries(self):
+        """Return the entries sorted by name"""
+        with self._lock:
+            return sorted(self.entries.values(), key=lambda entry: entry['name'].lower())
+
+    def filename_for(self, path):
+        """Return the manifest key for path, or None if it is not a note of this directory"""
+        directory, filename = os.path.split(os.path.abspath(path))
+        if directory != self.directory or not is_note_file(filename):
+            return None
+        return filename
+
+    def make_entry(self, filename, note_data, stat):
+        mode, preview = summarize_note(note_data)
+        return {
+            'file': filename,
+            'name': filename[:-4],  # Remove .enc
+            'mode': mode,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'preview': preview,
+        }
+
+    def on_note_changed(self, path, note_data):
+        """Storage listener: record a saved note or forget a deleted one"""
+        filename = self.filename_for(path)
+        if filename is None:
+            return
+        with self._lock:
+            if not self.loaded:
+                self.load()
+            if note_data is None:
+                if self.entries.pop(filename, None) is None:
+                    return
+            else:
+                entry = self.make_entry(filename, note_data, os.stat(path))
+                if self.entries.get(filename) == entry:
+                    return  # A journal append that left the preview as it was
+                self.entries[filename] = entry
+            self._append([filename])
+
+    def _update_entry(self, filename, stat):
+        """Re-read the entry of filename if its size or mtime changed; return whether it did"""
+        entry = self.entries.get(filename)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return False
+        try:
+            note_data = load_note_file(os.path.join(self.directory, filename))
+        except Exception as e:
+            logging.error(f"Cannot read {filename}: {e}")
+            note_data = {'mode': 'unknown'}
+        self.entries[filename] = self.make_entry(filename, note_data, stat)
+        return True
+
+    def refresh(self, filenames):
+        """Bring the entries of some files in line with the directory.
+
+        Like reconcile() for just those files, so a watcher reporting a few
+        changes does not list the whole directory. Returns {filename: entry}
+        for each note, with None for notes that no longer exist.
+        """
+        with self._lock:
+            self.load()
+            changes = {}
+            changed = []
+            for filename in filenames:
+                if not is_note_file(filename):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    if self.entries.pop(filename, None) is not None:
+                        changed.append(filename)
+                    changes[filename] = None
+                    continue
+                if self._update_entry(filename, stat):
+                    changed.append(filename)
+                changes[filename] = self.entries[filename]
+            if changed:
+                self._append(changed)
+            return changes
+
+    def reconcile(self):
+        """Bring the manifest in line with the directory using stat information"""
+        with self._lock:
+            changed = not self.loaded
+            present = set()
+            for filename in os.listdir(self.directory):
+                if not is_note_file(filename):
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                present.add(filename)
+                changed = self._update_entry(filename, stat) or changed
+            for filename in set(self.entries) - present:
+                del self.entries[filename]
+                changed = True
+            self.loaded = True
+            if changed:
+                self.save()
+
+
+manifest = NoteManifest()
+add_note_listener(manifest.on_note_changed)
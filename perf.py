@@ -0,0 +1,150 @@
+"""Opt-in latency histograms, byte counters and profiling of the hot paths.
+
+Enabled by the STICKY_PERF environment variable:
+
+    STICKY_PERF=1 python3 main.py        # histograms and counters
+    STICKY_PERF=profile python3 main.py  # also cProfile the session
+
+The summary is written to stderr on exit and whenever the process receives
+SIGUSR1. While disabled, timed() hands functions back undecorated and
+count() does nothing, so instrumented code runs exactly as before.
+"""
+
+import atexit
+import cProfile
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+
+MODE = os.environ.get('STICKY_PERF', '')
+ENABLED = MODE not in ('', '0')
+PROFILE_FILE = os.environ.get('STICKY_PERF_PROFILE', 'sticky-perf.prof')
+BUCKETS = 32  # Bucket i holds durations below 2**i microseconds
+
+_histograms = {}  # name -> Histogram
+_counters = {}  # name -> total
+_lock = threading.Lock()
+_profiler = None
+# Set by the SIGUSR1 handler: it interrupts the main thread, possibly inside
+# record() with _lock held, so the summary is written from another thread
+_dump_requested = threading.Event()
+
+
+class Histogram:
+    """Log2-bucketed latencies; cheap to update, accurate to a factor of two"""
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Return the upper bound in ms of the bucket holding that fraction of samples"""
+        target = fraction * self.count
+        seen = 0
+        for bucket, samples in enumerate(self.buckets):
+            seen += samples
+            if samples and seen >= target:
+                return min((1 << bucket) / 1000, self.max * 1000)
+        return self.max * 1000
+
+
+def record(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def timed(name):
+    """Decorator recording each call of a function into the histogram name"""
+    if not ENABLED:
+        return lambda function: function
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def _ignore(name, amount=1):
+    pass
+
+
+count = _count if ENABLED else _ignore
+
+
+def summary():
+    """Return the histograms and counters as a table"""
+    with _lock:
+        lines = [f"{'timer':<24} {'calls':>8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for name, histogram in sorted(_histograms.items()):
+            if not histogram.count:
+                continue
+            lines.append(f"{name:<24} {histogram.count:>8} {histogram.total / histogram.count * 1000:>9.3f} "
+                         f"{histogram.percentile(0.5):>9.3f} {histogram.percentile(0.99):>9.3f} "
+                         f"{histogram.max * 1000:>9.3f}")
+        for name, total in sorted(_counters.items()):
+            lines.append(f"{name:<24} {total:>8}")
+    return '\n'.join(lines)
+
+
+def dump(file=None):
+    print(summary(), file=file or sys.stderr)
+
+
+def _dump_on_request():
+    while True:
+        _dump_requested.wait()
+        _dump_requested.clear()
+        dump()
+
+
+def start():
+    """Install the exit and SIGUSR1 dumps and start profiling, if enabled"""
+    global _profiler
+    if not ENABLED:
+        return
+    atexit.register(stop)
+    if hasattr(signal, 'SIGUSR1'):
+        threading.Thread(target=_dump_on_request, name='perf-dump', daemon=True).start()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: _dump_requested.set())
+    if MODE == 'profile':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def stop():
+    """Write the summary, and the profile if one is running"""
+    global _profiler
+    dump()
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(PROFILE_FILE)
+        print(f"Profile written to {PROFILE_FILE}", file=sys.stderr)
+        _profiler = None
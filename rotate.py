@@ -0,0 +1,267 @@
+"""Re-encrypt every note and index under a new key.
+
+Run from the notes directory while the app is closed:
+
+    python3 rotate.py [--workers N] [--threads] [--passphrase [--unlock-seconds S]]
+
+A new key is written to key.key.new, or with --passphrase derived from a
+new passphrase whose scrypt parameters go to key.scrypt.new, and every
+encrypted file is rotated to it with MultiFernet, token by token, without
+decompressing or parsing the notes. Each file is replaced atomically and
+recorded in a checkpoint, so an interrupted rotation picks up where it
+stopped when run again, which must be with the same kind of key. The key
+files are only replaced once every file has been rotated.
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import getpass
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+from manifest import MANIFEST_FILE
+from search import INDEX_FILE
+from storage import (_CHUNK_PREFIX, _HEADER, _HEADER_V2, FORMAT_MAGIC, FORMAT_MAGIC_V2, KEY_FILE, KEY_PARAMS_FILE,
+                     NOTE_SUFFIX, UNLOCK_TARGET_SECONDS, atomic_writer, calibrate_scrypt, key_cache,
+                     make_key_params, pack_frame, read_key_params, unlock_key, write_atomic)
+
+NEW_KEY_FILE = KEY_FILE + '.new'
+NEW_KEY_PARAMS_FILE = KEY_PARAMS_FILE + '.new'
+CHECKPOINT_FILE = '.rotation.checkpoint'
+JOURNAL_SUFFIX = '.journal'
+CHECKPOINT_SYNC_EVERY = 100  # Completed files between checkpoint fsyncs
+
+_fernet = None  # MultiFernet of the new and old keys, per worker
+
+
+def key_fingerprint(key):
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def rotation_targets(directory='.'):
+    """Return the encrypted files of directory: notes, journals, manifest and index"""
+    targets = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(NOTE_SUFFIX) or filename.endswith(JOURNAL_SUFFIX):
+            targets.append(os.path.join(directory, filename))
+    return targets
+
+
+def rotate_token(token, raw=False):
+    """Re-encrypt one token under the new key; raw tokens are stored without base64"""
+    if raw:
+        return base64.urlsafe_b64decode(_fernet.rotate(base64.urlsafe_b64encode(token)))
+    return _fernet.rotate(token)
+
+
+def read_frame(f):
+    """Return the next length-prefixed token of f, or None at the end of the file.
+
+    Raises ValueError if the file ends inside a frame.
+    """
+    length = f.read(4)
+    if not length:
+        return None
+    if len(length) < 4:
+        raise ValueError("Truncated frame")
+    (length,) = struct.unpack('>I', length)
+    token = f.read(length)
+    if len(token) < length:
+        raise ValueError("Truncated frame")
+    return token
+
+
+def rotate_note(f, out):
+    """Rotate the chunks of a note, raising ValueError if the file is cut short"""
+    magic = f.read(len(FORMAT_MAGIC))
+    if magic not in (FORMAT_MAGIC, FORMAT_MAGIC_V2):
+        # Original format: the whole file is one token
+        out.write(rotate_token(magic + f.read()))
+        return
+    header_struct = _HEADER if magic == FORMAT_MAGIC else _HEADER_V2
+    header = f.read(header_struct.size)
+    if len(header) < header_struct.size:
+        raise ValueError("Truncated note file")
+    out.write(magic + header)
+    raw = magic == FORMAT_MAGIC
+    final = False
+    while not final:
+        token = read_frame(f)
+        if token is None:
+            # Cut at a frame boundary: every frame is whole but the last is missing
+            raise ValueError("Truncated note file")
+        if raw:
+            token = base64.urlsafe_b64encode(token)
+        plaintext = _fernet.decrypt(token)
+        final = _CHUNK_PREFIX.unpack_from(plaintext)[2]
+        token = _fernet.encrypt(plaintext)
+        out.write(pack_frame(base64.urlsafe_b64decode(token) if raw else token))
+    if f.read(1):
+        raise ValueError("Data after the final chunk")
+
+
+def rotate_log(f, out):
+    """Rotate a log of frames, dropping a torn or unreadable tail as its readers do"""
+    while True:
+        try:
+            token = read_frame(f)
+            if token is None:
+                return
+            token = rotate_token(token)
+        except (ValueError, InvalidToken):
+            return
+        out.write(pack_frame(token))
+
+
+def rotate_file(path):
+    """Rotate one file in place; return (path, bytes, error message or None)"""
+    filename = os.path.basename(path)
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f, atomic_writer(path) as out:
+            if filename == MANIFEST_FILE and f.peek(1)[:1] != b'\x00':
+                out.write(rotate_token(f.read()))  # Written whole before it became a log
+            elif filename in (MANIFEST_FILE, INDEX_FILE) or filename.endswith(JOURNAL_SUFFIX):
+                rotate_log(f, out)
+            else:
+                rotate_note(f, out)
+        return path, size, None
+    except FileNotFoundError:
+        return path, 0, None  # Deleted since it was listed
+    except Exception as e:
+        return path, 0, str(e) or type(e).__name__
+
+
+def init_worker(new_key, old_key):
+    global _fernet
+    _fernet = MultiFernet([Fernet(new_key), Fernet(old_key)])
+
+
+def load_new_key(passphrase=False, unlock_seconds=UNLOCK_TARGET_SECONDS):
+    """Return the key this rotation moves to, creating it on the first run"""
+    # Files an interrupted rotation already moved to its key can only be read with
+    # that key, so it has to be finished before a rotation of the other kind starts
+    pending = NEW_KEY_FILE if passphrase else NEW_KEY_PARAMS_FILE
+    if os.path.exists(pending):
+        option = "without" if passphrase else "with"
+        raise ValueError(f"An interrupted rotation to {pending} is pending; "
+                         f"rerun {option} --passphrase to finish it first")
+    if not passphrase:
+        if os.path.exists(NEW_KEY_FILE):
+            with open(NEW_KEY_FILE, 'rb') as f:
+                return f.read()
+        new_key = Fernet.generate_key()
+        write_atomic(NEW_KEY_FILE, new_key)
+        return new_key
+    if os.path.exists(NEW_KEY_PARAMS_FILE):
+        return unlock_key(getpass.getpass("New passphrase: "), read_key_params(NEW_KEY_PARAMS_FILE))
+    passphrase = getpass.getpass("New passphrase: ")
+    if passphrase != getpass.getpass("Repeat new passphrase: "):
+        raise ValueError("Passphrases do not match")
+    new_key, params = make_key_params(passphrase, calibrate_scrypt(unlock_seconds))
+    logging.info(f"scrypt n={params['n']} r={params['r']} p={params['p']}")
+    write_atomic(NEW_KEY_PARAMS_FILE, json.dumps(params).encode())
+    return new_key
+
+
+def install_new_key(passphrase=False):
+    """Make the rotated-to key the one the app unlocks"""
+    if passphrase:
+        os.replace(NEW_KEY_PARAMS_FILE, KEY_PARAMS_FILE)
+        old_file = KEY_FILE
+    else:
+        os.replace(NEW_KEY_FILE, KEY_FILE)
+        old_file = KEY_PARAMS_FILE
+    try:
+        os.remove(old_file)
+    except FileNotFoundError:
+        pass
+
+
+def load_checkpoint(new_key):
+    """Return the files already rotated to new_key by an interrupted run"""
+    try:
+        with open(CHECKPOINT_FILE) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return set()
+    if not lines or json.loads(lines[0]).get('key') != key_fingerprint(new_key):
+        return set()  # Left behind by a rotation to another key
+    return set(lines[1:])
+
+
+def rotate_directory(workers=None, use_threads=False, passphrase=False,
+                     unlock_seconds=UNLOCK_TARGET_SECONDS):
+    """Rotate every encrypted file of the current directory; return the failed paths"""
+    old_key = key_cache.key()
+    new_key = load_new_key(passphrase, unlock_seconds)
+    done = load_checkpoint(new_key)
+    if not done:
+        write_atomic(CHECKPOINT_FILE, (json.dumps({'key': key_fingerprint(new_key)}) + '\n').encode())
+    targets = [path for path in rotation_targets() if path not in done]
+    logging.info(f"Rotating {len(targets)} files, {len(done)} already done")
+
+    executor_class = (concurrent.futures.ThreadPoolExecutor if use_threads
+                      else concurrent.futures.ProcessPoolExecutor)
+    failed = []
+    total_bytes = 0
+    start = time.perf_counter()
+    with open(CHECKPOINT_FILE, 'a') as checkpoint, \
+            executor_class(max_workers=workers, initializer=init_worker,
+                           initargs=(new_key, old_key)) as executor:
+        chunksize = 1 if use_threads else 16
+        for count, (path, size, error) in enumerate(executor.map(rotate_file, targets, chunksize=chunksize), 1):
+            if error is not None:
+                logging.error(f"Cannot rotate {path}: {error}")
+                failed.append(path)
+                continue
+            total_bytes += size
+            checkpoint.write(path + '\n')
+            if count % CHECKPOINT_SYNC_EVERY == 0:
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                logging.info(f"{count}/{len(targets)} files rotated")
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    elapsed = time.perf_counter() - start
+
+    rotated = len(targets) - len(failed)
+    print(f"Rotated {rotated} files, {total_bytes / 1e6:.1f} MB in {elapsed:.2f} s: "
+          f"{rotated / max(elapsed, 1e-9):.0f} files/s, {total_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s")
+    if failed:
+        print(f"{len(failed)} files failed; the key is unchanged and a rerun resumes the rotation")
+        return failed
+    install_new_key(passphrase)
+    os.remove(CHECKPOINT_FILE)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of workers (default: one per CPU)")
+    parser.add_argument('--threads', action='store_true',
+                        help="use a thread pool instead of worker processes")
+    parser.add_argument('--passphrase', action='store_true',
+                        help="derive the new key from a passphrase instead of storing it in key.key")
+    parser.add_argument('--unlock-seconds', type=float, default=UNLOCK_TARGET_SECONDS,
+                        help="scrypt cost as the time one unlock takes on this machine")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        failed = rotate_directory(args.workers, args.threads, args.passphrase, args.unlock_seconds)
+    except ValueError as e:
+        sys.exit(f"Cannot rotate: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Formula evaluation in worker processes with CPU time and memory limits.
+
+Formulas whose cost has no bound, such as =9**9**9, are evaluated here
+instead of on the thread that owns the sheet. Each worker process runs one
+evaluation at a time under RLIMIT_CPU and RLIMIT_AS; a worker that exceeds
+its CPU time is killed by the kernel (or by its pool thread, should it
+outlive the wall-clock backstop) and replaced before the next evaluation.
+Workers are spawned on first use and reused afterwards.
+"""
+
+import concurrent.futures
+import logging
+import math
+import multiprocessing
+import queue
+import threading
+
+try:
+    import resource
+except ImportError:  # No rlimits on this platform; only the wall-clock timeout applies
+    resource = None
+
+SANDBOX_WORKERS = 2
+CPU_SECONDS = 1  # CPU time one evaluation may use
+MEMORY_BYTES = 256 << 20  # Address space one evaluation may add
+STARTUP_SECONDS = 10  # Time a new worker has to import calc
+WALL_MARGIN_SECONDS = 1  # Extra wall-clock time before an evaluation is killed from outside
+
+# Evaluation outcomes: (OK, number), (ERROR, message) or (TIMEOUT, None)
+OK = 'ok'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+
+def _address_space():
+    """Return the current virtual memory size of this process, or 0 if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _worker_main(conn, cpu_seconds, memory_bytes):
+    """Evaluate (formula text, arguments) jobs from conn until it closes"""
+    from calc import compile_formula  # Imported before the memory limit is set
+
+    if resource is not None:
+        limit = _address_space() + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    conn.send((OK, None))
+    while True:
+        try:
+            text, args = conn.recv()
+        except EOFError:
+            return
+        if resource is not None:
+            # RLIMIT_CPU counts the life of the process, so it moves on with each job.
+            # SIGXCPU keeps its default action and ends the process even inside a C call.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = usage.ru_utime + usage.ru_stime
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            resource.setrlimit(resource.RLIMIT_CPU, (math.ceil(used + cpu_seconds), hard))
+        try:
+            outcome = (OK, float(compile_formula(text).call(args)))
+        except Exception as e:
+            outcome = (ERROR, str(e) or type(e).__name__)
+        conn.send(outcome)
+
+
+class SandboxPool:
+    """Small reusable pool of worker processes evaluating formulas under limits.
+
+    submit() returns a concurrent.futures.Future that always completes with
+    an (outcome, value) pair; the evaluation never raises into the caller.
+    One thread per worker feeds it jobs and kills it when it overruns.
+    """
+
+    def __init__(self, workers=SANDBOX_WORKERS, cpu_seconds=CPU_SECONDS, memory_bytes=MEMORY_BYTES):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        # Spawned, not forked: the parent may be a GTK process with threads
+        self._context = multiprocessing.get_context('spawn')
+
+    def submit(self, text, args):
+        """Queue the formula text for evaluation with its argument values"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'sandbox-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._jobs.put((future, text, args))
+        return future
+
+    def evaluate(self, text, args):
+        """Evaluate the formula text and wait for its (outcome, value)"""
+        return self.submit(text, args).result()
+
+    def _spawn(self):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child, self.cpu_seconds, self.memory_bytes),
+                                        daemon=True)
+        process.start()
+        child.close()
+        if not parent.poll(STARTUP_SECONDS):
+            process.kill()
+            raise OSError("Sandbox worker did not start")
+        parent.recv()
+        return process, parent
+
+    def _run(self):
+        process = conn = None
+        while True:
+            future, text, args = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue  # The cell changed again before this job started
+            try:
+                if process is None or not process.is_alive():
+                    process, conn = self._spawn()
+                conn.send((text, args))
+                # A worker killed for its CPU time closes the pipe, which wakes poll too
+                if not conn.poll(self.cpu_seconds + WALL_MARGIN_SECONDS):
+                    raise TimeoutError
+                outcome = conn.recv()
+            except Exception as e:
+                # EOFError and OSError (TimeoutError included) mean the worker overran or died
+                logging.info("Sandboxed evaluation of %s stopped: %s", text, e or type(e).__name__)
+                if process is not None:
+                    process.kill()
+                    process.join()
+                process = conn = None
+                outcome = (TIMEOUT, None) if isinstance(e, (EOFError, OSError)) else (ERROR, str(e))
+            future.set_result(outcome)
+
+
+pool = SandboxPool()
@@ -0,0 +1,279 @@
+"""Encrypted full-text search index over all notes"""
+
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+
+from storage import (add_note_listener, cipher_suite, is_note_file, load_note_file, note_stamp, pack_frame,
+                     unpack_frames, write_atomic)
+
+INDEX_FILE = '.search-index.enc'
+MAX_TERM_LENGTH = 64
+COMPACT_MIN_BYTES = 256 * 1024  # Appended updates below this never trigger compaction
+TERM = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Return the lower-cased search terms of text, in order"""
+    return [term for term in TERM.findall(text.lower()) if len(term) <= MAX_TERM_LENGTH]
+
+
+def unique_terms(text):
+    """Return the set of lower-cased terms of text without listing every occurrence"""
+    return {term for term in (match.group().lower() for match in TERM.finditer(text))
+            if len(term) <= MAX_TERM_LENGTH}
+
+
+def note_terms(note_data):
+    """Return the set of terms a note can be found by: its text and calc cell values"""
+    terms = unique_terms(note_data.get('text_content', ''))
+    for value in note_data.get('calc_data', {}).get('cells', {}).values():
+        terms |= unique_terms(value)
+    return terms
+
+
+class SearchIndex:
+    """Inverted index from terms to note filenames, stored encrypted.
+
+    Saved and deleted notes update the index through the storage listener
+    hook, so a query only ever reads the index and never decrypts notes.
+    Only the per-note term lists are persisted; postings are rebuilt from
+    them when the index is loaded.
+
+    The file is a snapshot frame followed by one small encrypted frame per
+    note update, so an update appends a few hundred bytes instead of
+    rewriting the whole index. Once the appended frames outgrow the
+    snapshot, the index is compacted into a fresh snapshot.
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, INDEX_FILE)
+        self.documents = {}  # filename -> set of terms
+        self.stamps = {}  # filename -> note_stamp() when it was indexed
+        self.postings = {}  # term -> set of filenames
+        self.loaded = False
+        self._sorted_terms = None  # Sorted postings keys for prefix lookups
+        self._snapshot_bytes = 0
+        self._log_bytes = 0  # Bytes of update frames appended since the snapshot
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Read the index once and bring it in line with the directory; build it if it is missing"""
+        from cryptography.fernet import InvalidToken
+
+        with self._lock:
+            if self.loaded:
+                return
+            try:
+                with open(self.path, 'rb') as f:
+                    frames = unpack_frames(f.read())
+                    token = next(frames)
+                    snapshot = json.loads(cipher_suite.decrypt(token))
+            except FileNotFoundError:
+                self.rebuild()
+                return
+            except Exception as e:
+                logging.error(f"Search index unreadable, rebuilding: {e}")
+                self.rebuild()
+                return
+            self.documents = {}
+            self.stamps = snapshot.get('stamps', {})  # Version 2 had none, so every note is reindexed
+            self.postings = {}
+            for filename, terms in snapshot['documents'].items():
+                self._add(filename, set(terms))
+            self._snapshot_bytes = len(token) + 4
+            self._log_bytes = 0
+            for frame in frames:
+                try:
+                    record = json.loads(cipher_suite.decrypt(frame))
+                except (InvalidToken, ValueError):
+                    # A torn or corrupt update ends the log; compaction drops it
+                    self._log_bytes = COMPACT_MIN_BYTES + self._snapshot_bytes
+                    break
+                self._remove(record['file'])
+                if record['terms'] is not None:
+                    self._add(record['file'], set(record['terms']))
+                    self.stamps[record['file']] = record.get('stamp')
+                self._log_bytes += len(frame) + 4
+            self.loaded = True
+            self.reconcile()
+
+    def save(self):
+        """Write a fresh snapshot, folding in every appended update"""
+        with self._lock:
+            documents = {filename: sorted(terms) for filename, terms in self.documents.items()}
+            data = json.dumps({'version': 3, 'documents': documents, 'stamps': self.stamps}).encode()
+            frame = pack_frame(cipher_suite.encrypt(data))
+            write_atomic(self.path, frame)
+            self._snapshot_bytes = len(frame)
+            self._log_bytes = 0
+
+    def _append(self, filenames):
+        """Persist the current terms of some notes as update frames"""
+        if self._log_bytes > max(COMPACT_MIN_BYTES, self._snapshot_bytes) or not os.path.exists(self.path):
+            self.save()
+            return
+        frames = b''
+        for filename in filenames:
+            terms = self.documents.get(filename)
+            record = {'file': filename, 'terms': sorted(terms) if terms is not None else None,
+                      'stamp': self.stamps.get(filename)}
+            frames += pack_frame(cipher_suite.encrypt(json.dumps(record).encode()))
+        with open(self.path, 'ab') as f:
+            f.write(frames)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_bytes += len(frames)
+
+    def _add(self, filename, terms):
+        self.documents[filename] = terms
+        for term in terms:
+            self.postings.setdefault(term, set()).add(filename)
+        self._sorted_terms = None
+
+    def _remove(self, filename):
+        self.stamps.pop(filename, None)
+        for term in self.documents.pop(filename, ()):
+            filenames = self.postings.get(term)
+            if filenames is not None:
+                filenames.discard(filename)
+                if not filenames:
+                    del self.postings[term]
+        self._sorted_terms = None
+
+    def update(self, filename, note_data):
+        """Index a saved note in memory, replacing its previous terms"""
+        return self.update_terms(filename, note_terms(note_data))
+
+    def update_terms(self, filename, terms, stamp=None):
+        """Index a note by terms already extracted, e.g. by a worker process.
+
+        The note is stamped as it is on disk now unless stamp is given.
+        """
+        with self._lock:
+            terms = set(terms)
+            if stamp is None:
+                stamp = note_stamp(os.path.join(self.directory, filename))
+            if self.documents.get(filename) == terms:
+                # Kept in memory only: a stale stamp on disk costs one reindex on the next load
+                self.stamps[filename] = stamp
+                return False
+            self._remove(filename)
+            self._add(filename, terms)
+            self.stamps[filename] = stamp
+            return True
+
+    def remove(self, filename):
+        """Drop a deleted note in memory"""
+        with self._lock:
+            if filename not in self.documents:
+                return False
+            self._remove(filename)
+            return True
+
+    def _reindex(self, filename):
+        """Index filename again if it changed on disk since it was indexed; return whether its terms did"""
+        path = os.path.join(self.directory, filename)
+        stamp = note_stamp(path)
+        if stamp is None:
+            return self.remove(filename)
+        if filename in self.documents and self.stamps.get(filename) == stamp:
+            return False
+        try:
+            terms = note_terms(load_note_file(path))
+        except Exception as e:
+            logging.error(f"Cannot index {filename}: {e}")
+            terms = set()  # Not retried until the file changes again
+        return self.update_terms(filename, terms, stamp)
+
+    def refresh(self, filenames):
+        """Reindex the notes among filenames that were written or deleted behind the index's back"""
+        with self._lock:
+            self.load()
+            changed = [filename for filename in filenames if is_note_file(filename) and self._reindex(filename)]
+            if changed:
+                self._append(changed)
+
+    def reconcile(self):
+        """Bring the whole index in line with the directory using stat information"""
+        with self._lock:
+            if not self.loaded:
+                self.load()  # Which reconciles once read
+                return
+            present = {filename for filename in os.listdir(self.directory) if is_note_file(filename)}
+            changed = [filename for filename in sorted(present | set(self.documents)) if self._reindex(filename)]
+            if changed:
+                self._append(changed)
+
+    def on_note_changed(self, path, note_data):
+        """Storage listener: reindex a saved note or drop a deleted one"""
+        directory, filename = os.path.split(os.path.abspath(path))
+        if directory != self.directory or not is_note_file(filename):
+            return
+        with self._lock:
+            self.load()
+            if note_data is None:
+                changed = self.remove(filename)
+            else:
+                changed = self.update(filename, note_data)
+            if changed:
+                self._append([filename])
+
+    def rebuild(self):
+        """Index every note in the directory from scratch"""
+        with self._lock:
+            self.documents = {}
+            self.stamps = {}
+            self.postings = {}
+            self._sorted_terms = None
+            for filename in os.listdir(self.directory):
+                if is_note_file(filename):
+                    self._reindex(filename)
+            self.loaded = True
+            self.save()
+
+    def _prefix_matches(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = self._sorted_terms
+        matches = set()
+        for i in range(bisect.bisect_left(terms, prefix), len(terms)):
+            if not terms[i].startswith(prefix):
+                break
+            matches |= self.postings[terms[i]]
+        return matches
+
+    def search(self, query):
+        """Return the sorted filenames of notes matching every term of query.
+
+        The last term also matches as a prefix, so results narrow while the
+        user is still typing a word.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            self.load()
+            results = None
+            for position, term in enumerate(terms):
+                if position == len(terms) - 1:
+                    matches = self._prefix_matches(term)
+                else:
+                    matches = self.postings.get(term, set())
+                results = matches if results is None else results & matches
+                if not results:
+                    return []
+            return sorted(results)
+
+
+index = SearchIndex()
+add_note_listener(index.on_note_changed)
+
+
+def search_notes(query):
+    """Return the filenames of notes in the notes directory matching query"""
+    return index.search(query)
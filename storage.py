@@ -0,0 +1,1101 @@
+"""Encrypted note storage shared by every window"""
+
+import atexit
+import base64
+import codecs
+import collections
+import contextlib
+import getpass
+import itertools
+import json
+import logging
+import lzma
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import perf
+
+# cryptography is imported by the functions that need it rather than here:
+# it is a large share of startup time and a new text note never touches it
+
+KEY_FILE = 'key.key'
+KEY_PARAMS_FILE = 'key.scrypt'  # Present in passphrase mode instead of KEY_FILE
+KEY_CHECK = b'secure-sticky-notes'  # Encrypted with a derived key to verify the passphrase
+UNLOCK_TARGET_SECONDS = 0.5
+MAX_SCRYPT_N = 1 << 20  # 1 GiB of memory with r=8
+NOTE_SUFFIX = '.enc'
+SCRATCH_NOTE = '.note.enc'  # Where the first window without a named note keeps it
+
+# Chunked note format: magic, chunk size, a random file id and a codec byte,
+# followed by length-prefixed Fernet tokens stored as raw bytes rather than
+# base64. Each token holds the file id, its index and a final flag ahead of
+# up to CHUNK_SIZE bytes of the compressed plaintext stream: one line of
+# JSON metadata, then the UTF-8 text content. Version 2 files have no codec
+# byte, base64 tokens and an uncompressed stream.
+FORMAT_MAGIC = b'SSN\x03'
+FORMAT_MAGIC_V2 = b'SSN\x02'
+CHUNK_SIZE = 1 << 20
+TEXT_SLICE_CHARS = 256 * 1024  # Text is encoded this many characters at a time
+LOAD_PIECE_CHARS = 32 * 1024  # Text handed to the window per insertion while loading
+LOAD_AHEAD_PIECES = 8  # Pieces NoteLoader may read ahead of the window
+_HEADER = struct.Struct('>I16sB')
+_HEADER_V2 = struct.Struct('>I16s')
+_CHUNK_PREFIX = struct.Struct('>16sIB')
+
+# Compression applied before encryption; the codec is recorded per file
+CODECS = {'none': 0, 'zlib': 1, 'lzma': 2}
+DEFAULT_LEVELS = {'none': None, 'zlib': 6, 'lzma': 6}
+compression = ['zlib', 6]  # Codec and level of new saves, see set_compression()
+
+# Journaled saves append delta records to a hidden log next to the note.
+# Each snapshot carries a journal id and only records with that id extend
+# it; past this size the log is folded into a new snapshot. Writers pass
+# the id of the snapshot they wrote, so nobody journals onto another's.
+JOURNAL_COMPACT_BYTES = 1 << 20
+_journals = {}  # note path -> [journal_id, next_seq, valid_bytes, inode of the note]
+_journals_lock = threading.Lock()
+_scratch_notes = set()  # Scratch files claimed by windows of this process
+
+NOTE_CACHE_BYTES = 64 << 20  # Decrypted notes kept in memory for reopening
+
+# Called as listener(path, note_data) after a note is written, and as
+# listener(path, None) after it is deleted
+_note_listeners = []
+
+
+# Generate or load encryption key
+def get_or_create_key():
+    from cryptography.fernet import Fernet
+
+    if os.path.exists(KEY_FILE):
+        with open(KEY_FILE, 'rb') as f:
+            key = f.read()
+    else:
+        key = Fernet.generate_key()
+        with open(KEY_FILE, 'wb') as f:
+            f.write(key)
+    return key
+
+
+class KeyLockedError(Exception):
+    """The notes are passphrase protected and no passphrase was given"""
+
+
+class StaleJournalError(Exception):
+    """The note no longer holds the snapshot a journal append was made against"""
+
+
+def derive_key(passphrase, params):
+    """Derive a Fernet key from a passphrase with scrypt"""
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    kdf = Scrypt(salt=base64.b64decode(params['salt']), length=32,
+                 n=params['n'], r=params['r'], p=params['p'])
+    return base64.urlsafe_b64encode(kdf.derive(passphrase.encode()))
+
+
+def calibrate_scrypt(target_seconds=UNLOCK_TARGET_SECONDS, r=8, p=1):
+    """Return the largest scrypt cost that derives a key in about target_seconds here"""
+    params = {'salt': base64.b64encode(os.urandom(16)).decode(), 'n': 1 << 14, 'r': r, 'p': p}
+    start = time.perf_counter()
+    derive_key('calibration', params)
+    elapsed = time.perf_counter() - start
+    # Derivation time grows linearly with n
+    while params['n'] < MAX_SCRYPT_N and elapsed * 2 <= target_seconds:
+        params['n'] *= 2
+        elapsed *= 2
+    return {'n': params['n'], 'r': r, 'p': p}
+
+
+def make_key_params(passphrase, cost=None):
+    """Return (key, params) for a new passphrase; params are stored in KEY_PARAMS_FILE"""
+    from cryptography.fernet import Fernet
+
+    params = dict(cost or calibrate_scrypt())
+    params['kdf'] = 'scrypt'
+    params['salt'] = base64.b64encode(os.urandom(16)).decode()
+    key = derive_key(passphrase, params)
+    params['check'] = Fernet(key).encrypt(KEY_CHECK).decode()
+    return key, params
+
+
+def unlock_key(passphrase, params):
+    """Return the key params derive from passphrase, or raise ValueError if it is wrong"""
+    from cryptography.fernet import Fernet, InvalidToken
+
+    key = derive_key(passphrase, params)
+    try:
+        Fernet(key).decrypt(params['check'].encode())
+    except InvalidToken:
+        raise ValueError("Wrong passphrase")
+    return key
+
+
+def read_key_params(path=KEY_PARAMS_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def ask_passphrase_tty(attempt):
+    """Default passphrase prompt, for when the notes are opened from a terminal"""
+    if not sys.stdin.isatty():
+        return None
+    return getpass.getpass("Wrong passphrase, try again: " if attempt else "Passphrase: ")
+
+
+class KeyCache:
+    """The note key of this process, loaded or derived once and shared by every window.
+
+    In passphrase mode the key is derived on first use by asking
+    passphrase_provider(attempt) until it returns the right passphrase, or
+    None to give up.
+    """
+
+    def __init__(self):
+        self.passphrase_provider = ask_passphrase_tty
+        self._key = None
+        self._cipher = None
+        self._lock = threading.Lock()
+
+    def passphrase_mode(self):
+        return os.path.exists(KEY_PARAMS_FILE)
+
+    def cipher(self):
+        """Return the Fernet of the session key, unlocking it if needed"""
+        from cryptography.fernet import Fernet
+
+        with self._lock:
+            if self._cipher is None:
+                self._key = self._load()
+                self._cipher = Fernet(self._key)
+            return self._cipher
+
+    def key(self):
+        self.cipher()
+        return self._key
+
+    def _load(self):
+        if not self.passphrase_mode():
+            return get_or_create_key()
+        params = read_key_params()
+        for attempt in itertools.count():
+            passphrase = self.passphrase_provider(attempt)
+            if passphrase is None:
+                raise KeyLockedError("Notes are locked")
+            try:
+                return unlock_key(passphrase, params)
+            except ValueError:
+                logging.warning("Wrong passphrase")
+
+    def install(self, key):
+        """Use a key unlocked elsewhere, such as by the parent of a worker process"""
+        from cryptography.fernet import Fernet
+
+        with self._lock:
+            self._key = key
+            self._cipher = Fernet(key)
+
+    def lock(self):
+        """Forget the session key and the decrypted notes; the next use asks for the passphrase again"""
+        with self._lock:
+            self._key = None
+            self._cipher = None
+        note_cache.clear()
+
+
+key_cache = KeyCache()
+
+
+class SessionCipher:
+    """Fernet interface to the session key, safe to bind at import before unlocking"""
+
+    def encrypt(self, data):
+        perf.count('encrypt_bytes', len(data))
+        return key_cache.cipher().encrypt(data)
+
+    def decrypt(self, token, ttl=None):
+        perf.count('decrypt_bytes', len(token))
+        return key_cache.cipher().decrypt(token, ttl)
+
+
+cipher_suite = SessionCipher()
+
+
+def set_compression(codec, level=None):
+    """Choose the codec ('none', 'zlib' or 'lzma') and level of new saves"""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    compression[:] = [codec, DEFAULT_LEVELS[codec] if level is None else level]
+
+
+def make_compressor(codec, level):
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    return None
+
+
+def make_decompressor(codec_id):
+    if codec_id == CODECS['zlib']:
+        return zlib.decompressobj()
+    if codec_id == CODECS['lzma']:
+        return lzma.LZMADecompressor()
+    if codec_id == CODECS['none']:
+        return None
+    raise ValueError(f"Unknown compression codec id {codec_id}")
+
+
+def decompress_pieces(decompressor, data):
+    """Yield what data decompresses to in pieces of at most CHUNK_SIZE bytes.
+
+    A chunk of well compressed text can expand a thousandfold, so output is
+    bounded rather than inflated in one call.
+    """
+    is_lzma = isinstance(decompressor, lzma.LZMADecompressor)
+    while True:
+        piece = decompressor.decompress(data, CHUNK_SIZE)
+        if piece:
+            yield piece
+        if is_lzma:
+            # lzma keeps unread input itself and asks for more once it is used up
+            if decompressor.needs_input or decompressor.eof:
+                return
+            data = b''
+        else:
+            data = decompressor.unconsumed_tail
+            if not data and len(piece) < CHUNK_SIZE:
+                return
+
+
+def decode_note(encrypted_content):
+    """Decrypt and parse a single-token note, accepting the old plain-text format"""
+    decrypted_content = cipher_suite.decrypt(encrypted_content).decode()
+    try:
+        return json.loads(decrypted_content)
+    except json.JSONDecodeError:
+        # Old format - just text content
+        return {'mode': 'text', 'text_content': decrypted_content}
+
+
+@contextlib.contextmanager
+def atomic_writer(path):
+    """Open a temporary file that replaces path only once it is fully written"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def write_atomic(path, data):
+    """Write data to path so readers see either the old or the new file, never a mix"""
+    with atomic_writer(path) as f:
+        f.write(data)
+
+
+class ChunkWriter:
+    """Compresses and encrypts a byte stream into fixed-size authenticated chunks"""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE, codec=None, level=None):
+        if codec is None:
+            codec, level = compression
+        self.f = f
+        self.chunk_size = chunk_size
+        self.file_id = os.urandom(16)
+        self.index = 0
+        self.buffer = bytearray()
+        self.compressor = make_compressor(codec, level)
+        f.write(FORMAT_MAGIC + _HEADER.pack(chunk_size, self.file_id, CODECS[codec]))
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        while len(self.buffer) > self.chunk_size:
+            self._emit(bytes(self.buffer[:self.chunk_size]), False)
+            del self.buffer[:self.chunk_size]
+
+    def close(self):
+        """Write the remaining bytes as the final chunk"""
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush()
+            while len(self.buffer) > self.chunk_size:
+                self._emit(bytes(self.buffer[:self.chunk_size]), False)
+                del self.buffer[:self.chunk_size]
+        self._emit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+
+    def _emit(self, data, final):
+        prefix = _CHUNK_PREFIX.pack(self.file_id, self.index, final)
+        token = cipher_suite.encrypt(prefix + data)
+        self.f.write(pack_frame(base64.urlsafe_b64decode(token)))
+        self.index += 1
+
+
+def iter_chunks(f, magic=FORMAT_MAGIC):
+    """Yield the decrypted, decompressed chunks of a note file positioned after its magic.
+
+    Chunks are at most CHUNK_SIZE bytes once decompressed.
+    """
+    header_struct = _HEADER if magic == FORMAT_MAGIC else _HEADER_V2
+    header = f.read(header_struct.size)
+    if len(header) < header_struct.size:
+        raise ValueError("Truncated note file")
+    if magic == FORMAT_MAGIC:
+        chunk_size, file_id, codec_id = header_struct.unpack(header)
+        decompressor = make_decompressor(codec_id)
+    else:
+        chunk_size, file_id = header_struct.unpack(header)
+        decompressor = None
+    index = 0
+    while True:
+        length = f.read(4)
+        if len(length) < 4:
+            raise ValueError("Truncated note file")
+        (length,) = struct.unpack('>I', length)
+        token = f.read(length)
+        if len(token) < length:
+            raise ValueError("Truncated note file")
+        if magic == FORMAT_MAGIC:
+            token = base64.urlsafe_b64encode(token)
+        plaintext = cipher_suite.decrypt(token)
+        chunk_file_id, chunk_index, final = _CHUNK_PREFIX.unpack_from(plaintext)
+        if chunk_file_id != file_id or chunk_index != index:
+            raise ValueError("Note chunks out of order")
+        data = plaintext[_CHUNK_PREFIX.size:]
+        if decompressor is None:
+            yield data
+        else:
+            yield from decompress_pieces(decompressor, data)
+            if final and not decompressor.eof:
+                raise ValueError("Truncated compressed stream")
+        if final:
+            return
+        index += 1
+
+
+def write_note_stream(f, note_data, pieces=None):
+    """Write note data to an open file in the chunked format.
+
+    The text is taken from the iterable pieces instead of note_data when
+    given, so it never has to be held whole.
+    """
+    meta = {key: value for key, value in note_data.items() if key != 'text_content'}
+    writer = ChunkWriter(f)
+    writer.write(json.dumps(meta).encode() + b'\n')
+    if pieces is None:
+        text = note_data.get('text_content', '')
+        pieces = (text[start:start + TEXT_SLICE_CHARS] for start in range(0, len(text), TEXT_SLICE_CHARS))
+    for piece in pieces:
+        writer.write(piece.encode())
+    writer.close()
+
+
+class NoteReader:
+    """Streams a note file: its metadata first, then its text in bounded pieces.
+
+    Reads both chunked format versions as well as the original single-token
+    files.
+
+        with NoteReader(path) as reader:
+            reader.meta  # note data without text_content
+            for piece in reader.iter_text():
+                ...
+    """
+
+    def __init__(self, path, replay=True):
+        self.path = path
+        self.replay = replay  # Whether journaled edits are applied to the snapshot
+        self.meta = None
+        self.journal_id = None  # Set when later saves may append to the journal
+        self._file = None
+        self._chunks = None
+        self._text = ''  # Text of a single-token note, or bytes read past the metadata
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        try:
+            magic = self._file.read(len(FORMAT_MAGIC))
+            if magic in (FORMAT_MAGIC, FORMAT_MAGIC_V2):
+                self._chunks = iter_chunks(self._file, magic)
+                pending = b''
+                for chunk in self._chunks:
+                    pending += chunk
+                    if b'\n' in pending:
+                        break
+                meta, _, self._text = pending.partition(b'\n')
+                self.meta = json.loads(meta)
+                self.journal_id = self.meta.pop('journal_id', None)
+                if self.journal_id and self.replay:
+                    self._replay_journal()
+            else:
+                note_data = decode_note(magic + self._file.read())
+                self._text = note_data.pop('text_content', '')
+                self.meta = note_data
+        except BaseException:
+            # __exit__ only runs once __enter__ has returned
+            self._file.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def _replay_journal(self):
+        ops = read_journal(self.path, self.journal_id)
+        if not ops:
+            return
+        if any(op['op'] == 'text' for op in ops):
+            # Text edits address character offsets, so they need the whole text
+            note_data = self.read_note()
+            apply_journal_ops(note_data, ops)
+            self._chunks = None
+            self._text = note_data.pop('text_content')
+            self.meta = note_data
+        else:
+            apply_journal_ops(self.meta, ops)
+
+    def iter_text(self):
+        """Yield the text content piece by piece"""
+        if self._chunks is None:
+            text, self._text = self._text, ''
+            for start in range(0, len(text), TEXT_SLICE_CHARS):
+                yield text[start:start + TEXT_SLICE_CHARS]
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        pending, self._text = self._text, b''
+        if pending:
+            yield decoder.decode(pending)
+        for chunk in self._chunks:
+            piece = decoder.decode(chunk)
+            if piece:
+                yield piece
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def read_note(self):
+        """Return the whole note data, text included"""
+        note_data = dict(self.meta)
+        note_data['text_content'] = ''.join(self.iter_text())
+        return note_data
+
+    def tell(self):
+        """Return how many bytes of the file have been read"""
+        return self._file.tell()
+
+
+class NoteLoader:
+    """Decrypts a note on a background thread and hands it over in bounded pieces.
+
+    on_event(loader, kind, value) is called from the loader thread with
+    ('meta', note data without its text), then ('text', piece) for every
+    piece of at most LOAD_PIECE_CHARS characters, then ('done', None), or
+    ('error', exception) instead. Only LOAD_AHEAD_PIECES pieces are handed
+    over before the receiver calls consumed(), so however large the note,
+    the memory in flight stays bounded. cancel() stops the thread at the
+    next piece without further events.
+    """
+
+    def __init__(self, path, on_event):
+        self.path = path
+        self.journal_id = None  # Set from the reader once the metadata is read
+        self.progress = 0.0  # Fraction of the file read so far
+        self._on_event = on_event
+        self._cancelled = threading.Event()
+        self._window = threading.Semaphore(LOAD_AHEAD_PIECES)
+        self._thread = threading.Thread(target=self._run, name='note-loader', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def consumed(self):
+        """Let the thread read another piece ahead"""
+        self._window.release()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._window.release()  # Wake the thread if it waits for the receiver
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _run(self):
+        try:
+            cached = note_cache.get(self.path)
+            if cached is None:
+                finished = self._read()
+            else:
+                self.journal_id, note_data = cached
+                text = note_data.pop('text_content', '')
+                finished = not self.cancelled
+                if finished:
+                    self._on_event(self, 'meta', note_data)
+                    finished = self._hand_over(text, lambda start: start / max(1, len(text)))
+            if finished:
+                self.progress = 1.0
+                self._on_event(self, 'done', None)
+        except Exception as e:
+            if not self.cancelled:
+                self._on_event(self, 'error', e)
+
+    def _read(self):
+        """Decrypt the file, caching it once read if it fits; return False if cancelled"""
+        size = max(1, os.path.getsize(self.path))
+        stamp = note_stamp(self.path)
+        with NoteReader(self.path) as reader:
+            self.journal_id = reader.journal_id
+            if self.cancelled:
+                return False
+            meta = dict(reader.meta)
+            self._on_event(self, 'meta', reader.meta)
+            kept = []  # Text read so far, until it outgrows the cache
+            kept_chars = 0
+            for text in reader.iter_text():
+                if kept is not None:
+                    kept.append(text)
+                    kept_chars += len(text)
+                    if kept_chars > note_cache.max_bytes:
+                        kept = None
+                if not self._hand_over(text, lambda start: min(1.0, reader.tell() / size)):
+                    return False
+        if kept is not None:
+            note_cache.put(self.path, stamp, self.journal_id, dict(meta, text_content=''.join(kept)))
+        else:
+            note_cache.mark_oversized(self.path)
+        return not self.cancelled
+
+    def _hand_over(self, text, progress):
+        """Pass text on in pieces, waiting for room ahead; return False if cancelled"""
+        for start in range(0, len(text), LOAD_PIECE_CHARS):
+            self._window.acquire()
+            if self.cancelled:
+                return False
+            self.progress = progress(start)
+            self._on_event(self, 'text', text[start:start + LOAD_PIECE_CHARS])
+        return True
+
+
+class NoteCache:
+    """Recently opened notes, decrypted, shared by every window of the process.
+
+    Entries are keyed by absolute path and hold a note's metadata and text
+    as one UTF-8 bytearray; the least recently used go first once they
+    total more than max_bytes. Each remembers the inode, size and mtime of
+    the note and of its journal when it was read or written, and is dropped
+    when either has changed since. Dropped buffers are overwritten with
+    zeros, and clear() runs when the key is locked and at exit; strings
+    already handed to a window are beyond its reach.
+
+    Only notes opened through NoteLoader, saved or journaled are cached,
+    so scans such as the manifest's do not push them out.
+    """
+
+    def __init__(self, max_bytes=NOTE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # path -> (stamp, journal_id, buffer, meta length)
+        self._oversized = set()  # Paths last seen too large to cache
+        self._lock = threading.Lock()
+
+    def fits(self, path):
+        """Return False if the note at path was too large to cache when last offered"""
+        with self._lock:
+            return os.path.abspath(path) not in self._oversized
+
+    def get(self, path):
+        """Return (journal_id, note data) if path is cached and unchanged on disk, else None"""
+        key = os.path.abspath(path)
+        stamp = note_stamp(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                perf.count('note_cache_miss')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            perf.count('note_cache_hit')
+            _, journal_id, buffer, meta_length = entry
+            with memoryview(buffer) as view:
+                note_data = json.loads(str(view[:meta_length], 'utf-8'))
+                note_data['text_content'] = str(view[meta_length:], 'utf-8')
+        return journal_id, note_data
+
+    def put(self, path, stamp, journal_id, note_data):
+        """Cache note data that was read from or written to path when it had stamp"""
+        meta = {key: value for key, value in note_data.items() if key != 'text_content'}
+        buffer = bytearray(json.dumps(meta).encode())
+        meta_length = len(buffer)
+        text = note_data.get('text_content', '')
+        # UTF-8 takes at least a byte per character, so this is known before encoding
+        cacheable = stamp is not None and meta_length + len(text) <= self.max_bytes
+        if cacheable:
+            buffer += text.encode()
+            cacheable = len(buffer) <= self.max_bytes
+        key = os.path.abspath(path)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if not cacheable:
+                if stamp is not None:
+                    self._oversized.add(key)
+                _zero(buffer)
+                return
+            self._oversized.discard(key)
+            self._entries[key] = (stamp, journal_id, buffer, meta_length)
+            self.size += len(buffer)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def mark_oversized(self, path):
+        """Record that the note at path is too large to cache, as put() does for such notes"""
+        with self._lock:
+            key = os.path.abspath(path)
+            if key in self._entries:
+                self._drop(key)
+            self._oversized.add(key)
+
+    def discard(self, path):
+        with self._lock:
+            key = os.path.abspath(path)
+            self._oversized.discard(key)
+            if key in self._entries:
+                self._drop(key)
+
+    def clear(self):
+        """Zero and forget every entry"""
+        with self._lock:
+            self._oversized.clear()
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.size}
+
+    def _drop(self, key):
+        _, _, buffer, _ = self._entries.pop(key)
+        self.size -= len(buffer)
+        _zero(buffer)
+
+
+def _zero(buffer):
+    buffer[:] = bytes(len(buffer))
+
+
+note_cache = NoteCache()
+atexit.register(note_cache.clear)
+
+
+def note_stamp(path):
+    """Return what identifies the contents of path and its journal, or None if path is gone.
+
+    Stamps are lists so they compare equal after a round trip through JSON.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    try:
+        journal = os.stat(journal_path(path))
+        journal = [journal.st_ino, journal.st_size, journal.st_mtime_ns]
+    except FileNotFoundError:
+        journal = None
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns, journal]
+
+
+def is_note_file(filename):
+    """Return whether filename is a named note, as listed in the Note Manager"""
+    return filename.endswith(NOTE_SUFFIX) and not filename.startswith('.')
+
+
+def is_scratch_file(filename):
+    """Return whether filename holds the unnamed note of a window"""
+    return filename == SCRATCH_NOTE or (filename.startswith('.note-') and filename.endswith(NOTE_SUFFIX))
+
+
+def claim_scratch_note():
+    """Return a scratch file that no other window of this process autosaves to.
+
+    The first window gets SCRATCH_NOTE, later ones .note-2.enc and up.
+    """
+    with _journals_lock:
+        for number in itertools.count(1):
+            path = SCRATCH_NOTE if number == 1 else f".note-{number}{NOTE_SUFFIX}"
+            if path not in _scratch_notes:
+                _scratch_notes.add(path)
+                return path
+
+
+def release_scratch_note(path):
+    with _journals_lock:
+        _scratch_notes.discard(path)
+
+
+def add_note_listener(listener):
+    _note_listeners.append(listener)
+
+
+def _notify(path, note_data):
+    for listener in _note_listeners:
+        try:
+            listener(path, note_data)
+        except Exception as e:
+            logging.error(f"Note listener failed for {path}: {e}")
+
+
+def pack_frame(token):
+    """Prefix an encrypted token with its length for appending to a log file"""
+    return struct.pack('>I', len(token)) + token
+
+
+def unpack_frames(data):
+    """Yield the tokens of concatenated frames, stopping at a torn final frame"""
+    offset = 0
+    while offset + 4 <= len(data):
+        (length,) = struct.unpack_from('>I', data, offset)
+        if offset + 4 + length > len(data):
+            break
+        yield data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+
+
+def journal_path(path):
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, f".{filename}.journal")
+
+
+def apply_journal_ops(note_data, ops):
+    """Apply journal delta operations to note data in place.
+
+    Operations are {'op': 'text', 'start', 'end', 'text'} replacing a range
+    of characters, {'op': 'cell', 'cell': 'row,col', 'input'} setting or
+    clearing a calc cell, {'op': 'size', 'rows', 'cols'} resizing the sheet
+    and {'op': 'mode', 'mode'}.
+    """
+    for op in ops:
+        if op['op'] == 'text':
+            text = note_data.get('text_content', '')
+            note_data['text_content'] = text[:op['start']] + op['text'] + text[op['end']:]
+        elif op['op'] == 'cell':
+            calc_data = note_data.setdefault('calc_data', {})
+            cells = calc_data.setdefault('cells', {})
+            formulas = calc_data.setdefault('formulas', {})
+            key, value = op['cell'], op['input']
+            if value.startswith('='):
+                # The displayed result is recomputed when the sheet is loaded
+                formulas[key] = value
+                cells.pop(key, None)
+            else:
+                formulas.pop(key, None)
+                if value:
+                    cells[key] = value
+                else:
+                    cells.pop(key, None)
+        elif op['op'] == 'size':
+            calc_data = note_data.setdefault('calc_data', {})
+            calc_data['rows'], calc_data['cols'] = op['rows'], op['cols']
+            # Like CellModel.resize, drop the cells that no longer fit
+            for cells in (calc_data.setdefault('cells', {}), calc_data.setdefault('formulas', {})):
+                for key in list(cells):
+                    row, col = map(int, key.split(','))
+                    if row >= op['rows'] or col >= op['cols']:
+                        del cells[key]
+        elif op['op'] == 'mode':
+            note_data['mode'] = op['mode']
+
+
+def read_journal(path, journal_id):
+    """Return the operations journaled on top of snapshot journal_id.
+
+    Reading stops at the first torn, corrupt or foreign record; the next
+    append truncates the journal there.
+    """
+    from cryptography.fernet import InvalidToken
+
+    ops = []
+    seq = 0
+    valid_bytes = 0
+    try:
+        with open(journal_path(path), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = b''
+    for token in unpack_frames(data):
+        try:
+            record = json.loads(cipher_suite.decrypt(token))
+        except (InvalidToken, ValueError):
+            break
+        if record.get('journal') != journal_id or record.get('seq') != seq:
+            break
+        ops.extend(record['ops'])
+        seq += 1
+        valid_bytes += 4 + len(token)
+    with _journals_lock:
+        _journals[path] = [journal_id, seq, valid_bytes, os.stat(path).st_ino]
+    return ops
+
+
+def new_journal_id():
+    return uuid.uuid4().hex
+
+
+def _journal_state(path):
+    """Return the journal state of path, read again if another process replaced the note or wrote its journal"""
+    with _journals_lock:
+        state = _journals.get(path)
+    try:
+        journal_bytes = os.path.getsize(journal_path(path))
+    except FileNotFoundError:
+        journal_bytes = 0
+    if state is None or state[3] != os.stat(path).st_ino or state[2] != journal_bytes:
+        with NoteReader(path, replay=False) as reader:
+            if reader.journal_id is None:
+                raise ValueError(f"{path} has no journal")
+        read_journal(path, reader.journal_id)
+        with _journals_lock:
+            state = _journals[path]
+    return state
+
+
+@perf.timed('append_journal')
+def append_journal(path, ops, notify=True, journal_id=None):
+    """Append one delta record to the journal of path; return the journal size.
+
+    With journal_id, the operations are taken to extend that snapshot, and
+    StaleJournalError is raised if path holds another one by now, so the
+    caller writes a full snapshot instead.
+
+    Listeners are told about the note with the operations applied, rebuilt
+    from its cached data, or read once if it is not cached. Notes too large
+    for the cache are only reported when their journal is compacted.
+    """
+    cached = note_cache.get(path) if notify else None  # Before the append changes its stamp
+    state = _journal_state(path)
+    if journal_id is not None and state[0] != journal_id:
+        raise StaleJournalError(f"{path} was saved over since journal {journal_id} began")
+    journal_id, seq, valid_bytes, inode = state
+    record = {'journal': journal_id, 'seq': seq, 'ops': ops}
+    frame = pack_frame(cipher_suite.encrypt(json.dumps(record).encode()))
+    with open(journal_path(path), 'a+b') as f:
+        f.truncate(valid_bytes)  # Drop a torn record left by a crash
+        f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+    with _journals_lock:
+        _journals[path] = [journal_id, seq + 1, valid_bytes + len(frame), inode]
+    if notify:
+        if cached is not None:
+            note_data = cached[1]
+            apply_journal_ops(note_data, ops)
+        elif note_cache.fits(path):
+            with NoteReader(path) as reader:
+                note_data = reader.read_note()
+        else:
+            note_data = None
+        if note_data is not None:
+            note_cache.put(path, note_stamp(path), journal_id, note_data)
+            _notify(path, note_data)
+    return valid_bytes + len(frame)
+
+
+def journal_size(path):
+    with _journals_lock:
+        state = _journals.get(path)
+    return state[2] if state else 0
+
+
+@perf.timed('save_note_file')
+def save_note_file(path, note_data, notify=True, pieces=None, journal_id=None):
+    """Write a full snapshot of a note, starting a new empty journal; return its journal id.
+
+    With pieces, the text is streamed from them rather than note_data;
+    such notes are not cached and listeners get note_data as given.
+    """
+    journal_id = journal_id or new_journal_id()
+    with atomic_writer(path) as f:
+        write_note_stream(f, dict(note_data, journal_id=journal_id), pieces)
+    with _journals_lock:
+        _journals[path] = [journal_id, 0, 0, os.stat(path).st_ino]
+    try:
+        os.remove(journal_path(path))
+    except FileNotFoundError:
+        pass
+    if pieces is None:
+        # The window that saved it is the likeliest to open it again
+        note_cache.put(path, note_stamp(path), journal_id, note_data)
+    else:
+        note_cache.discard(path)
+    if notify:
+        _notify(path, note_data)
+    return journal_id
+
+
+def compact_note(path):
+    """Fold the journal of path into a new snapshot; return the old and new journal ids"""
+    cached = note_cache.get(path)
+    if cached is None:
+        with NoteReader(path) as reader:
+            cached = reader.journal_id, reader.read_note()
+    journal_id, note_data = cached
+    return journal_id, save_note_file(path, note_data)
+
+
+def delete_note_file(path):
+    os.remove(path)
+    try:
+        os.remove(journal_path(path))
+    except FileNotFoundError:
+        pass
+    with _journals_lock:
+        _journals.pop(path, None)
+    note_cache.discard(path)
+    _notify(path, None)
+
+
+@perf.timed('load_note_file')
+def load_note_file(path):
+    cached = note_cache.get(path)
+    if cached is not None:
+        return cached[1]
+    with NoteReader(path) as reader:
+        return reader.read_note()
+
+
+# Edit generations are unique across windows so they can be compared per path
+_generations = itertools.count(1)
+
+
+def new_generation():
+    return next(_generations)
+
+
+class AutosaveWorker:
+    """Serializes, encrypts and writes notes on a background thread.
+
+    Jobs are an optional full snapshot followed by journal operations made
+    after it, queued per path and written in order. A newer snapshot
+    replaces the jobs its window still has queued, while operations extend
+    the last job if it builds on the same snapshot, so a burst of edits
+    costs one write and no edit is lost. Each snapshot's journal id comes
+    from the window, which binds its operations to it; when windows save
+    over each other, the operations of the one overwritten fail with
+    StaleJournalError. Journals that outgrow JOURNAL_COMPACT_BYTES are
+    compacted on the same thread, and operations bound to a compacted
+    journal go on to its new one.
+    on_saved(path, generation, error) is called from the worker thread once
+    a job is on disk or has failed.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = {}  # path -> [[generation, note_data, ops, compact, journal_id, on_saved], ...]
+        self._saved = {}  # path -> newest generation written successfully
+        self._compacted = {}  # journal id -> id of the snapshot it was folded into
+        self._busy = False
+        self._thread = None
+
+    def submit(self, path, generation, note_data, on_saved, journal_id=None):
+        """Queue a full snapshot of a note, which starts journal journal_id"""
+        self._submit(path, [generation, note_data, [], False, journal_id, on_saved])
+
+    def submit_ops(self, path, generation, ops, on_saved, journal_id=None):
+        """Queue journal operations made since snapshot journal_id was queued or written"""
+        self._submit(path, [generation, None, list(ops), False, journal_id, on_saved])
+
+    def submit_compact(self, path, on_saved):
+        """Queue folding the journal of path into a new snapshot"""
+        self._submit(path, [0, None, [], True, None, on_saved])
+
+    def _submit(self, path, job):
+        with self._condition:
+            jobs = self._pending.setdefault(path, [])
+            last = jobs[-1] if jobs else None
+            if job[1] is not None:
+                # What the same window still has queued is superseded
+                jobs[:] = [pending for pending in jobs if pending[5] != job[5]]
+                jobs.append(job)
+            elif last is not None and (job[3] or last[4] == job[4]):
+                # Keep the queued snapshot and every operation made after it
+                last[0] = max(last[0], job[0])
+                last[2] = last[2] + job[2]
+                last[3] = last[3] or job[3]
+                if job[2]:
+                    last[5] = job[5]
+            else:
+                jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='autosave', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def saved_generation(self, path):
+        """Return the newest generation of path known to be on disk, or 0"""
+        with self._condition:
+            return self._saved.get(path, 0)
+
+    def flush(self):
+        """Block until every submitted snapshot has been written"""
+        with self._condition:
+            while self._pending or self._busy:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                path = next(iter(self._pending))
+                jobs = self._pending[path]
+                generation, note_data, ops, compact, journal_id, on_saved = jobs.pop(0)
+                if not jobs:
+                    del self._pending[path]
+                journal_id = self._compacted.get(journal_id, journal_id)
+                self._busy = True
+            try:
+                if note_data is not None:
+                    save_note_file(path, note_data, journal_id=journal_id)
+                if ops:
+                    append_journal(path, ops, journal_id=journal_id)
+                if journal_size(path) and (compact or journal_size(path) > JOURNAL_COMPACT_BYTES):
+                    folded, new_id = compact_note(path)
+                    with self._condition:
+                        for old_id, current in self._compacted.items():
+                            if current == folded:
+                                self._compacted[old_id] = new_id
+                        self._compacted[folded] = new_id
+                error = None
+            except Exception as e:
+                logging.error(f"Autosave of {path} failed: {e}")
+                error = e
+            with self._condition:
+                if error is None:
+                    self._saved[path] = max(self._saved.get(path, 0), generation)
+                self._busy = False
+                self._condition.notify_all()
+            on_saved(path, generation, error)
+
+
+autosave_worker = AutosaveWorker()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, as the benchmarks import them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def notes_dir(tmp_path, monkeypatch):
+    """Run in an empty notes directory with a fresh key, cache and journal state"""
+    import storage
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 'compression', ['zlib', 6])
+    monkeypatch.setattr(storage, '_note_listeners', [])
+    storage._journals.clear()
+    storage.key_cache.lock()
+    yield tmp_path
+    storage.key_cache.lock()
+    storage._journals.clear()
+
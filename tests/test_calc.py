@@ -0,0 +1,257 @@
+"""CellModel, its dependency graph and formula compilation, without a display"""
+
+import os
+import queue
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import calc
+import sandbox
+from calc import (CYCLE, MAX_COLS, MAX_ROWS, PENDING, TIMEOUT, CellModel, compile_formula, format_ref,
+                  format_result, shift_formula)
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def aggregates(request, monkeypatch):
+    """Run a test with the pure Python aggregates and again with NumPy, if installed"""
+    if request.param == 'python':
+        calc._numpy()  # Settle the lazy import first, so None sticks
+        monkeypatch.setattr(calc, 'numpy', None)
+    elif calc._numpy() is None:
+        pytest.skip("numpy is not installed")
+    return request.param
+
+
+def counting_model():
+    model = CellModel()
+    model.evaluations = 0
+    evaluate = model.evaluate
+
+    def counted(cell):
+        model.evaluations += 1
+        return evaluate(cell)
+    model.evaluate = counted
+    return model
+
+
+def test_references():
+    assert [calc.column_name(col) for col in (0, 25, 26, 701)] == ['A', 'Z', 'AA', 'ZZ']
+    assert calc.parse_ref('ZZ100000') == (MAX_ROWS - 1, MAX_COLS - 1)
+    assert calc.parse_ref('A0') is None
+    assert CellModel(50, 20).parse_ref('U1') is None
+    assert shift_formula('=A1+B2', 1, 1) == '=B2+C3'
+    assert shift_formula('=A1', -1, 0) == '=#REF'
+
+
+def test_formula_chain_recalculates():
+    model = CellModel()
+    model.set_input((0, 0), '2')
+    model.set_input((1, 0), '=A1*3')
+    model.set_input((2, 0), '=A2+A1')
+    assert model.display((2, 0)) == '8'
+    updated = model.set_input((0, 0), '4')
+    assert set(updated) == {(0, 0), (1, 0), (2, 0)}
+    assert model.display((1, 0)) == '12'
+    assert model.display((2, 0)) == '16'
+
+
+def test_text_and_errors():
+    model = CellModel()
+    model.set_input((0, 0), 'apples')
+    model.set_input((0, 1), '=A1+1')
+    model.set_input((0, 2), '=1/0')
+    model.set_input((0, 3), '=open("x")')
+    assert model.display((0, 1)) == '#ERROR'
+    assert model.display((0, 2)) == '#ERROR'
+    assert model.display((0, 3)) == '#ERROR'
+
+
+def test_cycles_are_marked_and_recover():
+    model = CellModel()
+    model.set_input((0, 0), '=B1')
+    model.set_input((0, 1), '=A1')
+    model.set_input((0, 2), '=A1+1')
+    assert model.display((0, 0)) == CYCLE
+    assert model.display((0, 1)) == CYCLE
+    assert model.display((0, 2)) == '#ERROR'
+    model.set_input((0, 1), '5')
+    assert model.display((0, 0)) == '5'
+    assert model.display((0, 2)) == '6'
+
+
+def test_self_reference_is_a_cycle():
+    model = CellModel()
+    model.set_input((0, 0), '=A1+1')
+    assert model.display((0, 0)) == CYCLE
+
+
+def test_long_chain_has_no_recursion_limit():
+    model = CellModel(5000, 1)
+    with model.batch():
+        model.set_input((0, 0), '1')
+        for row in range(1, 5000):
+            model.set_input((row, 0), f"={format_ref(row - 1, 0)}+1")
+    assert model.display((4999, 0)) == '5000'
+
+
+def test_long_cycle_is_found_without_recursion():
+    model = CellModel(5000, 1)
+    with model.batch():
+        for row in range(5000):
+            model.set_input((row, 0), f"={format_ref((row + 1) % 5000, 0)}")
+    assert model.display((0, 0)) == model.display((4999, 0)) == CYCLE
+    model.set_input((4999, 0), '7')
+    assert model.display((0, 0)) == '7'
+
+
+def test_batch_evaluates_each_formula_once():
+    cells = [(row, 0) for row in range(50)]
+    inputs = [(cells[0], '1')] + [(cell, f"={format_ref(*previous)}+1")
+                                  for previous, cell in zip(cells, cells[1:])]
+
+    per_cell = counting_model()
+    for cell, text in reversed(inputs):
+        per_cell.set_input(cell, text)
+
+    batched = counting_model()
+    with batched.batch() as updated:
+        for cell, text in reversed(inputs):
+            batched.set_input(cell, text)
+
+    assert batched.evaluations == len(cells) - 1
+    assert per_cell.evaluations > batched.evaluations
+    assert set(updated) == set(cells)
+    assert batched.display(cells[-1]) == per_cell.display(cells[-1]) == '50'
+
+
+def test_fill_down_shifts_references():
+    model = CellModel()
+    model.set_input((0, 0), '1')
+    model.set_input((0, 1), '=A1*10')
+    with model.batch():
+        for row in range(1, 4):
+            model.set_input((row, 0), str(row + 1))
+            model.set_input((row, 1), shift_formula(model.formula((0, 1)), row, 0))
+    assert [model.display((row, 1)) for row in range(4)] == ['10', '20', '30', '40']
+
+
+def test_round_trip_and_resize():
+    model = CellModel(200, 30)
+    model.set_input((0, 0), '3')
+    model.set_input((150, 25), '=A1*2')
+    model.set_input((1, 1), 'note')
+    copy = CellModel()
+    copy.load(model.to_dict())
+    assert (copy.rows, copy.cols) == (200, 30)
+    assert copy.display((150, 25)) == '6'
+    assert copy.formula((150, 25)) == '=A1*2'
+    assert copy.input((1, 1)) == 'note'
+    copy.resize(100, 30)
+    assert copy.input((150, 25)) == ''
+    assert copy.has_content()
+
+
+def test_ranges(aggregates):
+    model = CellModel()
+    for row, text in enumerate(['1', '2', 'text', '', '4']):
+        model.set_input((row, 0), text)
+    model.set_input((0, 5), '=SUM(A1:A5)')
+    model.set_input((1, 5), '=COUNT(A1:A5)')
+    model.set_input((2, 5), '=AVERAGE(A1:A5)')
+    model.set_input((3, 5), '=MAX(A1:A5)-MIN(A1:A5)')
+    assert [model.display((row, 5)) for row in range(4)] == ['7', '3', '2.3333333333333335', '3']
+    model.set_input((4, 0), '10')
+    assert model.display((0, 5)) == '13'
+
+
+def test_empty_ranges(aggregates):
+    model = CellModel()
+    model.set_input((0, 0), '=SUM(C5:C9)')
+    model.set_input((0, 1), '=COUNT(C5:C9)')
+    model.set_input((0, 2), '=AVERAGE(C5:C9)')
+    assert [model.display((0, col)) for col in range(3)] == ['0', '0', '#ERROR']
+
+
+def test_ranges_span_blocks(aggregates):
+    model = CellModel(MAX_ROWS, MAX_COLS)
+    for row in (0, 31, 32, 1000, MAX_ROWS - 1):
+        model.set_input((row, 1), '1')
+    model.set_input((0, 0), f"=SUM(B1:B{MAX_ROWS})")
+    model.set_input((1, 0), '=SUM(B32:B33)')
+    assert model.display((0, 0)) == '5'
+    assert model.display((1, 0)) == '2'
+
+
+def test_numpy_is_imported_by_the_first_range_aggregate():
+    script = textwrap.dedent("""
+        import sys
+        import calc
+        model = calc.CellModel()
+        model.set_input((0, 0), '=1+2')
+        print('numpy' in sys.modules)
+        model.set_input((0, 1), '=SUM(A1:A3)')
+        print(model.display((0, 1)))
+    """)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, check=True)
+    assert output.stdout.split() == ['False', '3']
+
+
+def test_unbounded_formulas_are_sandboxed():
+    assert compile_formula('=9**9**9').sandboxed
+    assert compile_formula('=2**2000').sandboxed  # Too large for a float, so never worth running here
+    assert not compile_formula('=A1**B1').sandboxed  # Cell values are floats, which overflow instead
+    assert not compile_formula('=2**10').sandboxed
+    assert not compile_formula('=SUM(A1:A5)*2').sandboxed
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    """A model whose sandboxed results are queued for the test to run, as GLib.idle_add would"""
+    monkeypatch.setattr(sandbox, 'pool', sandbox.SandboxPool(workers=1, cpu_seconds=0.5))
+    calls = queue.Queue()
+    model = CellModel()
+    model.dispatch = lambda function, *args: calls.put((function, args))
+    model.updates = []
+    model.on_update = model.updates.append
+
+    def run_next():
+        function, args = calls.get(timeout=30)
+        function(*args)
+    model.run_next = run_next
+    return model
+
+
+def test_sandboxed_results_arrive_through_dispatch(dispatched):
+    model = dispatched
+    model.set_input((0, 0), '=2**600')
+    model.set_input((0, 1), '=A1*2')
+    assert model.display((0, 0)) == PENDING
+    assert model.display((0, 1)) == PENDING
+    model.run_next()
+    assert model.display((0, 0)) == format_result(2.0 ** 600)
+    assert model.display((0, 1)) == format_result(2.0 ** 601)
+    assert model.updates == [[(0, 0), (0, 1)]]
+
+
+def test_superseded_sandboxed_results_are_dropped(dispatched):
+    model = dispatched
+    model.set_input((0, 0), '=2**600')
+    model.set_input((0, 0), '=2**601')
+    while model.display((0, 0)) == PENDING:
+        model.run_next()
+    assert model.display((0, 0)) == format_result(2.0 ** 601)
+
+
+def test_overrunning_formulas_time_out(dispatched):
+    model = dispatched
+    model.set_input((0, 0), '=9**9**9')
+    model.run_next()
+    assert model.display((0, 0)) == TIMEOUT
+    # The worker is replaced for the next formula
+    model.set_input((0, 0), '=2**2000')
+    model.run_next()
+    assert model.display((0, 0)) == '#ERROR'
@@ -0,0 +1,98 @@
+"""The headless CLI: import, export and verify over a pool of workers"""
+
+import argparse
+import json
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import cli
+from manifest import NoteManifest
+from search import SearchIndex
+from storage import TEXT_SLICE_CHARS, append_journal, journal_path, load_note_file, save_note_file
+
+pytestmark = pytest.mark.usefixtures('notes_dir')
+
+
+@pytest.fixture(autouse=True)
+def directory_indexes(notes_dir, monkeypatch):
+    """The CLI's manifest and index, for the temporary notes directory rather than the one imported from"""
+    monkeypatch.setattr(cli, 'manifest', NoteManifest())
+    monkeypatch.setattr(cli, 'index', SearchIndex())
+
+
+def run(command, **options):
+    return command(argparse.Namespace(workers=2, **options))
+
+
+def write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def test_import_streams_text_and_indexes_it(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    # A word straddling the boundary between two pieces read from the file
+    long_text = 'a' * (TEXT_SLICE_CHARS - 3) + ' straddling words ' + 'é' * 10
+    write(source / 'long.txt', long_text)
+    write(source / 'sheet.csv', '1,2\n=A1+B1,\n')
+    write(source / 'readme.md', 'markdown note')
+    write(source / '.hidden.txt', 'skipped')
+    write(source / 'image.png', 'skipped')
+    assert run(cli.import_notes, source_dir=str(source), overwrite=False) == 0
+    assert load_note_file('long.enc')['text_content'] == long_text
+    sheet = load_note_file('sheet.enc')
+    assert sheet['mode'] == 'calc' and sheet['calc_data']['cells']['1,0'] == '3'
+    assert sorted(entry['file'] for entry in cli.manifest.list_entries()) == ['long.enc', 'readme.enc', 'sheet.enc']
+    assert SearchIndex().search('straddling') == ['long.enc']
+    assert SearchIndex().search('markdown') == ['readme.enc']
+    # Names already taken get a number unless overwriting
+    assert run(cli.import_notes, source_dir=str(source), overwrite=False) == 0
+    assert os.path.exists('long (2).enc')
+    assert run(cli.import_notes, source_dir=str(source), overwrite=True) == 0
+    assert not os.path.exists('long (3).enc')
+
+
+def test_export_formats(tmp_path):
+    text_note = {'mode': 'text', 'text_content': 'line "one"\nline two', 'calc_data': {'cells': {}, 'formulas': {}}}
+    save_note_file('words.enc', text_note)
+    append_journal('words.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': '> '}])
+    sheet = {'mode': 'calc', 'text_content': '',
+             'calc_data': {'rows': 5, 'cols': 5, 'cells': {'0,0': '1', '1,1': 'x,y'}, 'formulas': {}}}
+    save_note_file('sheet.enc', sheet)
+
+    assert run(cli.export_notes, output_dir=str(tmp_path / 'json'), notes=[], format='json') == 0
+    with open(tmp_path / 'json' / 'words.json', encoding='utf-8') as f:
+        assert json.load(f) == dict(text_note, text_content='> ' + text_note['text_content'])
+    with open(tmp_path / 'json' / 'sheet.json', encoding='utf-8') as f:
+        assert json.load(f) == sheet
+
+    assert run(cli.export_notes, output_dir=str(tmp_path / 'text'), notes=['sheet'], format='text') == 0
+    assert os.listdir(tmp_path / 'text') == ['sheet.csv']
+    with open(tmp_path / 'text' / 'sheet.csv', encoding='utf-8', newline='') as f:
+        assert f.read() == '1,\r\n,"x,y"\r\n'
+    with pytest.raises(FileNotFoundError):
+        run(cli.export_notes, output_dir=str(tmp_path / 'text'), notes=['missing'], format='text')
+
+
+def test_verify_reports_damage(capsys):
+    note_data = {'mode': 'text', 'text_content': 'intact', 'calc_data': {'cells': {}, 'formulas': {}}}
+    save_note_file('good.enc', note_data)
+    save_note_file('journaled.enc', note_data)
+    append_journal('journaled.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'x'}])
+    with open(journal_path('journaled.enc'), 'ab') as f:
+        f.write(b'\0\0\1\0torn')
+    save_note_file('.note-2.enc', note_data)  # Scratch notes are verified too
+    assert run(cli.verify_notes) == 0
+    output = capsys.readouterr().out
+    assert 'WARNING journaled.enc' in output
+    assert 'Verified 3 of 3 notes' in output
+
+    with open('good.enc', 'r+b') as f:
+        f.seek(-20, os.SEEK_END)
+        f.write(b'\0' * 20)
+    assert run(cli.verify_notes) == 1
+    assert 'FAILED  good.enc' in capsys.readouterr().out
@@ -0,0 +1,103 @@
+"""The encrypted note manifest and its appended updates"""
+
+import json
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import manifest as manifest_module
+import storage
+from manifest import MANIFEST_FILE, NoteManifest
+from storage import append_journal, cipher_suite, delete_note_file, save_note_file, write_atomic
+
+pytestmark = pytest.mark.usefixtures('notes_dir')
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def listening_manifest():
+    manifest = NoteManifest()
+    manifest.load()
+    storage.add_note_listener(manifest.on_note_changed)
+    return manifest
+
+
+def reread():
+    manifest = NoteManifest()
+    manifest.load()
+    return {entry['file']: entry['preview'] for entry in manifest.list_entries()}
+
+
+def test_updates_are_appended_not_rewritten():
+    manifest = listening_manifest()
+    save_note_file('a.enc', text_note('first note'))
+    inode = os.stat(MANIFEST_FILE).st_ino
+    size = os.path.getsize(MANIFEST_FILE)
+    save_note_file('b.enc', text_note('second note'))
+    save_note_file('.hidden.enc', text_note('not listed'))
+    assert os.stat(MANIFEST_FILE).st_ino == inode
+    assert os.path.getsize(MANIFEST_FILE) > size
+    assert reread() == {'a.enc': 'first note', 'b.enc': 'second note'}
+    delete_note_file('a.enc')
+    assert reread() == {'b.enc': 'second note'}
+    assert [entry['file'] for entry in manifest.list_entries()] == ['b.enc']
+
+
+def test_unchanged_entries_append_nothing():
+    listening_manifest()
+    save_note_file('a.enc', text_note('words'))
+    size = os.path.getsize(MANIFEST_FILE)
+    # A journal append leaves the note file as it was, and trailing spaces leave the preview
+    append_journal('a.enc', [{'op': 'text', 'start': 5, 'end': 5, 'text': '   '}])
+    assert os.path.getsize(MANIFEST_FILE) == size
+    append_journal('a.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'more '}])
+    assert os.path.getsize(MANIFEST_FILE) > size
+    assert reread() == {'a.enc': 'more words'}
+
+
+def test_updates_are_compacted(monkeypatch):
+    monkeypatch.setattr(manifest_module, 'COMPACT_MIN_BYTES', 0)
+    listening_manifest()
+    inodes = set()
+    for i in range(6):
+        save_note_file('a.enc', text_note(f'version {i}'))
+        inodes.add(os.stat(MANIFEST_FILE).st_ino)
+    assert len(inodes) > 1
+    assert reread() == {'a.enc': 'version 5'}
+
+
+def test_torn_update_is_dropped():
+    listening_manifest()
+    save_note_file('a.enc', text_note('kept'))
+    save_note_file('b.enc', text_note('torn'))
+    with open(MANIFEST_FILE, 'r+b') as f:
+        f.truncate(os.path.getsize(MANIFEST_FILE) - 5)
+    assert reread() == {'a.enc': 'kept'}
+
+
+def test_refresh_and_reconcile_follow_the_directory():
+    manifest = listening_manifest()
+    save_note_file('a.enc', text_note('saved here'))
+    storage._note_listeners.clear()  # As if written by another process
+    save_note_file('b.enc', text_note('saved elsewhere'))
+    os.remove('a.enc')
+    changes = manifest.refresh(['a.enc', 'b.enc', '.note.enc'])
+    assert changes['a.enc'] is None
+    assert changes['b.enc']['preview'] == 'saved elsewhere'
+    assert reread() == {'b.enc': 'saved elsewhere'}
+    save_note_file('c.enc', text_note('third'))
+    manifest.reconcile()
+    assert reread() == {'b.enc': 'saved elsewhere', 'c.enc': 'third'}
+
+
+def test_single_token_manifest_is_read():
+    save_note_file('a.enc', text_note('old manifest'))
+    manifest = NoteManifest()
+    manifest.reconcile()
+    data = json.dumps({'version': 1, 'entries': manifest.entries}).encode()
+    write_atomic(MANIFEST_FILE, cipher_suite.encrypt(data))
+    assert reread() == {'a.enc': 'old manifest'}
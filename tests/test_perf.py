@@ -0,0 +1,69 @@
+"""Latency histograms, counters and the SIGUSR1 summary"""
+
+import os
+import signal
+import threading
+
+import pytest
+
+import perf
+from perf import Histogram
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    """Collect into empty tables as if STICKY_PERF were set"""
+    monkeypatch.setattr(perf, 'ENABLED', True)
+    monkeypatch.setattr(perf, 'MODE', '1')
+    monkeypatch.setattr(perf, '_histograms', {})
+    monkeypatch.setattr(perf, '_counters', {})
+    monkeypatch.setattr(perf.atexit, 'register', lambda function: None)
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for micros in [10] * 98 + [5000, 20000]:
+        histogram.add(micros / 1e6)
+    assert histogram.count == 100
+    assert histogram.percentile(0.5) == 16 / 1000  # The 8-16 us bucket
+    assert histogram.percentile(0.99) == 8192 / 1000
+    assert histogram.percentile(1.0) == 20.0  # Capped at the slowest call
+
+
+def test_timed_records_calls_only_when_enabled(enabled):
+    def work(x):
+        return x * 2
+    assert perf.timed('work')(work)(4) == 8
+    perf._count('bytes', 10)
+    perf._count('bytes', 5)
+    assert perf._histograms['work'].count == 1
+    assert perf._counters == {'bytes': 15}
+    perf.ENABLED = False
+    assert perf.timed('work')(work) is work
+
+
+def test_summary_skips_empty_histograms(enabled):
+    perf.record('save', 0.002)
+    perf._histograms['unused'] = Histogram()
+    lines = perf.summary().splitlines()
+    assert [line.split()[0] for line in lines[1:]] == ['save']
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason="no SIGUSR1")
+def test_sigusr1_dumps_from_another_thread(enabled, monkeypatch):
+    dumped = threading.Event()
+
+    def dump(file=None):
+        perf.summary()
+        dumped.set()
+    monkeypatch.setattr(perf, 'dump', dump)
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        perf.start()
+        # The signal arrives while the main thread records a timing
+        with perf._lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert not dumped.wait(0.2)
+        assert dumped.wait(5)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
@@ -0,0 +1,106 @@
+"""Passphrase keys and key rotation of a notes directory"""
+
+import base64
+import json
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import rotate
+import storage
+from manifest import MANIFEST_FILE, NoteManifest
+from search import INDEX_FILE, SearchIndex
+from storage import append_journal, key_cache, load_note_file, save_note_file, write_atomic
+
+pytestmark = pytest.mark.usefixtures('notes_dir')
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def reopen():
+    """Forget everything decrypted with the old key, as a new process would"""
+    key_cache.lock()
+    storage._journals.clear()
+
+
+def test_rotation_keeps_notes_readable():
+    storage.set_compression('zlib')
+    for listener in (NoteManifest(), SearchIndex()):
+        listener.load()
+        storage.add_note_listener(listener.on_note_changed)
+    notes = {f'n{i}.enc': text_note(' '.join(['word'] * 100000 * i)) for i in range(4)}
+    for path, note_data in notes.items():
+        save_note_file(path, note_data)
+    append_journal('n1.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'journaled '}])
+    notes['n1.enc']['text_content'] = 'journaled ' + notes['n1.enc']['text_content']
+    with open(storage.KEY_FILE, 'rb') as f:
+        old_key = f.read()
+
+    assert rotate.rotate_directory(workers=2, use_threads=True) == []
+    with open(storage.KEY_FILE, 'rb') as f:
+        assert f.read() != old_key
+    assert not os.path.exists(rotate.CHECKPOINT_FILE)
+    reopen()
+    for path, note_data in notes.items():
+        assert load_note_file(path) == note_data
+    manifest = NoteManifest()
+    manifest.load()
+    assert sorted(manifest.entries) == sorted(notes)
+    assert SearchIndex().search('journaled') == ['n1.enc']
+    assert os.path.exists(MANIFEST_FILE) and os.path.exists(INDEX_FILE)
+
+
+@pytest.mark.parametrize('cut', ['inside a frame', 'at a frame boundary'])
+def test_truncated_notes_are_not_rotated(cut):
+    storage.set_compression('none')
+    save_note_file('whole.enc', text_note('fine'))
+    save_note_file('torn.enc', text_note('x' * (3 * storage.CHUNK_SIZE)))
+    with open('torn.enc', 'rb') as f:
+        data = f.read()
+    if cut == 'inside a frame':
+        data = data[:-10]
+    else:
+        # Drop the final chunk frame whole
+        offset = len(storage.FORMAT_MAGIC) + storage._HEADER.size
+        frames = []
+        while offset < len(data):
+            frames.append(offset)
+            offset += 4 + int.from_bytes(data[offset:offset + 4], 'big')
+        data = data[:frames[-1]]
+    with open('torn.enc', 'wb') as f:
+        f.write(data)
+
+    assert rotate.rotate_directory(use_threads=True) == ['./torn.enc']
+    assert os.path.exists(rotate.NEW_KEY_FILE)  # The key is only installed once every file is rotated
+    with open(rotate.CHECKPOINT_FILE) as f:
+        assert f.read().splitlines()[1:] == ['./whole.enc']
+
+
+def test_rotation_keeps_the_pending_key_of_the_other_kind():
+    save_note_file('n0.enc', text_note('rotated halfway'))
+    write_atomic(rotate.NEW_KEY_FILE, base64.urlsafe_b64encode(os.urandom(32)))
+    with pytest.raises(ValueError):
+        rotate.rotate_directory(passphrase=True)
+    assert os.path.exists(rotate.NEW_KEY_FILE)
+
+
+def test_passphrase_unlocks_the_session_key():
+    key, params = storage.make_key_params('correct horse', {'n': 1 << 10, 'r': 8, 'p': 1})
+    write_atomic(storage.KEY_PARAMS_FILE, json.dumps(params).encode())
+    attempts = []
+
+    def provider(attempt):
+        attempts.append(attempt)
+        return 'wrong' if attempt == 0 else 'correct horse'
+    cache = storage.KeyCache()
+    cache.passphrase_provider = provider
+    assert cache.key() == key
+    assert attempts == [0, 1]
+    cache.lock()
+    cache.passphrase_provider = lambda attempt: None
+    with pytest.raises(storage.KeyLockedError):
+        cache.cipher()
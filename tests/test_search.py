@@ -0,0 +1,101 @@
+"""The encrypted search index, its appended updates and its view of the directory"""
+
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import search
+import storage
+from search import INDEX_FILE, SearchIndex, tokenize
+from storage import append_journal, delete_note_file, save_note_file
+
+pytestmark = pytest.mark.usefixtures('notes_dir')
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def listening_index():
+    index = SearchIndex()
+    index.load()
+    storage.add_note_listener(index.on_note_changed)
+    return index
+
+
+def test_tokenize():
+    assert tokenize("Budget: Q3 été, x" + 'y' * 80) == ['budget', 'q3', 'été']
+
+
+def test_every_term_matches_and_the_last_as_a_prefix():
+    index = listening_index()
+    save_note_file('a.enc', text_note('meeting budget review'))
+    save_note_file('b.enc', text_note('budget draft'))
+    note_data = text_note('')
+    note_data['calc_data']['cells']['0,0'] = 'budget meetup'
+    save_note_file('c.enc', note_data)
+    assert index.search('budget') == ['a.enc', 'b.enc', 'c.enc']
+    assert index.search('budget mee') == ['a.enc', 'c.enc']
+    assert index.search('mee budget') == []
+    assert index.search('zzz') == []
+    assert index.search('  ') == []
+
+
+def test_updates_are_appended_and_read_back():
+    index = listening_index()
+    save_note_file('a.enc', text_note('apple'))
+    inode = os.stat(INDEX_FILE).st_ino
+    save_note_file('b.enc', text_note('banana'))
+    append_journal('a.enc', [{'op': 'text', 'start': 5, 'end': 5, 'text': ' cherry'}])
+    delete_note_file('b.enc')
+    assert os.stat(INDEX_FILE).st_ino == inode
+    fresh = SearchIndex()
+    assert fresh.search('cherry') == ['a.enc']
+    assert fresh.search('banana') == []
+    assert fresh.documents == index.documents
+
+
+def test_updates_are_compacted(monkeypatch):
+    monkeypatch.setattr(search, 'COMPACT_MIN_BYTES', 0)
+    listening_index()
+    inodes = set()
+    for i in range(6):
+        save_note_file('a.enc', text_note(f'word{i}'))
+        inodes.add(os.stat(INDEX_FILE).st_ino)
+    assert len(inodes) > 1
+    assert SearchIndex().search('word') == ['a.enc']
+
+
+def test_loading_follows_changes_made_by_other_processes():
+    listening_index()
+    save_note_file('a.enc', text_note('apple'))
+    save_note_file('b.enc', text_note('banana'))
+    storage._note_listeners.clear()  # Written by the CLI or another instance from here on
+    save_note_file('c.enc', text_note('cherry'))
+    append_journal('a.enc', [{'op': 'text', 'start': 0, 'end': 5, 'text': 'apricot'}])
+    os.remove('b.enc')
+    index = SearchIndex()
+    assert index.search('cherry') == ['c.enc']
+    assert index.search('apricot') == ['a.enc']
+    assert index.search('apple') == []
+    assert index.search('banana') == []
+    # Reconciling persisted the changes, so the next process reads nothing
+    storage.key_cache.lock()
+    reads = storage.note_cache.misses
+    assert SearchIndex().search('apricot') == ['a.enc']
+    assert storage.note_cache.misses == reads
+
+
+def test_refresh_reindexes_only_the_given_files():
+    index = listening_index()
+    save_note_file('a.enc', text_note('apple'))
+    storage._note_listeners.clear()
+    save_note_file('a.enc', text_note('apricot'))
+    save_note_file('b.enc', text_note('banana'))
+    index.refresh(['a.enc', '.note.enc'])
+    assert index.search('apricot') == ['a.enc']
+    assert index.search('banana') == []
+    index.reconcile()
+    assert index.search('banana') == ['b.enc']
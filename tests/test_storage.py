@@ -0,0 +1,309 @@
+"""Note file formats, journals and the decrypted-note cache, in a temporary notes directory"""
+
+import io
+import json
+import os
+import random
+import struct
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import storage
+from storage import (CHUNK_SIZE, FORMAT_MAGIC_V2, SCRATCH_NOTE, AutosaveWorker, NoteLoader, NoteReader,
+                     StaleJournalError, append_journal, apply_journal_ops, cipher_suite, claim_scratch_note,
+                     journal_path, key_cache, load_note_file, new_generation, new_journal_id, note_cache,
+                     release_scratch_note, save_note_file, write_atomic)
+
+pytestmark = pytest.mark.usefixtures('notes_dir')
+
+
+def text_note(text):
+    return {'mode': 'text', 'text_content': text, 'calc_data': {'cells': {}, 'formulas': {}}}
+
+
+def sample_text(chars):
+    rng = random.Random(42)
+    words = ['note', 'été', '日本語', 'budget', 'x' * 30, '\n']
+    parts = []
+    length = 0
+    while length < chars:
+        parts.append(rng.choice(words))
+        length += len(parts[-1]) + 1
+    return ' '.join(parts)
+
+
+def read_from_disk(path):
+    note_cache.clear()
+    return load_note_file(path)
+
+
+def test_chunked_round_trip():
+    # More than one chunk, with multi-byte characters across chunk boundaries
+    storage.set_compression('none')
+    note_data = text_note(sample_text(3 * CHUNK_SIZE))
+    note_data['calc_data'] = {'rows': 60, 'cols': 20, 'cells': {'0,0': '1', '59,19': 'é'}, 'formulas': {}}
+    save_note_file('note.enc', note_data)
+    assert os.path.getsize('note.enc') > 3 * CHUNK_SIZE
+    assert read_from_disk('note.enc') == note_data
+    with NoteReader('note.enc') as reader:
+        assert reader.meta['calc_data'] == note_data['calc_data']
+        assert ''.join(reader.iter_text()) == note_data['text_content']
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib', 'lzma'])
+def test_compressed_round_trip(codec):
+    storage.set_compression(codec)
+    note_data = text_note(sample_text(2 * CHUNK_SIZE))
+    save_note_file('note.enc', note_data)
+    with open('note.enc', 'rb') as f:
+        assert f.read(len(storage.FORMAT_MAGIC) + storage._HEADER.size)[-1] == storage.CODECS[codec]
+    assert read_from_disk('note.enc') == note_data
+    if codec != 'none':
+        assert os.path.getsize('note.enc') < len(note_data['text_content'])
+
+
+def test_version_2_notes():
+    # Base64 tokens, no codec byte and an uncompressed stream
+    file_id = os.urandom(16)
+    meta = {'mode': 'text', 'calc_data': {'cells': {}, 'formulas': {}}}
+    stream = json.dumps(meta).encode() + b'\n' + 'version two ✓'.encode()
+    with open('v2.enc', 'wb') as f:
+        f.write(FORMAT_MAGIC_V2 + storage._HEADER_V2.pack(CHUNK_SIZE, file_id))
+        for index, start in enumerate(range(0, len(stream), 8)):
+            final = start + 8 >= len(stream)
+            prefix = storage._CHUNK_PREFIX.pack(file_id, index, final)
+            f.write(storage.pack_frame(cipher_suite.encrypt(prefix + stream[start:start + 8])))
+    assert load_note_file('v2.enc') == dict(meta, text_content='version two ✓')
+
+
+def test_empty_note_round_trip():
+    save_note_file('empty.enc', text_note(''))
+    assert read_from_disk('empty.enc') == text_note('')
+
+
+def test_legacy_single_token_notes():
+    note_data = text_note('written before the chunked format')
+    write_atomic('json.enc', cipher_suite.encrypt(json.dumps(note_data).encode()))
+    write_atomic('plain.enc', cipher_suite.encrypt('just text'.encode()))
+    assert load_note_file('json.enc') == note_data
+    assert load_note_file('plain.enc') == {'mode': 'text', 'text_content': 'just text'}
+
+
+def test_truncated_note_is_an_error():
+    save_note_file('note.enc', text_note(sample_text(10000)))
+    with open('note.enc', 'r+b') as f:
+        f.truncate(os.path.getsize('note.enc') - 10)
+    with pytest.raises(ValueError):
+        read_from_disk('note.enc')
+
+
+def test_reader_closes_the_file_when_the_header_is_unreadable(monkeypatch):
+    opened = []
+
+    def tracked_open(*args):
+        opened.append(io.open(*args))
+        return opened[-1]
+    monkeypatch.setattr(storage, 'open', tracked_open, raising=False)
+    write_atomic('bad.enc', storage.FORMAT_MAGIC + b'\0' * 5)
+    with pytest.raises(ValueError):
+        NoteReader('bad.enc').__enter__()
+    assert opened and all(f.closed for f in opened)
+
+
+def test_journal_replay():
+    note_data = text_note('hello world')
+    save_note_file('note.enc', note_data)
+    ops = [
+        {'op': 'text', 'start': 5, 'end': 11, 'text': ' there'},
+        {'op': 'cell', 'cell': '2,3', 'input': '=A1+1'},
+        {'op': 'cell', 'cell': '0,0', 'input': '4'},
+        {'op': 'size', 'rows': 10, 'cols': 5},
+        {'op': 'mode', 'mode': 'calc'},
+    ]
+    append_journal('note.enc', ops[:2])
+    append_journal('note.enc', ops[2:])
+    expected = json.loads(json.dumps(note_data))
+    apply_journal_ops(expected, ops)
+    assert read_from_disk('note.enc') == expected
+    assert expected['text_content'] == 'hello there'
+    # A new snapshot starts an empty journal
+    save_note_file('note.enc', expected)
+    assert not os.path.exists(journal_path('note.enc'))
+
+
+def test_torn_journal_record_is_dropped():
+    save_note_file('note.enc', text_note('a'))
+    append_journal('note.enc', [{'op': 'text', 'start': 1, 'end': 1, 'text': 'b'}])
+    append_journal('note.enc', [{'op': 'text', 'start': 2, 'end': 2, 'text': 'c'}])
+    with open(journal_path('note.enc'), 'r+b') as f:
+        f.truncate(os.path.getsize(journal_path('note.enc')) - 3)
+    storage._journals.clear()  # As after a crash: the state is read back from the file
+    assert read_from_disk('note.enc')['text_content'] == 'ab'
+    # The next append truncates the torn record before writing its own
+    append_journal('note.enc', [{'op': 'text', 'start': 2, 'end': 2, 'text': 'd'}])
+    assert read_from_disk('note.enc')['text_content'] == 'abd'
+
+
+def test_corrupt_journal_record_ends_replay():
+    save_note_file('note.enc', text_note('a'))
+    append_journal('note.enc', [{'op': 'text', 'start': 1, 'end': 1, 'text': 'b'}])
+    with open(journal_path('note.enc'), 'ab') as f:
+        f.write(struct.pack('>I', 8) + b'garbage!')
+    storage._journals.clear()
+    assert read_from_disk('note.enc')['text_content'] == 'ab'
+
+
+def test_journal_appends_notify_listeners():
+    seen = []
+    storage.add_note_listener(lambda path, note_data: seen.append(note_data['text_content']))
+    save_note_file('note.enc', text_note('apple'))
+    append_journal('note.enc', [{'op': 'text', 'start': 5, 'end': 5, 'text': ' banana'}])
+    note_cache.clear()  # Uncached notes are read back instead
+    append_journal('note.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'cherry '}])
+    assert seen == ['apple', 'apple banana', 'cherry apple banana']
+
+def test_appends_only_extend_the_snapshot_they_were_made_against():
+    # Two windows autosaving to the same file: B saves over A's snapshot
+    a = save_note_file('note.enc', text_note('A'))
+    b = save_note_file('note.enc', text_note('B'))
+    with pytest.raises(StaleJournalError):
+        append_journal('note.enc', [{'op': 'text', 'start': 1, 'end': 1, 'text': '!'}], journal_id=a)
+    append_journal('note.enc', [{'op': 'text', 'start': 1, 'end': 1, 'text': '?'}], journal_id=b)
+    assert read_from_disk('note.enc')['text_content'] == 'B?'
+
+
+def test_appends_notice_snapshots_written_by_other_processes():
+    a = save_note_file('note.enc', text_note('mine'))
+    state = list(storage._journals['note.enc'])
+    save_note_file('note.enc', text_note('theirs'))
+    storage._journals['note.enc'] = state  # What this process last knew
+    with pytest.raises(StaleJournalError):
+        append_journal('note.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'x'}], journal_id=a)
+    append_journal('note.enc', [{'op': 'text', 'start': 0, 'end': 0, 'text': 'all '}])
+    assert read_from_disk('note.enc')['text_content'] == 'all theirs'
+
+
+class Window:
+    """What a window hands the autosave worker: its own journal id and callback"""
+
+    def __init__(self, worker, path):
+        self.worker = worker
+        self.path = path
+        self.journal_id = None
+        self.errors = []
+
+    def on_saved(self, path, generation, error):
+        if error is not None:
+            self.errors.append(error)
+
+    def snapshot(self, text):
+        self.journal_id = new_journal_id()
+        self.worker.submit(self.path, new_generation(), text_note(text), self.on_saved, self.journal_id)
+
+    def type(self, offset, text):
+        ops = [{'op': 'text', 'start': offset, 'end': offset, 'text': text}]
+        self.worker.submit_ops(self.path, new_generation(), ops, self.on_saved, self.journal_id)
+
+
+def test_windows_sharing_a_scratch_note_do_not_mix_their_edits():
+    worker = AutosaveWorker()
+    a, b = Window(worker, SCRATCH_NOTE), Window(worker, SCRATCH_NOTE)
+    a.snapshot('A')
+    b.snapshot('B')
+    a.type(1, '!')
+    worker.flush()
+    assert read_from_disk(SCRATCH_NOTE)['text_content'] == 'B'
+    assert [type(error) for error in a.errors] == [StaleJournalError]
+    assert not b.errors
+    # As the window does on the error: save its whole note instead
+    a.snapshot('A!')
+    b.type(1, '?')
+    worker.flush()
+    assert read_from_disk(SCRATCH_NOTE)['text_content'] == 'A!'
+    assert [type(error) for error in b.errors] == [StaleJournalError]
+
+
+def test_each_window_gets_its_own_scratch_note():
+    first, second = claim_scratch_note(), claim_scratch_note()
+    try:
+        assert first == SCRATCH_NOTE
+        assert second != first and storage.is_scratch_file(second)
+        assert not storage.is_note_file(second)
+    finally:
+        release_scratch_note(first)
+        release_scratch_note(second)
+    assert claim_scratch_note() == SCRATCH_NOTE
+    release_scratch_note(SCRATCH_NOTE)
+
+
+def test_compaction_keeps_the_window_journaling(monkeypatch):
+    monkeypatch.setattr(storage, 'JOURNAL_COMPACT_BYTES', 0)
+    worker = AutosaveWorker()
+    window = Window(worker, 'note.enc')
+    window.snapshot('a')
+    worker.flush()
+    for offset, text in enumerate('bcd', 1):
+        window.type(offset, text)
+        worker.flush()
+    assert not window.errors
+    assert not os.path.exists(journal_path('note.enc'))  # Every append was compacted
+    assert read_from_disk('note.enc')['text_content'] == 'abcd'
+
+
+def test_cache_serves_saved_notes_until_they_change():
+    note_data = text_note('cached')
+    save_note_file('note.enc', note_data)
+    hits = note_cache.hits
+    assert load_note_file('note.enc') == note_data
+    assert note_cache.hits == hits + 1
+    # Another process rewrites the file: the entry no longer matches it
+    with open('other.enc', 'wb') as f:
+        with open('note.enc', 'rb') as source:
+            f.write(source.read())
+    os.replace('other.enc', 'note.enc')
+    misses = note_cache.misses
+    assert load_note_file('note.enc') == note_data
+    assert note_cache.misses == misses + 1
+
+
+def test_cache_is_bounded_and_zeroed():
+    cache = storage.NoteCache(max_bytes=3000)
+    for i in range(5):
+        cache.put(f'n{i}.enc', (i,), None, text_note('x' * 1000))
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['evictions'] == 3
+    assert cache.get('n0.enc') is None
+    buffers = [entry[2] for entry in cache._entries.values()]
+    cache.clear()
+    assert cache.stats()['bytes'] == 0
+    assert all(not any(buffer) for buffer in buffers)
+    cache.put('big.enc', (0,), None, text_note('x' * 5000))
+    assert not cache.fits('big.enc')
+    assert cache.stats()['entries'] == 0
+
+
+def test_locking_the_key_clears_the_cache():
+    save_note_file('note.enc', text_note('secret'))
+    assert note_cache.stats()['entries'] == 1
+    key_cache.lock()
+    assert note_cache.stats()['entries'] == 0
+
+
+def test_loader_marks_notes_too_large_to_cache(monkeypatch):
+    monkeypatch.setattr(note_cache, 'max_bytes', 1000)
+    save_note_file('big.enc', text_note(sample_text(5000)))
+    note_cache.clear()
+    pieces = []
+
+    def on_event(loader, kind, value):
+        if kind == 'text':
+            pieces.append(value)
+            loader.consumed()
+    loader = NoteLoader('big.enc', on_event)
+    loader.start()
+    loader._thread.join(30)
+    assert len(''.join(pieces)) >= 5000
+    assert not note_cache.fits('big.enc')
+    assert note_cache.stats()['entries'] == 0